@@ -0,0 +1,497 @@
+# API Benchmark
+# Avvia l'app FastAPI nello stesso processo (httpx ASGITransport, nessuna
+# rete), crea utenti sintetici e misura carichi concorrenti: login, letture
+# della dashboard, import in blocco di entrate e insight con il finto LLM.
+# Per ogni carico riporta p50/p95/p99 e richieste al secondo e, se esiste
+# una baseline, fallisce (exit 1) quando i numeri peggiorano oltre la
+# tolleranza.
+#
+# Per le liste più grandi riporta anche i byte trasferiti in chiaro, gzip e
+# brotli (compression.py) e il tempo di serializzazione con l'encoder di
+# default di FastAPI (jsonable_encoder + json.dumps) e con serialization.py.
+#
+# Uso:
+#   python benchmark.py                                # mongomock-motor in memoria
+#   python benchmark.py --mongo-url mongodb://localhost:27017
+#   python benchmark.py --storage sqlite               # SQLite in un file temporaneo
+#   python benchmark.py --tenants 50 --entrate 2000 --concurrency 32
+#   python benchmark.py --update-baseline              # salva i risultati come baseline
+#
+# benchmark_baseline.json contiene una baseline di riferimento per backend
+# ("mongomock" e "sqlite", parametri di default): ogni esecuzione si
+# confronta con quella del proprio backend e --update-baseline sostituisce
+# solo quella. I numeri dipendono dalla macchina: su un ambiente diverso da
+# quello di riferimento si rigenera la baseline prima di confrontare. I
+# confronti valgono solo a parità di parametri del seed e del carico.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+ROOT_DIR = Path(__file__).parent
+
+DEFAULT_BASELINE = ROOT_DIR / "benchmark_baseline.json"
+
+WORKLOADS = ("login", "dashboard", "entrate_list", "entrate_bulk", "insights")
+
+# Liste misurate da measure_payloads: (nome, path, parametri)
+PAYLOAD_ENDPOINTS = (
+    ("entrate", "/api/entrate", {"limit": 1000}),
+    ("costi_variabili", "/api/costi/variabili", {"limit": 1000}),
+    ("materiali", "/api/materiali", {})
+)
+
+# Ripetizioni per il tempo di serializzazione (si riporta la mediana)
+PAYLOAD_REPEAT = 20
+
+PASSWORD = "benchmark-password"
+
+# Parametri che devono coincidere con la baseline perché il confronto abbia senso
+COMPARABLE_PARAMS = (
+    "backend", "tenants", "entrate", "materiali", "requests", "concurrency",
+    "bulk_rows", "llm_latency", "bcrypt_rounds", "seed"
+)
+
+
+# ============== SETUP ==============
+
+def configure_environment(args) -> str:
+    """Variabili lette da server.py all'import: vanno impostate prima"""
+    db_name = f"benchmark_{uuid.uuid4().hex[:8]}"
+    os.environ["STORAGE_BACKEND"] = args.storage
+    os.environ["DB_NAME"] = db_name
+    os.environ["MONGO_URL"] = args.mongo_url or os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["LLM_FAKE_LATENCY"] = str(args.llm_latency)
+    os.environ["SLOW_REQUEST_MS"] = "0"
+    os.environ["NOTIFICHE_SWEEP_INTERVAL"] = "0"
+    if args.bcrypt_rounds:
+        os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+
+    if args.storage == "sqlite":
+        os.environ["SQLITE_PATH"] = str(Path(tempfile.gettempdir()) / f"{db_name}.db")
+    elif args.mongo_url is None:
+        try:
+            import mongomock_motor
+        except ImportError:
+            sys.exit("mongomock-motor non installato: pip install mongomock-motor oppure usa --mongo-url")
+        import motor.motor_asyncio
+        motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+    return db_name
+
+
+async def seed(server, args) -> List[dict]:
+    """
+    Crea `args.tenants` utenti con sessione, entrate, costi e materiali
+
+    Returns:
+        list: [{user_id, email, token}]
+    """
+    rng = random.Random(args.seed)
+    store = server.store
+    oggi = date.today()
+    password_hash = await server.password_hasher.hash(PASSWORD)
+    now = datetime.now(timezone.utc)
+
+    tenants = []
+    for i in range(args.tenants):
+        user_id = f"user_bench{i:05d}"
+        email = f"bench{i:05d}@example.com"
+        token = f"sess_{uuid.uuid4().hex}"
+        tenants.append({"user_id": user_id, "email": email, "token": token})
+
+        await store.insert_user({
+            "user_id": user_id,
+            "email": email,
+            "name": f"Benchmark {i}",
+            "password_hash": password_hash,
+            "picture": None,
+            "created_at": now,
+            "subscription_tier": "pro" if i % 2 else "free",
+            "auth_method": "email"
+        })
+        await store.insert_session({
+            "user_id": user_id,
+            "session_token": token,
+            "expires_at": now + timedelta(days=7),
+            "created_at": now
+        })
+        await store.insert_profile({
+            "user_id": user_id,
+            "tipo_attivita": "negozio",
+            "settore": "commercio",
+            "obiettivi": ["controllo_costi"],
+            "created_at": now.isoformat()
+        })
+
+        entrate = [
+            server.build_entrata_doc(user_id, server.EntrataInput(
+                descrizione=f"Vendita {n}",
+                importo=round(rng.uniform(10, 500), 2),
+                data=(oggi - timedelta(days=rng.randrange(90))).isoformat()
+            ))
+            for n in range(args.entrate)
+        ]
+        costi = [
+            server.build_costo_variabile_doc(user_id, server.CostoVariabileInput(
+                descrizione=f"Spesa {n}",
+                importo=round(rng.uniform(5, 200), 2),
+                data=(oggi - timedelta(days=rng.randrange(90))).isoformat()
+            ))
+            for n in range(args.entrate // 2)
+        ]
+        # Passa dallo storage: i totali della dashboard restano allineati come con le API
+        if entrate:
+            await store.insert_ledger_many("entrate", user_id, list(enumerate(entrate, start=1)))
+        if costi:
+            await store.insert_ledger_many("costi_variabili", user_id, list(enumerate(costi, start=1)))
+        await store.insert_costo_fisso({
+            "costo_id": f"cf_bench{i:05d}",
+            "user_id": user_id,
+            "descrizione": "Affitto",
+            "importo_mensile": 1500,
+            "quota_giornaliera": 50.0,
+            "created_at": now.isoformat()
+        })
+        for n in range(args.materiali):
+            await store.insert_materiale({
+                "materiale_id": f"mat_bench{i:05d}_{n:03d}",
+                "user_id": user_id,
+                "nome": f"Materiale {n}",
+                "quantita_disponibile": round(rng.uniform(0, 100), 1),
+                "unita_misura": "pz",
+                "consumo_medio_giornaliero": round(rng.uniform(0, 10), 1),
+                "giorni_consegna": rng.randrange(1, 10),
+                "costo_unitario": 1.0,
+                "created_at": now.isoformat()
+            })
+
+    return tenants
+
+
+# ============== WORKLOADS ==============
+
+def _auth(tenant: dict) -> dict:
+    return {"Authorization": f"Bearer {tenant['token']}"}
+
+
+def build_workloads(args) -> Dict[str, Callable]:
+    oggi = date.today()
+    counter = {"insights": 0}
+
+    async def login(client, tenant, i):
+        return await client.post("/api/auth/login", json={"email": tenant["email"], "password": PASSWORD})
+
+    async def dashboard(client, tenant, i):
+        data = (oggi - timedelta(days=i % 30)).isoformat()
+        return await client.get("/api/dashboard", params={"data": data}, headers=_auth(tenant))
+
+    async def entrate_list(client, tenant, i):
+        return await client.get("/api/entrate", params={"limit": 1000}, headers=_auth(tenant))
+
+    async def entrate_bulk(client, tenant, i):
+        rows = [
+            {"descrizione": f"Import {i}-{n}", "importo": 10 + n, "data": (oggi - timedelta(days=n % 30)).isoformat()}
+            for n in range(args.bulk_rows)
+        ]
+        return await client.post("/api/entrate/bulk", json=rows, headers=_auth(tenant))
+
+    async def insights(client, tenant, i):
+        # Un giorno diverso per ogni richiesta: misura la generazione, non la lettura
+        counter["insights"] += 1
+        data = (oggi - timedelta(days=counter["insights"])).isoformat()
+        return await client.get("/api/insights", params={"data": data}, headers=_auth(tenant))
+
+    return {
+        "login": login,
+        "dashboard": dashboard,
+        "entrate_list": entrate_list,
+        "entrate_bulk": entrate_bulk,
+        "insights": insights
+    }
+
+
+async def run_workload(client, tenants: List[dict], fn, requests: int, concurrency: int) -> dict:
+    """Esegue `requests` chiamate con `concurrency` client in parallelo"""
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < requests:
+            i = next_index
+            next_index += 1
+            started = time.perf_counter()
+            response = await fn(client, tenants[i % len(tenants)], i)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99]) if latencies else (0, 0, 0)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0
+    }
+
+
+# ============== PAYLOAD ==============
+
+def _median_ms(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return round(float(np.median(timings)) * 1000, 3)
+
+
+async def _payload(server, name: str, user_id: str):
+    if name == "materiali":
+        return await server.load_materiali_con_stato(user_id)
+    docs, _ = await server.store.list_ledger(name, user_id, None, 1000)
+    return docs
+
+
+async def measure_payloads(client, server, tenant: dict, repeat: int = PAYLOAD_REPEAT) -> dict:
+    """
+    Byte trasferiti per codifica e tempo di serializzazione prima/dopo
+
+    Returns:
+        dict: {endpoint: {documenti, byte_<codifica>, serializza_<encoder>_ms}}
+    """
+    import compression
+    import serialization
+    from fastapi.encoders import jsonable_encoder
+
+    encodings = ["identity", "gzip"] + (["br"] if compression.BROTLI_AVAILABLE else [])
+    results = {}
+    for name, path, params in PAYLOAD_ENDPOINTS:
+        result = {}
+        for encoding in encodings:
+            response = await client.get(path, params=params, headers={**_auth(tenant), "Accept-Encoding": encoding})
+            result.setdefault("documenti", len(response.json()))
+            result[f"byte_{encoding}"] = response.num_bytes_downloaded
+
+        # Stessi documenti serializzati come JSONResponse e come FastJSONResponse
+        payload = await _payload(server, name, tenant["user_id"])
+        result["serializza_default_ms"] = _median_ms(
+            lambda: json.dumps(
+                jsonable_encoder(payload), ensure_ascii=False, allow_nan=False, separators=(",", ":")
+            ).encode("utf-8"),
+            repeat
+        )
+        result["serializza_fast_ms"] = _median_ms(lambda: serialization.dumps(payload), repeat)
+        results[name] = result
+    return results
+
+
+# ============== BASELINE ==============
+
+def load_baseline(path: Path, backend: str) -> Optional[dict]:
+    """Baseline del backend indicato, se presente nel file"""
+    if not path.exists():
+        return None
+    baselines = json.loads(path.read_text())
+    # File con una sola baseline (formato precedente)
+    if "workloads" in baselines:
+        baselines = {baselines.get("params", {}).get("backend"): baselines}
+    return baselines.get(backend)
+
+
+def save_baseline(path: Path, results: dict):
+    """Sostituisce la baseline del backend dei risultati, lasciando le altre"""
+    baselines = json.loads(path.read_text()) if path.exists() else {}
+    if "workloads" in baselines:
+        baselines = {baselines.get("params", {}).get("backend"): baselines}
+    baselines[results["params"]["backend"]] = results
+    path.write_text(json.dumps(dict(sorted(baselines.items())), indent=2) + "\n")
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Confronta i risultati con la baseline
+
+    Returns:
+        list: regressioni trovate (vuota se tutto è entro la tolleranza)
+    """
+    regressions = []
+    for name, result in results["workloads"].items():
+        base = baseline["workloads"].get(name)
+        if base is None:
+            continue
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: errori {base['errors']} -> {result['errors']}")
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {base[key]} -> {result[key]}")
+        if result["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {base['rps']} -> {result['rps']}")
+    return regressions
+
+
+def print_report(results: dict, baseline: Optional[dict]):
+    print(f"\n{'carico':<14}{'richieste':>10}{'errori':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'rps':>10}")
+    for name, r in results["workloads"].items():
+        line = f"{name:<14}{r['requests']:>10}{r['errors']:>8}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['rps']:>10}"
+        base = (baseline or {}).get("workloads", {}).get(name)
+        if base:
+            line += f"   (baseline p95 {base['p95_ms']} ms, {base['rps']} rps)"
+        print(line)
+
+    if results.get("payloads"):
+        encodings = [k for k in next(iter(results["payloads"].values())) if k.startswith("byte_")]
+        print(f"\n{'lista':<16}{'documenti':>10}" + "".join(f"{e:>15}" for e in encodings) + f"{'default ms':>12}{'fast ms':>10}")
+        for name, p in results["payloads"].items():
+            print(
+                f"{name:<16}{p['documenti']:>10}" + "".join(f"{p[e]:>15}" for e in encodings)
+                + f"{p['serializza_default_ms']:>12}{p['serializza_fast_ms']:>10}"
+            )
+
+
+# ============== MAIN ==============
+
+async def run(args) -> int:
+    db_name = configure_environment(args)
+
+    # Importa il server solo ora: legge l'ambiente appena configurato
+    import httpx
+    import server
+
+    # Una riga di log per richiesta falserebbe le misure
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    await server.app.router.startup()
+    try:
+        print(f"Seed: {args.tenants} utenti, {args.entrate} entrate e {args.materiali} materiali ciascuno...")
+        tenants = await seed(server, args)
+
+        transport = httpx.ASGITransport(app=server.app)
+        workloads = build_workloads(args)
+        results = {
+            "params": {
+                "backend": "sqlite" if args.storage == "sqlite" else "mongodb" if args.mongo_url else "mongomock",
+                "tenants": args.tenants,
+                "entrate": args.entrate,
+                "materiali": args.materiali,
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "bulk_rows": args.bulk_rows,
+                "llm_latency": args.llm_latency,
+                "bcrypt_rounds": server.password_hasher.rounds,
+                "seed": args.seed
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpu_count": os.cpu_count(),
+                "date": datetime.now(timezone.utc).isoformat()
+            },
+            "workloads": {}
+        }
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            for name in args.workloads:
+                print(f"Carico {name}: {args.requests} richieste, concorrenza {args.concurrency}")
+                results["workloads"][name] = await run_workload(
+                    client, tenants, workloads[name], args.requests, args.concurrency
+                )
+            print("Payload delle liste: byte per codifica e tempo di serializzazione")
+            results["payloads"] = await measure_payloads(client, server, tenants[0])
+    finally:
+        if args.storage == "mongo" and args.mongo_url:
+            await server.store.client.drop_database(db_name)
+        await server.app.router.shutdown()
+        if args.storage == "sqlite":
+            for suffix in ("", "-wal", "-shm"):
+                Path(os.environ["SQLITE_PATH"] + suffix).unlink(missing_ok=True)
+
+    backend = results["params"]["backend"]
+    baseline = None if args.update_baseline else load_baseline(args.baseline, backend)
+
+    print_report(results, baseline)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        print(f"\n✅ Baseline {backend} salvata in {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print(f"\nNessuna baseline {backend} in {args.baseline}: generala con --update-baseline")
+        return 0
+
+    differenti = [
+        k for k in COMPARABLE_PARAMS
+        if baseline.get("params", {}).get(k) != results["params"][k]
+    ]
+    if differenti:
+        print(f"\n⚠️  Parametri diversi dalla baseline ({', '.join(differenti)}): confronto saltato")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n❌ Regressioni oltre il {args.tolerance:.0%}:")
+        for r in regressions:
+            print(f"   {r}")
+        return 1
+
+    print(f"\n✅ Nessuna regressione oltre il {args.tolerance:.0%}")
+    return 0
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark dell'API Balance")
+    parser.add_argument("--storage", choices=("mongo", "sqlite"), default="mongo", help="Backend di storage (vedi storage.py)")
+    parser.add_argument("--mongo-url", help="MongoDB reale (database temporaneo); senza, usa mongomock-motor")
+    parser.add_argument("--tenants", type=int, default=20, help="Utenti sintetici")
+    parser.add_argument("--entrate", type=int, default=500, help="Entrate per utente (più la metà di costi variabili)")
+    parser.add_argument("--materiali", type=int, default=20, help="Materiali per utente")
+    parser.add_argument("--requests", type=int, default=200, help="Richieste per carico")
+    parser.add_argument("--concurrency", type=int, default=16, help="Richieste in parallelo")
+    parser.add_argument("--bulk-rows", type=int, default=100, help="Righe per import entrate_bulk")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Latenza del finto LLM in secondi")
+    parser.add_argument("--bcrypt-rounds", type=int, help="Cost factor bcrypt (default: BCRYPT_ROUNDS del server)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed dei dati sintetici")
+    parser.add_argument("--workloads", nargs="+", choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE, help="File della baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Peggioramento tollerato (0.2 = 20%%)")
+    parser.add_argument("--update-baseline", action="store_true", help="Salva i risultati come nuova baseline")
+    parser.add_argument("--output", help="Scrive i risultati JSON in questo file")
+    args = parser.parse_args(argv)
+
+    return asyncio.run(run(args))
+
+
+__all__ = [
+    'WORKLOADS', 'PAYLOAD_ENDPOINTS', 'seed', 'build_workloads', 'run_workload', 'measure_payloads',
+    'load_baseline', 'save_baseline', 'compare'
+]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# Bulk Import
+# Importazione massiva di entrate e costi variabili da CSV o array JSON
+# (migrazione da fogli di calcolo): validazione riga per riga con i modelli
+# di input esistenti e scrittura con insert_many non ordinati a blocchi.
+#
+# I limiti si applicano prima del lavoro che costano: il server rifiuta i
+# corpi oltre BULK_IMPORT_MAX_BYTES prima di leggerli per intero, e
+# parse_rows smette di leggere il CSV alla prima riga oltre il massimo.
+
+import csv
+import io
+import json
+from typing import List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+from pymongo.errors import BulkWriteError
+
+CHUNK_SIZE = 1000
+
+
+class TooManyRowsError(ValueError):
+    """Il corpo contiene più righe del massimo consentito"""
+
+
+def parse_rows(body: bytes, content_type: str, max_rows: Optional[int] = None) -> List[dict]:
+    """
+    Legge le righe dal corpo della richiesta
+
+    Accetta text/csv (separatore , o ; con intestazione) oppure un array JSON.
+
+    Args:
+        max_rows: righe massime; il CSV non viene letto oltre
+
+    Raises:
+        TooManyRowsError: se le righe sono più di max_rows
+        ValueError: se il corpo non è leggibile
+    """
+    if "csv" in (content_type or ""):
+        try:
+            text = body.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            raise ValueError("Il CSV deve essere codificato in UTF-8")
+
+        header = text.split("\n", 1)[0]
+        if not header.strip():
+            return []
+
+        delimiter = ";" if header.count(";") > header.count(",") else ","
+        rows = []
+        for row in csv.DictReader(io.StringIO(text), delimiter=delimiter):
+            if max_rows is not None and len(rows) >= max_rows:
+                raise TooManyRowsError(f"Massimo {max_rows} righe per importazione")
+            row = {(k or "").strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items()}
+            # Importi all'italiana: "12,50"
+            importo = row.get("importo")
+            if isinstance(importo, str) and "," in importo and "." not in importo:
+                row["importo"] = importo.replace(",", ".")
+            rows.append(row)
+        return rows
+
+    try:
+        rows = json.loads(body or b"[]")
+    except ValueError:
+        raise ValueError("JSON non valido")
+    if not isinstance(rows, list):
+        raise ValueError("Il corpo deve essere un array JSON")
+    if max_rows is not None and len(rows) > max_rows:
+        raise TooManyRowsError(f"Massimo {max_rows} righe per importazione")
+    return rows
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(p) for p in e['loc'])}: {e['msg']}" for e in error.errors()
+    )
+
+
+def validate_rows(rows: List[dict], model: Type[BaseModel]) -> Tuple[List[Tuple[int, BaseModel]], List[dict]]:
+    """
+    Valida ogni riga con il modello di input
+
+    Returns:
+        tuple: ([(riga, input)], [{"riga", "errore"}]) con righe numerate da 1
+    """
+    valid = []
+    errors = []
+    for riga, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            errors.append({"riga": riga, "errore": "La riga deve essere un oggetto"})
+            continue
+        try:
+            valid.append((riga, model(**row)))
+        except ValidationError as e:
+            errors.append({"riga": riga, "errore": _format_validation_error(e)})
+    return valid, errors
+
+
+async def insert_chunks(collection, docs: List[Tuple[int, dict]], chunk_size: int = CHUNK_SIZE) -> Tuple[List[dict], List[dict]]:
+    """
+    Scrive i documenti con insert_many non ordinato, un blocco alla volta
+
+    Un errore di scrittura scarta solo la riga interessata.
+
+    Returns:
+        tuple: (documenti inseriti, [{"riga", "errore"}])
+    """
+    inserted = []
+    errors = []
+
+    for start in range(0, len(docs), chunk_size):
+        chunk = docs[start:start + chunk_size]
+        failed = {}
+        try:
+            await collection.insert_many([doc.copy() for _, doc in chunk], ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                failed[write_error["index"]] = write_error.get("errmsg", "Errore di scrittura")
+
+        for index, (riga, doc) in enumerate(chunk):
+            if index in failed:
+                errors.append({"riga": riga, "errore": failed[index]})
+            else:
+                inserted.append(doc)
+
+    return inserted, errors
+
+
+__all__ = ['CHUNK_SIZE', 'TooManyRowsError', 'parse_rows', 'validate_rows', 'insert_chunks']
@@ -0,0 +1,144 @@
+# Response Compression
+# Middleware ASGI che comprime le risposte JSON e testuali con brotli o
+# gzip, scelti dall'Accept-Encoding del client, sopra una soglia di
+# dimensione (COMPRESSION_MIN_SIZE): sotto, l'header costa più di quanto
+# si risparmia.
+#
+# Sono compresse solo le risposte con un unico body: gli stream (SSE di
+# /api/eventi, NDJSON, export Parquet/Arrow) passano invariati, così nessun
+# evento resta bloccato in un buffer del compressore.
+#
+# Un ETag forte diventa debole quando il body viene compresso (come fa
+# nginx): i byte non sono più quelli della rappresentazione originale, e
+# If-None-Match usa comunque il confronto debole.
+#
+# brotli è opzionale: senza, i client che lo accettano ricevono gzip.
+
+import gzip
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+DEFAULT_MIN_SIZE = 1024
+
+# Livelli pensati per risposte dinamiche: buona parte del guadagno a una
+# frazione del tempo dei livelli massimi
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+EXCLUDED_TYPES = ("text/event-stream",)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Codifica preferita tra quelle accettate dal client (q > 0)
+
+    Returns:
+        str: "br", "gzip" oppure None se il client non ne accetta nessuna
+    """
+    accepted = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            accepted[name] = q
+
+    available = ("br", "gzip") if BROTLI_AVAILABLE else ("gzip",)
+    for encoding in available:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _compressible(content_type: str) -> bool:
+    content_type = content_type.lower()
+    return (
+        content_type.startswith(COMPRESSIBLE_TYPES)
+        and not content_type.startswith(EXCLUDED_TYPES)
+    )
+
+
+class CompressionMiddleware:
+    """
+    Middleware ASGI: compressione negoziata delle risposte con un solo body
+
+    Args:
+        minimum_size: byte sotto i quali la risposta resta in chiaro
+    """
+
+    def __init__(self, app, minimum_size: int = DEFAULT_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                # Trattenuto finché non si sa se il body va compresso
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+
+            pending, start = start, None
+            headers = MutableHeaders(raw=pending["headers"])
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or not _compressible(headers.get("content-type", ""))
+            ):
+                await send(pending)
+                await send(message)
+                return
+
+            compressed = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = f"W/{etag}"
+            await send(pending)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
+
+
+__all__ = [
+    'BROTLI_AVAILABLE', 'DEFAULT_MIN_SIZE', 'GZIP_LEVEL', 'BROTLI_QUALITY', 'choose_encoding', 'compress',
+    'CompressionMiddleware'
+]
@@ -0,0 +1,206 @@
+# Dates
+# Date e orari tipizzati nei documenti: `data` di entrate e costi variabili
+# è una data (su MongoDB un datetime a mezzanotte UTC, che non ha un tipo
+# solo-data) e `created_at` un datetime UTC, invece di stringhe libere.
+#
+# I documenti scritti prima restano stringhe finché il backfill non li
+# converte: i filtri di questo modulo trovano entrambe le forme, così il
+# server funziona durante la migrazione senza fermi.
+#
+# Backfill (solo MongoDB, a blocchi e con pausa tra un blocco e l'altro):
+#   python dates.py backfill [--batch-size 1000] [--pause 0.1] [--dry-run]
+
+import asyncio
+from datetime import date, datetime, time, timezone
+from typing import Dict, Optional, Union
+
+from pymongo import UpdateOne
+
+# Campi tipizzati per collezione: "data" (giorno) o "datetime"
+CAMPI_TIPIZZATI = {
+    "entrate": {"data": "data", "created_at": "datetime"},
+    "costi_variabili": {"data": "data", "created_at": "datetime"},
+    "users": {"created_at": "datetime"}
+}
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def parse_data(value: Union[str, date, datetime]) -> date:
+    """
+    Giorno da "YYYY-MM-DD", date o datetime
+
+    Raises:
+        ValueError: se non è una data valida
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Data non valida: {value!r} (formato YYYY-MM-DD)")
+
+
+def format_data(value: Union[str, date, datetime]) -> str:
+    """Giorno come "YYYY-MM-DD" (chiavi dei riepiloghi e risposte JSON)"""
+    return parse_data(value).isoformat()
+
+
+def to_datetime(value: Union[str, datetime]) -> datetime:
+    """
+    Datetime UTC da stringa ISO o datetime; i naive (come li restituisce
+    Motor) sono intesi in UTC
+
+    Raises:
+        ValueError: se la stringa non è una data/ora ISO
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"Data/ora non valida: {value!r}")
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def data_to_mongo(value: Union[str, date, datetime]) -> datetime:
+    """Giorno come datetime a mezzanotte UTC (BSON non ha un tipo data)"""
+    return datetime.combine(parse_data(value), time.min, tzinfo=timezone.utc)
+
+
+def data_filter(value: Union[str, date, datetime]) -> dict:
+    """Condizione MongoDB per un giorno, nella forma nuova e in quella stringa"""
+    return {"$in": [data_to_mongo(value), format_data(value)]}
+
+
+def data_range_filter(dal: Optional[date], al: Optional[date]) -> list:
+    """
+    Condizioni MongoDB per un intervallo di giorni (estremi inclusi), da
+    mettere in $or: i confronti di MongoDB non attraversano i tipi BSON
+    """
+    nativo, stringa = {}, {}
+    if dal is not None:
+        nativo["$gte"], stringa["$gte"] = data_to_mongo(dal), format_data(dal)
+    if al is not None:
+        nativo["$lte"], stringa["$lte"] = data_to_mongo(al), format_data(al)
+    return [{"data": nativo}, {"data": stringa}]
+
+
+def datetime_range_filter(campo: str, dopo: Optional[str], fino_a: str) -> list:
+    """Come data_range_filter per un datetime in (dopo, fino_a], estremi ISO"""
+    nativo = {"$lte": to_datetime(fino_a)}
+    stringa = {"$lte": fino_a}
+    if dopo:
+        nativo["$gt"], stringa["$gt"] = to_datetime(dopo), dopo
+    return [{campo: nativo}, {campo: stringa}]
+
+
+def _converti(value, tipo: str):
+    if tipo == "data":
+        return data_to_mongo(value)
+    return to_datetime(value)
+
+
+async def backfill_collection(db, collezione: str, batch_size: int = BACKFILL_BATCH_SIZE,
+                              pause: float = 0.0, dry_run: bool = False) -> Dict[str, int]:
+    """
+    Converte a blocchi i campi ancora salvati come stringa
+
+    Ogni aggiornamento è condizionato al valore letto: un documento
+    modificato nel frattempo viene lasciato al giro successivo. I valori non
+    interpretabili restano com'erano e sono contati in "non_validi".
+
+    Returns:
+        dict: documenti convertiti e non validi
+    """
+    campi = CAMPI_TIPIZZATI[collezione]
+    query = {"$or": [{campo: {"$type": "string"}} for campo in campi]}
+    stats = {"convertiti": 0, "non_validi": 0}
+    last_id = None
+
+    while True:
+        batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+        docs = await db[collezione].find(
+            batch_query,
+            {"_id": 1, **{campo: 1 for campo in campi}}
+        ).sort("_id", 1).limit(batch_size).to_list(batch_size)
+        if not docs:
+            return stats
+        last_id = docs[-1]["_id"]
+
+        operations = []
+        for doc in docs:
+            letti, nuovi = {}, {}
+            try:
+                for campo, tipo in campi.items():
+                    if isinstance(doc.get(campo), str):
+                        letti[campo] = doc[campo]
+                        nuovi[campo] = _converti(doc[campo], tipo)
+            except ValueError:
+                stats["non_validi"] += 1
+                continue
+            operations.append(UpdateOne({"_id": doc["_id"], **letti}, {"$set": nuovi}))
+
+        if operations and not dry_run:
+            result = await db[collezione].bulk_write(operations, ordered=False)
+            stats["convertiti"] += result.modified_count
+        else:
+            stats["convertiti"] += len(operations)
+
+        if pause:
+            await asyncio.sleep(pause)
+
+
+async def backfill(db, batch_size: int = BACKFILL_BATCH_SIZE, pause: float = 0.0,
+                   dry_run: bool = False) -> Dict[str, Dict[str, int]]:
+    """Backfill di tutte le collezioni di CAMPI_TIPIZZATI"""
+    return {
+        collezione: await backfill_collection(db, collezione, batch_size, pause, dry_run)
+        for collezione in CAMPI_TIPIZZATI
+    }
+
+
+async def _main(argv: Optional[list] = None):
+    import argparse
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Migrazione a date e orari tipizzati")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("backfill", help="Converte le date salvate come stringa (solo MongoDB)")
+    run.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE, help="Documenti per blocco")
+    run.add_argument("--pause", type=float, default=0.1, help="Secondi di pausa tra i blocchi")
+    run.add_argument("--dry-run", action="store_true", help="Conta i documenti senza modificarli")
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent / '.env')
+    if os.environ.get('STORAGE_BACKEND', 'mongo') != 'mongo':
+        parser.error("il backfill serve solo con STORAGE_BACKEND=mongo (SQLite salva già date ISO)")
+
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    try:
+        stats = await backfill(db, args.batch_size, args.pause, args.dry_run)
+    finally:
+        client.close()
+
+    verbo = "da convertire" if args.dry_run else "convertiti"
+    for collezione, s in stats.items():
+        print(f"{collezione}: {s['convertiti']} {verbo}, {s['non_validi']} non validi")
+    print("✅ Backfill completato")
+
+
+__all__ = [
+    'CAMPI_TIPIZZATI', 'BACKFILL_BATCH_SIZE', 'parse_data', 'format_data', 'to_datetime', 'data_to_mongo',
+    'data_filter', 'data_range_filter', 'datetime_range_filter', 'backfill_collection', 'backfill'
+]
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
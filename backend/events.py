@@ -0,0 +1,289 @@
+# Live Events
+# Pub/sub per utente dietro /api/eventi (Server-Sent Events): nuove
+# notifiche, totali del giorno aggiornati e modifiche ai materiali arrivano
+# al client senza polling.
+#
+# Backend (EVENT_BACKEND):
+#   memory  - solo nel processo, per sviluppo e test
+#   mongo   - ogni evento è scritto in `eventi` e ogni worker lo riceve
+#             tramite change stream (richiede un replica set)
+#
+# Con il backend mongo ogni processo registra in `eventi_presenze` gli
+# utenti che hanno client connessi a lui e rilegge periodicamente quelli
+# connessi altrove: wants() risponde dalla copia locale, così chi scrive
+# salta il calcolo degli eventi per gli utenti che nessuno sta ascoltando.
+# Un client connesso a un altro processo è visto entro un intervallo di
+# aggiornamento (PRESENZE_INTERVAL_SECONDS).
+
+import asyncio
+import json
+import logging
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+TIPI_EVENTO = ("notifica", "dashboard", "materiali")
+
+# Eventi in attesa per ogni connessione: un client lento perde i più vecchi
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Gli eventi in `eventi` servono solo alla consegna: scadono dopo questo tempo
+EVENTI_TTL_SECONDS = 3600
+
+# Ogni quanto un processo rinnova le proprie presenze e rilegge le altrui;
+# una presenza non rinnovata (processo terminato) scade dopo tre intervalli
+PRESENZE_INTERVAL_SECONDS = 10
+
+
+class Subscription:
+    """Connessione di un client: coda degli eventi destinati al suo utente"""
+
+    def __init__(self, broker: "InMemoryBroker", user_id: str, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.broker = broker
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def deliver(self, event: dict):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Prossimo evento, oppure None allo scadere di `timeout`"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InMemoryBroker:
+    """Consegna gli eventi ai client connessi a questo processo"""
+
+    def __init__(self):
+        self._subscriptions: Dict[str, Set[Subscription]] = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, user_id: str) -> Subscription:
+        subscription = Subscription(self, user_id)
+        self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is None:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscriptions[subscription.user_id]
+
+    def wants(self, user_id: str) -> bool:
+        """False se nessun client può ricevere eventi per l'utente (evita calcoli inutili)"""
+        return user_id in self._subscriptions
+
+    def subscriber_count(self) -> int:
+        return sum(len(s) for s in self._subscriptions.values())
+
+    def _fan_out(self, event: dict):
+        for subscription in list(self._subscriptions.get(event["user_id"], ())):
+            subscription.deliver(event)
+
+    async def publish_many(self, events: List[Tuple[str, str, dict]]):
+        """
+        Args:
+            events: [(user_id, tipo, dati)]
+        """
+        for user_id, tipo, dati in events:
+            self._fan_out(build_event(user_id, tipo, dati))
+
+    async def publish(self, user_id: str, tipo: str, dati: dict):
+        await self.publish_many([(user_id, tipo, dati)])
+
+
+class MongoChangeStreamBroker(InMemoryBroker):
+    """
+    Eventi condivisi tra processi tramite la collezione `eventi`
+
+    publish scrive il documento; ogni processo osserva gli inserimenti con
+    un change stream e li consegna ai propri client. Dopo un errore il
+    change stream riparte dall'ultimo resume token.
+
+    Args:
+        watch: False per i processi che pubblicano soltanto (sweeper)
+    """
+
+    def __init__(self, db, retry_seconds: float = 2.0, watch: bool = True,
+                 presence_interval: float = PRESENZE_INTERVAL_SECONDS):
+        super().__init__()
+        self.db = db
+        self.retry_seconds = retry_seconds
+        self.watch = watch
+        self.presence_interval = presence_interval
+        self.process_id = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+        self._presence_task: Optional[asyncio.Task] = None
+        self._resume_token = None
+        # Utenti con client connessi a un qualsiasi processo; None se la
+        # lettura è fallita e non si può escludere nessuno
+        self._present: Optional[Set[str]] = None
+
+    async def start(self):
+        if self._task is None and self.watch:
+            self._task = asyncio.create_task(self._watch())
+        if self._presence_task is None:
+            await self.refresh_presence()
+            self._presence_task = asyncio.create_task(self._presence_loop())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, self._presence_task) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._presence_task = None
+        try:
+            await self.db.eventi_presenze.delete_many({"processo": self.process_id})
+        except PyMongoError as e:
+            logger.error(f"Pulizia presenze eventi fallita: {e}")
+
+    def wants(self, user_id: str) -> bool:
+        # I client dell'utente possono essere connessi a un altro processo
+        return user_id in self._subscriptions or self._present is None or user_id in self._present
+
+    async def refresh_presence(self):
+        """Rinnova le presenze di questo processo e rilegge gli utenti connessi ovunque"""
+        try:
+            now = datetime.now(timezone.utc)
+            scade_il = now + timedelta(seconds=3 * self.presence_interval)
+            user_ids = list(self._subscriptions)
+            if user_ids:
+                await self.db.eventi_presenze.bulk_write([
+                    UpdateOne(
+                        {"processo": self.process_id, "user_id": user_id},
+                        {"$set": {"scade_il": scade_il}},
+                        upsert=True
+                    )
+                    for user_id in user_ids
+                ], ordered=False)
+            await self.db.eventi_presenze.delete_many({"processo": self.process_id, "user_id": {"$nin": user_ids}})
+            self._present = set(await self.db.eventi_presenze.distinct("user_id", {"scade_il": {"$gt": now}}))
+        except PyMongoError as e:
+            logger.error(f"Aggiornamento presenze eventi fallito: {e}")
+            self._present = None
+
+    async def _presence_loop(self):
+        while True:
+            await asyncio.sleep(self.presence_interval)
+            await self.refresh_presence()
+
+    async def publish_many(self, events: List[Tuple[str, str, dict]]):
+        if not events:
+            return
+        await self.db.eventi.insert_many(
+            [build_event(user_id, tipo, dati) for user_id, tipo, dati in events],
+            ordered=False
+        )
+
+    async def _watch(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        while True:
+            try:
+                async with self.db.eventi.watch(pipeline, resume_after=self._resume_token) as stream:
+                    async for change in stream:
+                        self._resume_token = stream.resume_token
+                        event = change["fullDocument"]
+                        event.pop("_id", None)
+                        self._fan_out(event)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.error(f"Change stream eventi interrotto: {e}")
+                await asyncio.sleep(self.retry_seconds)
+
+
+def build_event(user_id: str, tipo: str, dati: dict) -> dict:
+    return {
+        "evento_id": f"evt_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "tipo": tipo,
+        "dati": dati,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+
+def format_sse(event: dict) -> str:
+    """Evento nel formato text/event-stream"""
+    data = json.dumps(event["dati"], default=_json_default, separators=(",", ":"))
+    return f"id: {event['evento_id']}\nevent: {event['tipo']}\ndata: {data}\n\n"
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+def create_broker(db, backend: str = "memory", watch: bool = True):
+    """
+    Args:
+        db: database Motor (Storage.db), necessario solo per il backend mongo
+        watch: False per i processi che pubblicano soltanto
+    """
+    if backend == "mongo":
+        if db is None:
+            raise ValueError("EVENT_BACKEND=mongo richiede STORAGE_BACKEND=mongo")
+        return MongoChangeStreamBroker(db, watch=watch)
+    if backend == "memory":
+        return InMemoryBroker()
+    raise ValueError(f"EVENT_BACKEND non valido: {backend}")
+
+
+_broker: Optional[InMemoryBroker] = None
+
+
+def get_broker() -> Optional[InMemoryBroker]:
+    return _broker
+
+
+def set_broker(broker: Optional[InMemoryBroker]):
+    """Registra il broker del processo (server, sweeper, test)"""
+    global _broker
+    _broker = broker
+
+
+def wants(user_id: str) -> bool:
+    return _broker is not None and _broker.wants(user_id)
+
+
+async def publish_many(events: List[Tuple[str, str, dict]]):
+    """Pubblica sul broker registrato; senza broker non fa nulla"""
+    if _broker is None or not events:
+        return
+    try:
+        await _broker.publish_many(events)
+    except Exception as e:
+        # Gli eventi live sono accessori: non devono far fallire la scrittura
+        logger.error(f"Pubblicazione eventi fallita: {e}")
+
+
+async def publish(user_id: str, tipo: str, dati: dict):
+    await publish_many([(user_id, tipo, dati)])
+
+
+__all__ = [
+    'TIPI_EVENTO', 'EVENTI_TTL_SECONDS', 'PRESENZE_INTERVAL_SECONDS', 'Subscription', 'InMemoryBroker', 'MongoChangeStreamBroker',
+    'build_event', 'format_sse', 'create_broker', 'get_broker', 'set_broker', 'wants', 'publish', 'publish_many'
+]
@@ -0,0 +1,280 @@
+# Export
+# Esportazione colonnare di entrate, costi variabili, costi fissi e materiali
+# di un utente in Parquet o Arrow IPC (stream), per i commercialisti.
+#
+# I documenti arrivano dallo storage a blocchi (iter_export) e diventano
+# record batch da EXPORT_BATCH_SIZE righe: in memoria c'è al massimo un
+# batch, anche per uno storico di anni.
+#
+# Export incrementale: il watermark è il created_at massimo incluso, fissato
+# all'inizio dell'export; il giro successivo riparte con dal=watermark.
+# Il watermark resta EXPORT_WATERMARK_LAG secondi indietro rispetto
+# all'orologio: created_at è assegnato prima della scrittura, e una riga
+# salvata in ritardo con un created_at già sotto il watermark verrebbe
+# saltata da tutti gli export successivi.
+# Per costi fissi e materiali l'incrementale porta solo le righe nuove: una
+# modifica non cambia created_at (per lo stato attuale serve un export pieno).
+#
+# Uso:
+#   python export.py --user-id user_abc --out export/
+#   python export.py --user-id user_abc --out export/ --incrementale
+#   python export.py --user-id user_abc --out export/ --formato arrow --dal 2026-01-01T00:00:00+00:00
+#
+# pyarrow è opzionale: senza, l'endpoint risponde 501 e la CLI esce con errore.
+
+import argparse
+import asyncio
+import json
+import os
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+# Righe per record batch (e per row group Parquet)
+EXPORT_BATCH_SIZE = 10000
+
+# Secondi di ritardo del watermark: più del tempo massimo tra created_at e commit
+EXPORT_WATERMARK_LAG = float(os.environ.get('EXPORT_WATERMARK_LAG', '300'))
+
+FORMATI = {
+    "parquet": {"media_type": "application/vnd.apache.parquet", "estensione": "parquet"},
+    "arrow": {"media_type": "application/vnd.apache.arrow.stream", "estensione": "arrows"}
+}
+
+# Colonne esportate per collezione: (nome, tipo)
+COLONNE = {
+    "entrate": [
+        ("entrata_id", "string"), ("user_id", "string"), ("descrizione", "string"),
+        ("importo", "float64"), ("data", "date"), ("created_at", "timestamp")
+    ],
+    "costi_variabili": [
+        ("costo_id", "string"), ("user_id", "string"), ("descrizione", "string"),
+        ("importo", "float64"), ("data", "date"), ("created_at", "timestamp")
+    ],
+    "costi_fissi": [
+        ("costo_id", "string"), ("user_id", "string"), ("descrizione", "string"),
+        ("importo_mensile", "float64"), ("quota_giornaliera", "float64"), ("created_at", "timestamp")
+    ],
+    "materiali": [
+        ("materiale_id", "string"), ("user_id", "string"), ("nome", "string"),
+        ("quantita_disponibile", "float64"), ("unita_misura", "string"),
+        ("consumo_medio_giornaliero", "float64"), ("giorni_consegna", "int64"),
+        ("costo_unitario", "float64"), ("fornitore", "string"), ("fornitore_email", "string"),
+        ("fornitore_telefono", "string"), ("fornitore_sito", "string"), ("created_at", "timestamp")
+    ]
+}
+
+
+def parse_watermark(value: str) -> str:
+    """
+    Normalizza un watermark nel formato di created_at (ISO 8601 in UTC)
+
+    Raises:
+        ValueError: se non è una data/ora ISO
+    """
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError("Watermark non valido (data/ora ISO 8601)")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+def new_watermark(lag: float = EXPORT_WATERMARK_LAG) -> str:
+    """Limite superiore dell'export, fissato prima di leggere e `lag` secondi nel passato"""
+    return (datetime.now(timezone.utc) - timedelta(seconds=lag)).isoformat()
+
+
+def schema_for(collezione: str):
+    tipi = {
+        "string": pa.string(),
+        "float64": pa.float64(),
+        "int64": pa.int64(),
+        "date": pa.date32(),
+        "timestamp": pa.timestamp("us", tz="UTC")
+    }
+    return pa.schema([(nome, tipi[tipo]) for nome, tipo in COLONNE[collezione]])
+
+
+def _converti(value, tipo: str):
+    if value is None:
+        return None
+    if tipo == "timestamp":
+        value = datetime.fromisoformat(value) if isinstance(value, str) else value
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if tipo == "date":
+        if isinstance(value, datetime):
+            return value.date()
+        return date.fromisoformat(value) if isinstance(value, str) else value
+    if tipo == "float64":
+        return float(value)
+    if tipo == "int64":
+        return int(value)
+    return str(value)
+
+
+async def iter_record_batches(store, collezione: str, user_id: str, dal: Optional[str], fino_a: str,
+                              batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator["pa.RecordBatch"]:
+    """Record batch di al massimo `batch_size` righe, nell'ordine dello storage"""
+    schema = schema_for(collezione)
+    colonne = COLONNE[collezione]
+    righe = []
+    async for doc in store.iter_export(collezione, user_id, dal, fino_a):
+        righe.append({nome: _converti(doc.get(nome), tipo) for nome, tipo in colonne})
+        if len(righe) >= batch_size:
+            yield pa.RecordBatch.from_pylist(righe, schema=schema)
+            righe = []
+    if righe:
+        yield pa.RecordBatch.from_pylist(righe, schema=schema)
+
+
+def _open_writer(sink, formato: str, schema):
+    if formato == "parquet":
+        return pq.ParquetWriter(sink, schema)
+    return pa.ipc.new_stream(sink, schema)
+
+
+class _ChunkSink:
+    """File in sola scrittura che accumula i byte fino al prossimo drain()"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+async def stream_export(store, collezione: str, user_id: str, formato: str, dal: Optional[str],
+                        fino_a: str) -> AsyncIterator[bytes]:
+    """File Parquet o Arrow IPC a pezzi, un row group alla volta (StreamingResponse)"""
+    sink = _ChunkSink()
+    writer = _open_writer(sink, formato, schema_for(collezione))
+    async for batch in iter_record_batches(store, collezione, user_id, dal, fino_a):
+        writer.write_batch(batch)
+        yield sink.drain()
+    # Footer Parquet / fine dello stream Arrow
+    writer.close()
+    yield sink.drain()
+
+
+async def write_export(store, collezione: str, user_id: str, path: Path, formato: str,
+                       dal: Optional[str], fino_a: str) -> int:
+    """
+    Scrive l'export di una collezione su file
+
+    Returns:
+        int: righe esportate
+    """
+    righe = 0
+    writer = _open_writer(str(path), formato, schema_for(collezione))
+    try:
+        async for batch in iter_record_batches(store, collezione, user_id, dal, fino_a):
+            writer.write_batch(batch)
+            righe += batch.num_rows
+    finally:
+        writer.close()
+    return righe
+
+
+async def export_user(store, user_id: str, out_dir: Path, formato: str = "parquet",
+                      dal: Optional[str] = None) -> dict:
+    """
+    Esporta tutte le collezioni di un utente e scrive watermark.json
+
+    Returns:
+        dict: il contenuto di watermark.json
+    """
+    fino_a = new_watermark()
+    suffisso = datetime.fromisoformat(fino_a).strftime("%Y%m%dT%H%M%S%fZ")
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    files = {}
+    for collezione in COLONNE:
+        path = out_dir / f"{collezione}_{suffisso}.{FORMATI[formato]['estensione']}"
+        righe = await write_export(store, collezione, user_id, path, formato, dal, fino_a)
+        files[collezione] = {"file": path.name, "righe": righe}
+
+    stato = {"user_id": user_id, "formato": formato, "dal": dal, "watermark": fino_a, "file": files}
+    (out_dir / "watermark.json").write_text(json.dumps(stato, indent=2) + "\n")
+    return stato
+
+
+async def _main(argv: Optional[list] = None):
+    from dotenv import load_dotenv
+
+    import storage
+
+    parser = argparse.ArgumentParser(description="Export Parquet/Arrow dei movimenti di un utente")
+    parser.add_argument("--user-id", required=True, help="Utente da esportare")
+    parser.add_argument("--out", type=Path, required=True, help="Cartella di destinazione")
+    parser.add_argument("--formato", choices=tuple(FORMATI), default="parquet")
+    parser.add_argument("--dal", help="Solo documenti creati dopo questo watermark (ISO 8601)")
+    parser.add_argument("--incrementale", action="store_true", help="Riparte dal watermark.json nella cartella")
+    args = parser.parse_args(argv)
+
+    if not PYARROW_AVAILABLE:
+        parser.error("pyarrow non installato: pip install pyarrow")
+
+    dal = None
+    try:
+        if args.dal:
+            dal = parse_watermark(args.dal)
+        elif args.incrementale and (args.out / "watermark.json").exists():
+            precedente = json.loads((args.out / "watermark.json").read_text())
+            if precedente.get("user_id") != args.user_id:
+                parser.error(f"watermark.json in {args.out} appartiene a un altro utente")
+            dal = parse_watermark(precedente["watermark"])
+    except ValueError as e:
+        parser.error(str(e))
+
+    load_dotenv(Path(__file__).parent / '.env')
+    store = storage.create_storage(
+        os.environ.get('STORAGE_BACKEND', 'mongo'),
+        mongo_url=os.environ.get('MONGO_URL'),
+        db_name=os.environ.get('DB_NAME'),
+        sqlite_path=os.environ.get('SQLITE_PATH', str(Path(__file__).parent / 'balance.db'))
+    )
+    try:
+        stato = await export_user(store, args.user_id, args.out, args.formato, dal)
+    finally:
+        await store.close()
+
+    for collezione, info in stato["file"].items():
+        print(f"{collezione}: {info['righe']} righe in {info['file']}")
+    print(f"✅ Watermark {stato['watermark']}")
+
+
+__all__ = [
+    'PYARROW_AVAILABLE', 'EXPORT_BATCH_SIZE', 'EXPORT_WATERMARK_LAG', 'FORMATI', 'COLONNE', 'parse_watermark', 'new_watermark',
+    'schema_for', 'iter_record_batches', 'stream_export', 'write_export', 'export_user'
+]
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
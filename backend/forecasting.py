@@ -0,0 +1,160 @@
+# Inventory Forecasting
+# Previsione scorte per tutti i materiali di un utente in un unico calcolo
+# vettoriale NumPy: giorni rimasti, data di esaurimento, punto di riordino e
+# quantità da ordinare. Usato da /api/materiali e dalle notifiche magazzino.
+#
+# Il consumo giornaliero viene dallo storico (media e varianza esponenziali
+# consumo_ewma / consumo_ewma_var) quando disponibile, altrimenti dal campo
+# consumo_medio_giornaliero inserito a mano.
+#
+# La media è aggiornata solo al primo movimento di ogni giorno (movimenti.py):
+# i giorni chiusi dopo consumo_ewma_fino_al, senza movimenti, hanno consumo
+# zero e vengono applicati qui in forma chiusa, così un materiale fermo da
+# settimane non continua a risultare in esaurimento.
+
+import os
+from datetime import date, timedelta
+from typing import List, Optional
+
+import numpy as np
+
+from movimenti import EWMA_ALPHA, MAX_GIORNI_FOLD
+
+# z della scorta di sicurezza (1.65 ≈ 95% di livello di servizio)
+SERVICE_LEVEL_Z = float(os.environ.get('FORECAST_SERVICE_LEVEL_Z', '1.65'))
+
+# Giorni coperti da un ordine oltre al tempo di consegna
+REVIEW_DAYS = float(os.environ.get('FORECAST_REVIEW_DAYS', '7'))
+
+# Oltre questo orizzonte la data di esaurimento non è significativa
+MAX_GIORNI = 36500
+
+STATI = np.array(["ok", "attenzione", "ordina_ora"], dtype=object)
+
+
+def _column(materiali: List[dict], field: str) -> np.ndarray:
+    return np.fromiter(
+        ((m.get(field) or 0) for m in materiali),
+        dtype=np.float64,
+        count=len(materiali)
+    )
+
+
+def _giorni_non_contati(materiali: List[dict], oggi: date) -> np.ndarray:
+    """Giorni chiusi (fino a ieri) successivi a consumo_ewma_fino_al"""
+    ieri = (oggi - timedelta(days=1)).toordinal()
+    return np.fromiter(
+        (
+            min(max(ieri - date.fromisoformat(m["consumo_ewma_fino_al"]).toordinal(), 0), MAX_GIORNI_FOLD)
+            if m.get("consumo_ewma_fino_al") else 0
+            for m in materiali
+        ),
+        dtype=np.float64,
+        count=len(materiali)
+    )
+
+
+def decay(media: np.ndarray, varianza: np.ndarray, giorni: np.ndarray, alpha: float = EWMA_ALPHA):
+    """
+    Media e varianza dopo `giorni` giorni a consumo zero
+
+    Equivale a `giorni` chiamate di movimenti.ewma_update con consumo 0:
+    media * b^k e b^k * (varianza + media^2 * (1 - b^k)), con b = 1 - alpha.
+    """
+    fattore = (1 - alpha) ** giorni
+    return media * fattore, fattore * (varianza + media ** 2 * (1 - fattore))
+
+
+def _demand(materiali: List[dict], oggi: date):
+    """Media e deviazione standard del consumo giornaliero per materiale"""
+    n = len(materiali)
+    ewma = np.fromiter(
+        (np.nan if m.get("consumo_ewma") is None else m["consumo_ewma"] for m in materiali),
+        dtype=np.float64,
+        count=n
+    )
+    ewma_var = _column(materiali, "consumo_ewma_var")
+    statico = _column(materiali, "consumo_medio_giornaliero")
+    ewma, ewma_var = decay(ewma, ewma_var, _giorni_non_contati(materiali, oggi))
+
+    da_storico = ~np.isnan(ewma)
+    media = np.where(da_storico, ewma, statico)
+    deviazione = np.where(da_storico, np.sqrt(np.maximum(ewma_var, 0)), 0.0)
+    return media, deviazione
+
+
+def forecast(
+    materiali: List[dict],
+    oggi: Optional[date] = None,
+    service_level_z: float = SERVICE_LEVEL_Z,
+    review_days: float = REVIEW_DAYS
+) -> dict:
+    """
+    Previsione vettoriale per una lista di materiali
+
+    Returns:
+        dict di array NumPy allineati a `materiali`: giorni_rimasti (nan se
+        il consumo è nullo), data_esaurimento, punto_riordino,
+        quantita_da_ordinare, stato
+    """
+    oggi = oggi or date.today()
+
+    quantita = _column(materiali, "quantita_disponibile")
+    consegna = _column(materiali, "giorni_consegna")
+    media, deviazione = _demand(materiali, oggi)
+
+    consuma = media > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        giorni_rimasti = np.where(consuma, quantita / media, np.nan)
+
+    # Scorta di sicurezza sulla variabilità del consumo durante la consegna
+    scorta_sicurezza = service_level_z * deviazione * np.sqrt(consegna)
+    punto_riordino = media * consegna + scorta_sicurezza
+    livello_obiettivo = media * (consegna + review_days) + scorta_sicurezza
+
+    ordina_ora = consuma & (quantita <= punto_riordino)
+    attenzione = consuma & ~ordina_ora & (quantita <= punto_riordino + media * consegna)
+    stato = STATI[ordina_ora * 2 + attenzione * 1]
+
+    quantita_da_ordinare = np.where(ordina_ora, np.maximum(livello_obiettivo - quantita, 0), 0.0)
+
+    giorni_interi = np.floor(np.clip(np.nan_to_num(giorni_rimasti, nan=0.0), 0, MAX_GIORNI))
+    data_esaurimento = np.datetime64(oggi, "D") + giorni_interi.astype("timedelta64[D]")
+
+    return {
+        "giorni_rimasti": giorni_rimasti,
+        "data_esaurimento": data_esaurimento,
+        "punto_riordino": punto_riordino,
+        "quantita_da_ordinare": quantita_da_ordinare,
+        "consuma": consuma,
+        "stato": stato
+    }
+
+
+def annotate_materiali(materiali: List[dict], oggi: Optional[date] = None) -> List[dict]:
+    """Aggiunge ai documenti i campi della previsione (in place)"""
+    if not materiali:
+        return materiali
+
+    result = forecast(materiali, oggi)
+    columns = zip(
+        materiali,
+        result["consuma"].tolist(),
+        np.round(result["giorni_rimasti"], 1).tolist(),
+        np.datetime_as_string(result["data_esaurimento"], unit="D").tolist(),
+        np.round(result["punto_riordino"], 2).tolist(),
+        np.round(result["quantita_da_ordinare"], 2).tolist(),
+        result["stato"].tolist()
+    )
+
+    for m, consuma, giorni, esaurimento, riordino, da_ordinare, stato in columns:
+        m["stato"] = stato
+        m["giorni_rimasti"] = giorni if consuma else None
+        m["data_esaurimento"] = esaurimento if consuma else None
+        m["punto_riordino"] = riordino
+        m["quantita_da_ordinare"] = da_ordinare
+
+    return materiali
+
+
+__all__ = ['decay', 'forecast', 'annotate_materiali', 'SERVICE_LEVEL_Z', 'REVIEW_DAYS']
@@ -0,0 +1,223 @@
+# Index Provisioning
+# Dichiara gli indici delle collection usate ad ogni richiesta. All'avvio
+# ogni worker crea quelli mancanti e aggiorna le durate TTL; gli indici con
+# opzioni diverse dal piano vengono solo segnalati, perché ricrearli vuol
+# dire eliminarli prima (la chiave è la stessa) e farlo da tutti i worker
+# insieme lascerebbe le collection senza indice. La ricreazione è un
+# comando esplicito:
+#   python indexes.py --dry-run     # piano senza applicarlo
+#   python indexes.py --recreate    # ricrea anche gli indici in drift
+
+import asyncio
+import logging
+from typing import List, Optional
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from events import EVENTI_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+# (collection, chiavi, opzioni)
+INDEX_PLAN = [
+    ("user_sessions", [("session_token", ASCENDING)], {"name": "session_token_unique", "unique": True}),
+    # TTL: MongoDB elimina le sessioni appena scadute
+    ("user_sessions", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+    # Utenti attivi per insights_batch.py
+    ("user_sessions", [("created_at", ASCENDING), ("user_id", ASCENDING)], {"name": "created_at_user_id"}),
+    ("users", [("email", ASCENDING)], {"name": "email_unique", "unique": True}),
+    ("users", [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    # Utenti attivi per insights_batch.py (le sessioni scadono dopo 7 giorni)
+    ("users", [("last_seen_at", ASCENDING)], {"name": "last_seen_at"}),
+    ("user_profiles", [("user_id", ASCENDING)], {"name": "user_id"}),
+    ("notification_preferences", [("user_id", ASCENDING)], {"name": "user_id"}),
+    ("entrate", [("user_id", ASCENDING), ("data", ASCENDING)], {"name": "user_id_data"}),
+    ("costi_variabili", [("user_id", ASCENDING), ("data", ASCENDING)], {"name": "user_id_data"}),
+    # Keyset pagination su (created_at, id)
+    ("entrate", [("user_id", ASCENDING), ("created_at", ASCENDING), ("entrata_id", ASCENDING)], {"name": "user_id_created_at_id"}),
+    ("costi_variabili", [("user_id", ASCENDING), ("created_at", ASCENDING), ("costo_id", ASCENDING)], {"name": "user_id_created_at_id"}),
+    ("costi_fissi", [("user_id", ASCENDING)], {"name": "user_id"}),
+    ("materiali", [("user_id", ASCENDING)], {"name": "user_id"}),
+    ("movimenti_materiali", [("user_id", ASCENDING), ("materiale_id", ASCENDING), ("created_at", DESCENDING)], {"name": "user_id_materiale_id_created_at"}),
+    ("consumi_giornalieri", [("materiale_id", ASCENDING), ("data", ASCENDING)], {"name": "materiale_id_data_unique", "unique": True}),
+    ("notifiche", [("user_id", ASCENDING), ("created_at", DESCENDING)], {"name": "user_id_created_at"}),
+    ("notifiche", [("user_id", ASCENDING), ("letta", ASCENDING), ("created_at", DESCENDING)], {"name": "user_id_letta_created_at"}),
+    ("contatori_notifiche", [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    # Versioni per gli ETag dei GET (storage.RISORSE_VERSIONATE)
+    ("versioni", [("user_id", ASCENDING)], {"name": "user_id_unique", "unique": True}),
+    ("eventi", [("created_at", ASCENDING)], {"name": "created_at_ttl", "expireAfterSeconds": EVENTI_TTL_SECONDS}),
+    # Presenze per events.MongoChangeStreamBroker.wants
+    ("eventi_presenze", [("processo", ASCENDING), ("user_id", ASCENDING)], {"name": "processo_user_id_unique", "unique": True}),
+    ("eventi_presenze", [("scade_il", ASCENDING)], {"name": "scade_il_ttl", "expireAfterSeconds": 0}),
+    # Un solo insight per tipo e giorno: protegge da generazioni concorrenti
+    ("insights_ai", [("user_id", ASCENDING), ("data", ASCENDING), ("tipo", ASCENDING)], {"name": "user_id_data_tipo_unique", "unique": True}),
+    ("insights_batch_progress", [("run_id", ASCENDING), ("user_id", ASCENDING)], {"name": "run_id_user_id_unique", "unique": True}),
+    ("riepiloghi_giornalieri", [("user_id", ASCENDING), ("data", ASCENDING)], {"name": "user_id_data_unique", "unique": True}),
+]
+
+# Opzioni confrontate per rilevare differenze tra piano e database
+_COMPARED_OPTIONS = ("unique", "expireAfterSeconds")
+
+
+def _options_differ(planned: dict, existing: dict) -> List[str]:
+    differences = []
+    for option in _COMPARED_OPTIONS:
+        wanted = planned.get(option, False if option == "unique" else None)
+        actual = existing.get(option, False if option == "unique" else None)
+        if wanted != actual:
+            differences.append(f"{option}: {actual} -> {wanted}")
+    return differences
+
+
+async def plan_indexes(db) -> List[dict]:
+    """
+    Confronta INDEX_PLAN con gli indici esistenti
+
+    Returns:
+        list: azioni con action = ok | create | recreate | ttl | extra
+    """
+    actions = []
+    collections = sorted({collection for collection, _, _ in INDEX_PLAN})
+
+    for collection in collections:
+        existing = await db[collection].index_information()
+        planned_keys = []
+
+        for coll, keys, options in INDEX_PLAN:
+            if coll != collection:
+                continue
+            name = options["name"]
+            planned_keys.append(keys)
+            match = next(
+                ((index_name, info) for index_name, info in existing.items()
+                 if [tuple(k) for k in info["key"]] == keys),
+                None
+            )
+
+            action = {"collection": collection, "name": name, "keys": keys, "options": options}
+            if match is None:
+                action["action"] = "create"
+            else:
+                action["existing_name"] = match[0]
+                action["existing_info"] = match[1]
+                differences = _options_differ(options, match[1])
+                if not differences:
+                    action["action"] = "ok"
+                elif len(differences) == 1 and "expireAfterSeconds" in options \
+                        and "expireAfterSeconds" in match[1]:
+                    # Solo la durata TTL è cambiata: si modifica senza ricreare
+                    action["action"] = "ttl"
+                else:
+                    action["action"] = "recreate"
+                action["differences"] = differences
+            actions.append(action)
+
+        for index_name, info in existing.items():
+            keys = [tuple(k) for k in info["key"]]
+            if index_name != "_id_" and keys not in planned_keys:
+                actions.append({
+                    "collection": collection,
+                    "name": index_name,
+                    "keys": keys,
+                    "action": "extra"
+                })
+
+    return actions
+
+
+def _existing_options(info: dict) -> dict:
+    # Opzioni di index_information() riutilizzabili in create_index
+    return {k: v for k, v in info.items() if k not in ("key", "v", "ns")}
+
+
+async def _recreate(collection, action: dict):
+    """Elimina e ricrea un indice in drift; se la creazione fallisce ripristina il precedente"""
+    await collection.drop_index(action["existing_name"])
+    try:
+        await collection.create_index(action["keys"], **action["options"])
+    except OperationFailure:
+        await collection.create_index(
+            action["keys"], name=action["existing_name"], **_existing_options(action["existing_info"])
+        )
+        raise
+
+
+async def ensure_indexes(db, dry_run: bool = False, recreate: bool = False) -> List[dict]:
+    """
+    Crea gli indici mancanti e aggiorna le durate TTL
+
+    Gli indici con opzioni diverse dal piano vengono ricreati solo con
+    recreate (comando esplicito, mai all'avvio); altrimenti sono segnalati
+    come quelli non dichiarati, che non vengono mai eliminati.
+    In dry_run il piano viene stampato senza modificare il database.
+    """
+    actions = await plan_indexes(db)
+
+    for action in actions:
+        collection = db[action["collection"]]
+        label = f"{action['collection']}.{action['name']} {action['keys']}"
+
+        if dry_run:
+            print(f"[{action['action']}] {label} {action.get('differences', '')}".rstrip())
+            continue
+
+        try:
+            if action["action"] == "create":
+                await collection.create_index(action["keys"], **action["options"])
+                logger.info(f"Indice creato: {label}")
+            elif action["action"] == "ttl":
+                logger.warning(f"Drift indice {label}: {action['differences']}")
+                await db.command({
+                    "collMod": action["collection"],
+                    "index": {
+                        "keyPattern": dict(action["keys"]),
+                        "expireAfterSeconds": action["options"]["expireAfterSeconds"]
+                    }
+                })
+            elif action["action"] == "recreate" and recreate:
+                logger.warning(f"Drift indice {label}: {action['differences']}, ricreazione")
+                await _recreate(collection, action)
+                logger.info(f"Indice ricreato: {label}")
+            elif action["action"] == "recreate":
+                logger.warning(
+                    f"Drift indice {label}: {action['differences']} "
+                    f"(per ricrearlo: python indexes.py --recreate)"
+                )
+            elif action["action"] == "extra":
+                logger.info(f"Indice non dichiarato in INDEX_PLAN: {label}")
+        except OperationFailure as e:
+            # Es. indice unique su dati con duplicati: il server parte comunque
+            logger.error(f"Impossibile applicare indice {label}: {e}")
+
+    return actions
+
+
+async def _main(argv: Optional[list] = None):
+    import argparse
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Provisioning indici MongoDB")
+    parser.add_argument("--dry-run", action="store_true", help="Stampa il piano senza applicarlo")
+    parser.add_argument("--recreate", action="store_true", help="Ricrea gli indici con opzioni diverse dal piano")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+
+    try:
+        await ensure_indexes(client[os.environ['DB_NAME']], dry_run=args.dry_run, recreate=args.recreate)
+    finally:
+        client.close()
+
+
+__all__ = ['INDEX_PLAN', 'plan_indexes', 'ensure_indexes']
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
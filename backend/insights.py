@@ -0,0 +1,191 @@
+# Insight AI
+# Prompt, fallback a regole e generazione degli insight giornalieri.
+# Le chiamate al modello partono in parallelo, ognuna con una scadenza
+# propria e tutte entro un budget complessivo: ciò che non risponde in
+# tempo viene sostituito dal testo a regole, senza bloccare la richiesta.
+# Il testo a regole è salvato con fallback=True e una scadenza
+# (expires_at): passata quella, la visita successiva riprova il modello.
+
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+FREE_SYSTEM_MESSAGE = "Sei un consulente aziendale che fornisce suggerimenti prudenti e pratici."
+
+PRO_SYSTEM_MESSAGE = "Sei un consulente aziendale esperto."
+
+PRO_PROMPTS = [
+    ("positivo", "Identifica UN punto positivo o un successo nei dati di oggi (max 2 frasi)."),
+    ("rischio", "Identifica UN potenziale rischio o area di attenzione (max 2 frasi)."),
+    ("azione", "Suggerisci UN'azione concreta che l'utente potrebbe fare domani (max 2 frasi).")
+]
+
+
+def build_prompts(user_id: str, subscription_tier: str, data: str, context: str) -> List[Tuple[str, str, str, str]]:
+    """
+    Prompt da inviare al modello
+
+    Returns:
+        list: [(tipo, session_id, system_message, prompt)]
+    """
+    if subscription_tier == "free":
+        # FREE: 1 insight generico
+        prompt = f"""Sei un consulente aziendale per PMI italiane. Basandoti sui dati forniti, genera UN SOLO insight breve (max 2 frasi) per l'utente.
+
+{context}
+
+L'insight deve essere:
+- Pratico e operativo
+- In italiano semplice
+- Prudente (usa "potrebbe", "sembra", "considera")
+- Senza certezze assolute
+
+Non parlare di tasse, IVA o contabilità fiscale.
+"""
+        return [("generale", f"insight_{user_id}_{data}", FREE_SYSTEM_MESSAGE, prompt)]
+
+    # PRO: 3 insights fissi
+    return [
+        (
+            tipo,
+            f"insight_{tipo}_{user_id}_{data}",
+            PRO_SYSTEM_MESSAGE,
+            f"""{instruction}
+
+{context}
+
+Risposta in italiano, tono pratico e prudente. Non parlare di tasse o contabilità fiscale.
+"""
+        )
+        for tipo, instruction in PRO_PROMPTS
+    ]
+
+
+def fallback_text(tipo: str, dashboard: dict, materiali_critici: int = 0) -> str:
+    """Insight a regole usato quando il modello non risponde"""
+    utile = dashboard['utile']
+
+    if tipo == "positivo":
+        if utile > 0:
+            return f"Oggi hai chiuso in positivo con un utile di €{utile}. Ottimo lavoro!"
+        return f"Hai registrato entrate per €{dashboard['entrate']}: tenere traccia di ogni incasso è il primo passo per migliorare."
+
+    if tipo == "rischio":
+        if materiali_critici:
+            return f"{materiali_critici} materiali sono sotto la scorta di sicurezza: potrebbero causare fermi operativi."
+        if dashboard['stato'] == "critico":
+            return f"I costi di oggi (€{dashboard['costi']}) superano di molto le entrate: sembra utile capire quali voci pesano di più."
+        return "Non emergono rischi evidenti oggi: considera comunque di controllare l'andamento dei costi variabili."
+
+    if tipo == "azione":
+        if materiali_critici:
+            return "Domani potresti contattare i fornitori dei materiali critici per evitare di restare senza scorte."
+        if utile <= 0:
+            return "Domani considera di rivedere i costi variabili più alti o di spingere le vendite più redditizie."
+        return "Domani potresti registrare le entrate durante la giornata per tenere sotto controllo l'utile."
+
+    # generale (FREE)
+    return f"Il tuo utile oggi è di €{utile}. {'Ottimo lavoro!' if utile > 0 else 'Considera di rivedere i costi.'}"
+
+
+async def _complete(llm, session_id: str, system_message: str, prompt: str, timeout: float) -> str:
+    started = time.perf_counter()
+    esito = "errore"
+    try:
+        response = await asyncio.wait_for(llm.complete(session_id, system_message, prompt), timeout=timeout)
+        esito = "ok"
+        return response.strip()
+    except asyncio.TimeoutError:
+        esito = "timeout"
+        raise
+    except asyncio.CancelledError:
+        esito = "annullata"
+        raise
+    finally:
+        metrics.observe_llm(time.perf_counter() - started, esito)
+
+
+async def generate(
+    llm,
+    user_id: str,
+    subscription_tier: str,
+    data: str,
+    context: str,
+    dashboard: dict,
+    materiali_critici: int = 0,
+    call_timeout: float = 15.0,
+    total_budget: float = 25.0,
+    fallback_ttl: float = 600.0,
+    tipi: Optional[List[str]] = None
+) -> List[dict]:
+    """
+    Genera gli insight del giorno
+
+    Tutti i prompt sono inviati insieme. Ogni chiamata ha `call_timeout`
+    secondi; allo scadere di `total_budget` le chiamate ancora aperte sono
+    cancellate. Per ogni prompt senza risposta si usa fallback_text,
+    valido per `fallback_ttl` secondi. Con `tipi` si generano solo quelli
+    (es. gli insight a regole scaduti).
+
+    Returns:
+        list: documenti insight pronti per il salvataggio (nell'ordine dei prompt)
+    """
+    prompts = build_prompts(user_id, subscription_tier, data, context)
+    if tipi is not None:
+        prompts = [p for p in prompts if p[0] in tipi]
+
+    tasks = [
+        asyncio.ensure_future(_complete(llm, session_id, system_message, prompt, call_timeout))
+        for _, session_id, system_message, prompt in prompts
+    ]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=total_budget)
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    insights = []
+    for (tipo, _, _, _), task in zip(prompts, tasks):
+        contenuto = None
+        if task in done:
+            if task.exception() is None:
+                contenuto = task.result()
+            else:
+                logger.warning(f"Insight {tipo} per {user_id}: {type(task.exception()).__name__} {task.exception()}")
+        else:
+            logger.warning(f"Insight {tipo} per {user_id}: budget di {total_budget}s esaurito")
+
+        adesso = datetime.now(timezone.utc)
+        insights.append({
+            "insight_id": f"ins_{uuid.uuid4().hex[:12]}",
+            "user_id": user_id,
+            "data": data,
+            "tipo": tipo,
+            "contenuto": contenuto or fallback_text(tipo, dashboard, materiali_critici),
+            "fallback": not contenuto,
+            "expires_at": None if contenuto else (adesso + timedelta(seconds=fallback_ttl)).isoformat(),
+            "created_at": adesso.isoformat()
+        })
+
+    return insights
+
+
+def expired_fallbacks(insights: List[dict], now: Optional[datetime] = None) -> List[str]:
+    """Tipi degli insight a regole già scaduti, da rigenerare"""
+    now = now or datetime.now(timezone.utc)
+    return [
+        i["tipo"] for i in insights
+        if i.get("fallback") and (not i.get("expires_at") or datetime.fromisoformat(i["expires_at"]) <= now)
+    ]
+
+
+__all__ = ['PRO_PROMPTS', 'build_prompts', 'expired_fallbacks', 'fallback_text', 'generate']
@@ -0,0 +1,176 @@
+# Insights Batch
+# Genera in anticipo gli insight del giorno per gli utenti attivi, così la
+# prima apertura della dashboard non paga la latenza dell'LLM.
+#
+# Uso (es. da cron alle 03:00, per il giorno appena iniziato):
+#   0 3 * * * cd /app/backend && python insights_batch.py
+#   python insights_batch.py --data 2026-10-18 --concurrency 8 --rate 4
+#
+# Sono attivi gli utenti visti negli ultimi --active-days giorni
+# (users.last_seen_at, aggiornato da server.get_current_user).
+#
+# Il progresso è salvato in insights_batch_progress: rilanciando lo stesso
+# giorno dopo un crash, gli utenti già completati vengono saltati.
+
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+logger = logging.getLogger("insights_batch")
+
+
+class RateLimiter:
+    """Al massimo `rate` avvii al secondo, distribuiti uniformemente"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def default_data() -> str:
+    """
+    Giorno generato di default: oggi, come lo chiede la dashboard
+
+    Dashboard.js calcola la data con toISOString(), cioè in UTC: il batch
+    usa lo stesso calendario, così la prima apertura trova l'insight pronto.
+    """
+    return datetime.now(timezone.utc).date().isoformat()
+
+
+def iter_active_user_ids(store, active_days: int):
+    """Utenti visti negli ultimi `active_days` giorni (Storage.iter_active_user_ids)"""
+    return store.iter_active_user_ids(datetime.now(timezone.utc) - timedelta(days=active_days))
+
+
+async def run_batch(
+    store,
+    generate_insights,
+    user_from_doc,
+    data: str,
+    concurrency: int = 4,
+    rate: float = 2.0,
+    active_days: int = 30,
+    restart: bool = False
+) -> dict:
+    """
+    Genera gli insight di `data` per tutti gli utenti attivi
+
+    Args:
+        generate_insights: coroutine (user, data) che genera e salva gli insight
+        user_from_doc: costruisce il modello User da un documento users
+        restart: ignora il progresso salvato e riparte da zero
+
+    Returns:
+        dict: conteggi completati, saltati, errori
+    """
+    if restart:
+        await store.reset_batch_progress(data)
+
+    completed = await store.completed_batch_users(data)
+
+    stats = {"completati": 0, "saltati": 0, "errori": 0}
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    limiter = RateLimiter(rate)
+
+    async def process(user_id: str) -> str:
+        user_doc = await store.get_user(user_id)
+        if not user_doc:
+            return "saltati"
+
+        await limiter.acquire()
+        try:
+            await generate_insights(user_from_doc(user_doc), data)
+            stato = "completato"
+        except Exception as e:
+            logger.error(f"Insight {user_id} {data}: {e}")
+            stato = "errore"
+
+        await store.set_batch_progress(data, user_id, stato)
+        return "completati" if stato == "completato" else "errori"
+
+    async def worker():
+        while True:
+            user_id = await queue.get()
+            try:
+                if user_id is None:
+                    return
+                try:
+                    esito = await process(user_id)
+                except Exception as e:
+                    # Un worker che muore lascerebbe queue.put bloccato per sempre
+                    logger.error(f"Utente {user_id} {data}: {e}")
+                    esito = "errori"
+                stats[esito] += 1
+            finally:
+                queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+
+    async for user_id in iter_active_user_ids(store, active_days):
+        if user_id in completed:
+            stats["saltati"] += 1
+            continue
+        await queue.put(user_id)
+
+    for _ in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+
+    return stats
+
+
+async def _main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Generazione notturna degli insight")
+    parser.add_argument(
+        "--data", default=default_data(),
+        help="Giorno (YYYY-MM-DD), default oggi (UTC, come la dashboard)"
+    )
+    parser.add_argument("--concurrency", type=int, default=4, help="Utenti generati in parallelo")
+    parser.add_argument("--rate", type=float, default=2.0, help="Massimo generazioni avviate al secondo (0 = nessun limite)")
+    parser.add_argument("--active-days", type=int, default=30, help="Utenti visti negli ultimi N giorni")
+    parser.add_argument("--restart", action="store_true", help="Ignora il progresso salvato per questo giorno")
+    args = parser.parse_args(argv)
+
+    # Importa il server solo ora: legge .env e apre lo storage
+    import server
+
+    started = time.monotonic()
+    try:
+        stats = await run_batch(
+            server.store,
+            server.generate_insights,
+            server.user_from_doc,
+            args.data,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            active_days=args.active_days,
+            restart=args.restart
+        )
+    finally:
+        await server.store.close()
+
+    logger.info(
+        f"Insight {args.data}: {stats['completati']} completati, {stats['saltati']} saltati, "
+        f"{stats['errori']} errori in {time.monotonic() - started:.1f}s"
+    )
+
+
+__all__ = ['RateLimiter', 'default_data', 'iter_active_user_ids', 'run_batch']
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,497 @@
+# Ledger Aggregates
+# Riepiloghi giornalieri materializzati per la dashboard: un documento per
+# (user_id, data) con totali e conteggi di entrate e costi variabili, più un
+# documento per utente (data = "fissi") con la quota giornaliera dei costi fissi.
+#
+# I riepiloghi sono aggiornati in modo incrementale dai route di creazione ed
+# eliminazione. Il documento fissi di un utente nuovo nasce con il marcatore
+# `ricostruito_il`; per gli utenti con dati precedenti ai riepiloghi (senza
+# marcatore) le letture calcolano i totali dai documenti grezzi, senza
+# scrivere, finché la ricostruzione offline non li materializza. La
+# ricostruzione non gira mai sul percorso delle richieste: riscrivendo i
+# riepiloghi perderebbe gli incrementi concorrenti. Per riparazioni e
+# migrazioni:
+#   python ledger.py rebuild [--user USER_ID]
+
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from pymongo import ReplaceOne, UpdateOne
+
+import dates
+
+RIEPILOGO_FISSI = "fissi"
+
+GRANULARITA = ("day", "week", "month")
+
+MAX_GIORNI_RANGE = 366
+
+
+def classify_stato(utile: float, giorni: int = 1) -> str:
+    """Stato operativo: la soglia di attenzione è di -100€ per ogni giorno del periodo"""
+    if utile > 0:
+        return "positivo"
+    elif utile >= -100 * giorni:
+        return "attenzione"
+    return "critico"
+
+
+def build_dashboard(data: str, totale_entrate: float, totale_costi_var: float, totale_quota_fissi: float, giorni: int = 1) -> dict:
+    """Calcola utile e stato a partire dai totali del giorno (o del periodo)"""
+    # Arrotondati al centesimo prima della classificazione: le somme di
+    # $inc lasciano residui come 1e-14 che cambierebbero lo stato
+    totale_entrate = round(totale_entrate, 2)
+    totale_costi_var = round(totale_costi_var, 2)
+    totale_quota_fissi = round(totale_quota_fissi, 2)
+    totale_costi = round(totale_costi_var + totale_quota_fissi, 2)
+    utile = round(totale_entrate - totale_costi, 2)
+
+    return {
+        "data": data,
+        "utile": utile,
+        "entrate": totale_entrate,
+        "costi": totale_costi,
+        "costi_variabili": totale_costi_var,
+        "quota_fissi": totale_quota_fissi,
+        "stato": classify_stato(utile, giorni)
+    }
+
+
+async def _inc_riepilogo(db, user_id: str, data: str, inc: dict):
+    await db.riepiloghi_giornalieri.update_one(
+        {"user_id": user_id, "data": data},
+        {
+            "$inc": inc,
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+
+
+async def record_entrata(db, user_id: str, data: str, importo: float, segno: int = 1):
+    """Aggiorna il riepilogo del giorno dopo inserimento (+1) o eliminazione (-1) di un'entrata"""
+    await _inc_riepilogo(db, user_id, data, {
+        "totale_entrate": segno * importo,
+        "num_entrate": segno
+    })
+
+
+async def record_costo_variabile(db, user_id: str, data: str, importo: float, segno: int = 1):
+    """Aggiorna il riepilogo del giorno dopo inserimento (+1) o eliminazione (-1) di un costo variabile"""
+    await _inc_riepilogo(db, user_id, data, {
+        "totale_costi_variabili": segno * importo,
+        "num_costi_variabili": segno
+    })
+
+
+async def record_costo_fisso(db, user_id: str, quota_giornaliera: float, segno: int = 1):
+    """Aggiorna la quota fissi dell'utente dopo inserimento (+1) o eliminazione (-1) di un costo fisso"""
+    await _inc_riepilogo(db, user_id, RIEPILOGO_FISSI, {
+        "totale_quota_fissi": segno * quota_giornaliera,
+        "num_costi_fissi": segno
+    })
+
+
+async def _record_bulk(db, user_id: str, docs: list, totale_field: str, num_field: str):
+    # Un solo bulk_write per tutte le date toccate dall'importazione
+    per_giorno = {}
+    for doc in docs:
+        totale, num = per_giorno.get(doc["data"], (0, 0))
+        per_giorno[doc["data"]] = (totale + doc["importo"], num + 1)
+
+    if not per_giorno:
+        return
+
+    now = datetime.now(timezone.utc)
+    await db.riepiloghi_giornalieri.bulk_write([
+        UpdateOne(
+            {"user_id": user_id, "data": data},
+            {"$inc": {totale_field: totale, num_field: num}, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for data, (totale, num) in per_giorno.items()
+    ], ordered=False)
+
+
+async def record_entrate_bulk(db, user_id: str, docs: list):
+    """Aggiorna i riepiloghi dopo un'importazione massiva di entrate"""
+    await _record_bulk(db, user_id, docs, "totale_entrate", "num_entrate")
+
+
+async def record_costi_variabili_bulk(db, user_id: str, docs: list):
+    """Aggiorna i riepiloghi dopo un'importazione massiva di costi variabili"""
+    await _record_bulk(db, user_id, docs, "totale_costi_variabili", "num_costi_variabili")
+
+
+async def init_user(db, user_id: str):
+    """
+    Documento fissi di un utente appena creato, già marcato come ricostruito:
+    i suoi riepiloghi sono completi fin dal primo movimento
+    """
+    now = datetime.now(timezone.utc)
+    await db.riepiloghi_giornalieri.update_one(
+        {"user_id": user_id, "data": RIEPILOGO_FISSI},
+        {"$setOnInsert": {
+            "totale_quota_fissi": 0,
+            "num_costi_fissi": 0,
+            "ricostruito_il": now,
+            "updated_at": now
+        }},
+        upsert=True
+    )
+
+
+async def _totali_grezzi(db, user_id: str, dal: Optional[date] = None, al: Optional[date] = None) -> dict:
+    """Totali per giorno ("YYYY-MM-DD") calcolati dai documenti grezzi, senza scrivere"""
+    match = {"user_id": user_id}
+    if dal is not None or al is not None:
+        match["$or"] = dates.data_range_filter(dal, al)
+
+    giorni = {}
+    for collezione, totale_field, num_field in (
+        ("entrate", "totale_entrate", "num_entrate"),
+        ("costi_variabili", "totale_costi_variabili", "num_costi_variabili")
+    ):
+        async for row in db[collezione].aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$data", "totale": {"$sum": "$importo"}, "num": {"$sum": 1}}}
+        ]):
+            # Durante il backfill lo stesso giorno può comparire come stringa e come data
+            totali = giorni.setdefault(dates.format_data(row["_id"]), {})
+            totali[totale_field] = totali.get(totale_field, 0) + row["totale"]
+            totali[num_field] = totali.get(num_field, 0) + row["num"]
+    return giorni
+
+
+async def _fissi_grezzi(db, user_id: str) -> dict:
+    """Quota fissi calcolata dai costi fissi, senza scrivere"""
+    async for row in db.costi_fissi.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {"_id": None, "totale": {"$sum": "$quota_giornaliera"}, "num": {"$sum": 1}}}
+    ]):
+        return {"totale_quota_fissi": row["totale"], "num_costi_fissi": row["num"]}
+    return {"totale_quota_fissi": 0, "num_costi_fissi": 0}
+
+
+async def rebuild_user(db, user_id: str) -> int:
+    """
+    Ricalcola da zero i riepiloghi di un utente dai documenti grezzi
+
+    Solo per manutenzione offline (_main): gli incrementi scritti durante
+    la ricostruzione andrebbero persi.
+
+    Returns:
+        int: numero di giorni ricostruiti
+    """
+    now = datetime.now(timezone.utc)
+    giorni = await _totali_grezzi(db, user_id)
+    fissi = await _fissi_grezzi(db, user_id)
+
+    operations = []
+    for data, totali in giorni.items():
+        operations.append(ReplaceOne(
+            {"user_id": user_id, "data": data},
+            {
+                "user_id": user_id,
+                "data": data,
+                "totale_entrate": totali.get("totale_entrate", 0),
+                "num_entrate": totali.get("num_entrate", 0),
+                "totale_costi_variabili": totali.get("totale_costi_variabili", 0),
+                "num_costi_variabili": totali.get("num_costi_variabili", 0),
+                "updated_at": now
+            },
+            upsert=True
+        ))
+
+    # Il documento fissi porta il marcatore di ricostruzione
+    operations.append(ReplaceOne(
+        {"user_id": user_id, "data": RIEPILOGO_FISSI},
+        {
+            "user_id": user_id,
+            "data": RIEPILOGO_FISSI,
+            **fissi,
+            "ricostruito_il": now,
+            "updated_at": now
+        },
+        upsert=True
+    ))
+
+    await db.riepiloghi_giornalieri.bulk_write(operations, ordered=False)
+
+    # Rimuove i giorni che non hanno più documenti grezzi
+    await db.riepiloghi_giornalieri.delete_many({
+        "user_id": user_id,
+        "data": {"$nin": list(giorni.keys()) + [RIEPILOGO_FISSI]}
+    })
+
+    return len(giorni)
+
+
+async def rebuild_all(db) -> int:
+    """Ricalcola i riepiloghi di tutti gli utenti"""
+    count = 0
+    async for user_doc in db.users.find({}, {"_id": 0, "user_id": 1}):
+        await rebuild_user(db, user_doc["user_id"])
+        count += 1
+    return count
+
+
+def _ricostruito(fissi: Optional[dict]) -> bool:
+    # Senza marcatore i riepiloghi possono non coprire i dati precedenti
+    return fissi is not None and "ricostruito_il" in fissi
+
+
+def period_key(giorno: date, granularity: str) -> str:
+    """Chiave del periodo: 2026-10-17, 2026-W42 (settimana ISO) o 2026-10"""
+    if granularity == "week":
+        iso_year, iso_week, _ = giorno.isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    if granularity == "month":
+        return giorno.isoformat()[:7]
+    return giorno.isoformat()
+
+
+def _period_group_key(granularity: str):
+    # Stessa chiave di period_key, calcolata lato MongoDB
+    if granularity == "week":
+        return {"$dateToString": {
+            "format": "%G-W%V",
+            "date": {"$dateFromString": {"dateString": "$data", "format": "%Y-%m-%d"}}
+        }}
+    if granularity == "month":
+        return {"$substrCP": ["$data", 0, 7]}
+    return "$data"
+
+
+def build_dashboard_series(dal: date, al: date, granularity: str, totali: dict, quota_fissi: float) -> list:
+    """
+    Serie della dashboard a partire dai totali per periodo
+
+    Args:
+        totali: {chiave periodo: {"entrate", "costi_variabili"}} come da period_key
+        quota_fissi: quota giornaliera dei costi fissi, moltiplicata per i
+            giorni del periodo che cadono nell'intervallo
+    """
+    # Periodi nell'ordine del calendario, compresi quelli senza movimenti
+    periodi = {}
+    giorno = dal
+    while giorno <= al:
+        key = period_key(giorno, granularity)
+        periodo = periodi.setdefault(key, {"dal": giorno, "al": giorno, "giorni": 0})
+        periodo["al"] = giorno
+        periodo["giorni"] += 1
+        giorno += timedelta(days=1)
+
+    serie = []
+    for key, periodo in periodi.items():
+        row = totali.get(key, {})
+        punto = build_dashboard(
+            key,
+            row.get("entrate", 0),
+            row.get("costi_variabili", 0),
+            quota_fissi * periodo["giorni"],
+            giorni=periodo["giorni"]
+        )
+        punto.update(
+            dal=periodo["dal"].isoformat(),
+            al=periodo["al"].isoformat(),
+            giorni=periodo["giorni"]
+        )
+        serie.append(punto)
+
+    return serie
+
+
+async def get_dashboard_range(db, user_id: str, dal: date, al: date, granularity: str = "day") -> list:
+    """
+    Serie della dashboard tra due date (incluse) raggruppata per giorno, settimana o mese
+
+    I totali per periodo sono calcolati con una sola aggregazione sui riepiloghi
+    giornalieri; la quota fissi viene moltiplicata per i giorni del periodo che
+    cadono nell'intervallo. Con granularità "day" ogni punto coincide con
+    get_dashboard per quel giorno.
+    """
+    fissi = await db.riepiloghi_giornalieri.find_one(
+        {"user_id": user_id, "data": RIEPILOGO_FISSI},
+        {"_id": 0}
+    )
+
+    totali = {}
+    if not _ricostruito(fissi):
+        # Utente mai ricostruito: totali dai documenti grezzi
+        for giorno, row in (await _totali_grezzi(db, user_id, dal, al)).items():
+            periodo = totali.setdefault(
+                period_key(date.fromisoformat(giorno), granularity), {"entrate": 0, "costi_variabili": 0}
+            )
+            periodo["entrate"] += row.get("totale_entrate", 0)
+            periodo["costi_variabili"] += row.get("totale_costi_variabili", 0)
+        fissi = await _fissi_grezzi(db, user_id)
+        return build_dashboard_series(dal, al, granularity, totali, fissi["totale_quota_fissi"])
+
+    async for row in db.riepiloghi_giornalieri.aggregate([
+        {"$match": {
+            "user_id": user_id,
+            "data": {"$gte": dal.isoformat(), "$lte": al.isoformat()}
+        }},
+        {"$group": {
+            "_id": _period_group_key(granularity),
+            "entrate": {"$sum": "$totale_entrate"},
+            "costi_variabili": {"$sum": "$totale_costi_variabili"}
+        }}
+    ]):
+        totali[row["_id"]] = row
+
+    return build_dashboard_series(dal, al, granularity, totali, fissi.get("totale_quota_fissi", 0))
+
+
+async def get_dashboard_totals(db, user_id: str, data: str) -> dict:
+    """
+    Legge con una sola query il riepilogo del giorno e la quota fissi
+
+    Se l'utente non è mai stato ricostruito (dati precedenti ai riepiloghi),
+    calcola i totali dai documenti grezzi senza scrivere.
+    """
+    docs = await db.riepiloghi_giornalieri.find(
+        {"user_id": user_id, "data": {"$in": [data, RIEPILOGO_FISSI]}},
+        {"_id": 0}
+    ).to_list(2)
+
+    giorno = next((d for d in docs if d["data"] == data), {})
+    fissi = next((d for d in docs if d["data"] == RIEPILOGO_FISSI), None)
+
+    if not _ricostruito(fissi):
+        try:
+            dal = dates.parse_data(data)
+            giorno = (await _totali_grezzi(db, user_id, dal, dal)).get(dal.isoformat(), {})
+        except ValueError:
+            # Come la lettura dei riepiloghi: un giorno non valido non ha movimenti
+            giorno = {}
+        fissi = await _fissi_grezzi(db, user_id)
+
+    return {
+        "totale_entrate": giorno.get("totale_entrate", 0),
+        "num_entrate": giorno.get("num_entrate", 0),
+        "totale_costi_variabili": giorno.get("totale_costi_variabili", 0),
+        "num_costi_variabili": giorno.get("num_costi_variabili", 0),
+        "totale_quota_fissi": fissi.get("totale_quota_fissi", 0),
+        "num_costi_fissi": fissi.get("num_costi_fissi", 0)
+    }
+
+
+async def _totali_grezzi_many(db, user_ids: List[str], data: str) -> Dict[str, dict]:
+    """Totali del giorno per più utenti dai documenti grezzi: una aggregazione per collezione"""
+    try:
+        giorno = dates.parse_data(data)
+    except ValueError:
+        giorno = None
+
+    totali = {}
+    for collezione, campo, valore, per_giorno in (
+        ("entrate", "totale_entrate", "$importo", True),
+        ("costi_variabili", "totale_costi_variabili", "$importo", True),
+        ("costi_fissi", "totale_quota_fissi", "$quota_giornaliera", False)
+    ):
+        match = {"user_id": {"$in": user_ids}}
+        if per_giorno:
+            if giorno is None:
+                # Un giorno non valido non ha movimenti
+                continue
+            match["$or"] = dates.data_range_filter(giorno, giorno)
+        async for row in db[collezione].aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$user_id", "totale": {"$sum": valore}}}
+        ]):
+            totali.setdefault(row["_id"], {})[campo] = row["totale"]
+    return totali
+
+
+async def get_dashboard_totals_many(db, user_ids: List[str], data: str) -> Dict[str, dict]:
+    """
+    Totali del giorno per un gruppo di utenti, senza query per utente
+
+    Una query sui riepiloghi per tutto il gruppo; gli utenti mai ricostruiti
+    sono calcolati insieme dai documenti grezzi (_totali_grezzi_many).
+    """
+    giorni, fissi = {}, {}
+    async for doc in db.riepiloghi_giornalieri.find(
+        {"user_id": {"$in": user_ids}, "data": {"$in": [data, RIEPILOGO_FISSI]}},
+        {"_id": 0}
+    ):
+        if doc["data"] == RIEPILOGO_FISSI:
+            fissi[doc["user_id"]] = doc
+        else:
+            giorni[doc["user_id"]] = doc
+
+    da_ricostruire = [user_id for user_id in user_ids if not _ricostruito(fissi.get(user_id))]
+    grezzi = await _totali_grezzi_many(db, da_ricostruire, data) if da_ricostruire else {}
+
+    totali = {}
+    for user_id in user_ids:
+        if _ricostruito(fissi.get(user_id)):
+            giorno = {**giorni.get(user_id, {}), "totale_quota_fissi": fissi[user_id].get("totale_quota_fissi", 0)}
+        else:
+            giorno = grezzi.get(user_id, {})
+        totali[user_id] = {
+            "totale_entrate": giorno.get("totale_entrate", 0),
+            "totale_costi_variabili": giorno.get("totale_costi_variabili", 0),
+            "totale_quota_fissi": giorno.get("totale_quota_fissi", 0)
+        }
+    return totali
+
+
+async def get_dashboard(db, user_id: str, data: str) -> dict:
+    """Dashboard del giorno calcolata dai riepiloghi materializzati"""
+    totali = await get_dashboard_totals(db, user_id, data)
+    return build_dashboard(
+        data,
+        totali["totale_entrate"],
+        totali["totale_costi_variabili"],
+        totali["totale_quota_fissi"]
+    )
+
+
+async def _main(argv: Optional[list] = None):
+    import argparse
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manutenzione riepiloghi giornalieri")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild = sub.add_parser("rebuild", help="Ricalcola i riepiloghi dai documenti grezzi")
+    rebuild.add_argument("--user", help="Ricostruisce un solo utente")
+    args = parser.parse_args(argv)
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+
+    try:
+        if args.user:
+            giorni = await rebuild_user(db, args.user)
+            print(f"✅ Utente {args.user}: {giorni} giorni ricostruiti")
+        else:
+            utenti = await rebuild_all(db)
+            print(f"✅ {utenti} utenti ricostruiti")
+        # Una riparazione può cambiare i totali: invalida gli ETag della
+        # dashboard (storage.get_versions). Senza upsert, chi non ha contatori
+        # non ha ancora ETag da invalidare
+        await db.versioni.update_many(
+            {"user_id": args.user} if args.user else {},
+            {"$inc": {"dashboard": 1}}
+        )
+    finally:
+        client.close()
+
+
+__all__ = [
+    'RIEPILOGO_FISSI', 'GRANULARITA', 'MAX_GIORNI_RANGE', 'classify_stato', 'build_dashboard', 'init_user', 'record_entrata', 'record_costo_variabile',
+    'record_costo_fisso', 'record_entrate_bulk', 'record_costi_variabili_bulk', 'rebuild_user', 'rebuild_all', 'get_dashboard_totals', 'get_dashboard_totals_many', 'get_dashboard',
+    'period_key', 'build_dashboard_series', 'get_dashboard_range'
+]
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
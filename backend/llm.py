@@ -0,0 +1,82 @@
+# LLM Client
+# Punto unico di accesso al modello per gli insight. In produzione usa
+# emergentintegrations; con LLM_BACKEND=fake usa un finto modello locale
+# (latenza configurabile) per test e benchmark senza chiamate esterne.
+
+import asyncio
+import os
+from typing import Optional
+
+try:
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    EMERGENT_LLM_AVAILABLE = True
+except ImportError:
+    EMERGENT_LLM_AVAILABLE = False
+
+
+class EmergentLlm:
+    """Chiamata reale tramite emergentintegrations"""
+
+    def __init__(self, api_key: Optional[str], provider: str = "openai", model: str = "gpt-5.2"):
+        self.api_key = api_key
+        self.provider = provider
+        self.model = model
+
+    async def complete(self, session_id: str, system_message: str, prompt: str) -> str:
+        if not EMERGENT_LLM_AVAILABLE:
+            raise RuntimeError("emergentintegrations non installato")
+
+        chat = LlmChat(
+            api_key=self.api_key,
+            session_id=session_id,
+            system_message=system_message
+        )
+        chat.with_model(self.provider, self.model)
+        return await chat.send_message(UserMessage(text=prompt))
+
+
+class FakeLlm:
+    """
+    Finto LLM locale
+
+    Args:
+        latency: secondi di attesa per ogni risposta
+        hang_session_ids: sottostringhe di session_id per cui la chiamata non risponde mai
+    """
+
+    def __init__(self, latency: float = 0.0, hang_session_ids: tuple = ()):
+        self.latency = latency
+        self.hang_session_ids = hang_session_ids
+        self.calls = 0
+
+    async def complete(self, session_id: str, system_message: str, prompt: str) -> str:
+        self.calls += 1
+        if any(s in session_id for s in self.hang_session_ids):
+            await asyncio.Event().wait()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        first_line = prompt.strip().splitlines()[0] if prompt.strip() else ""
+        return f"Insight di prova: {first_line[:120]}"
+
+
+_llm = None
+
+
+def get_llm():
+    """Client configurato da LLM_BACKEND (emergent | fake)"""
+    global _llm
+    if _llm is None:
+        if os.environ.get('LLM_BACKEND', 'emergent') == 'fake':
+            _llm = FakeLlm(latency=float(os.environ.get('LLM_FAKE_LATENCY', '0')))
+        else:
+            _llm = EmergentLlm(api_key=os.environ.get('EMERGENT_LLM_KEY'))
+    return _llm
+
+
+def set_llm(llm):
+    """Sostituisce il client (test, benchmark)"""
+    global _llm
+    _llm = llm
+
+
+__all__ = ['EmergentLlm', 'FakeLlm', 'get_llm', 'set_llm', 'EMERGENT_LLM_AVAILABLE']
@@ -0,0 +1,317 @@
+# Request Metrics
+# Strumentazione delle richieste: latenza per route, chiamate e tempo
+# del database (CommandListener di pymongo o storage SQLite), tempo LLM e
+# tempo bcrypt.
+# Tutto è esposto in formato Prometheus su /metrics; le richieste più lente
+# di SLOW_REQUEST_MS finiscono nel log con il dettaglio dei tempi.
+# /metrics non usa le sessioni utente: con METRICS_TOKEN impostato lo
+# scraper deve inviarlo come Bearer token, senza va lasciato raggiungibile
+# solo dalla rete interna (server.py avvisa all'avvio).
+#
+# Il dettaglio per richiesta viaggia in una ContextVar: Motor e
+# asyncio.to_thread copiano il contesto nei thread, quindi anche il listener
+# MongoDB (che gira nel thread di pymongo) aggiorna la richiesta giusta.
+
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# ============== REGISTRY ==============
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> ([conteggio per bucket], somma, totale)
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    le = _format_labels(self.labelnames, labels, f'le="{_format_value(bound)}"')
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _format_labels(self.labelnames, labels, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """Valori letti al momento dello scrape (es. contatori della session cache)"""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[Tuple[str, ...], float]],
+                 labelnames: Tuple[str, ...] = (), type: str = "gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        self.type = type
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        try:
+            values = self.fn()
+        except Exception as e:
+            logger.error(f"Metrica {self.name} non disponibile: {e}")
+            return lines
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metrica già registrata: {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def callback(self, name: str, help: str, fn, labelnames: Tuple[str, ...] = (), type: str = "gauge") -> CallbackMetric:
+        return self._add(CallbackMetric(name, help, fn, labelnames, type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    "http_requests_total", "Richieste HTTP completate", ("method", "route", "status")
+)
+HTTP_DURATION = REGISTRY.histogram(
+    "http_request_duration_seconds", "Durata delle richieste HTTP", ("method", "route")
+)
+DB_DURATION = REGISTRY.histogram(
+    "mongodb_command_duration_seconds", "Durata dei comandi MongoDB", ("command",)
+)
+DB_FAILURES = REGISTRY.counter(
+    "mongodb_command_failures_total", "Comandi MongoDB falliti", ("command",)
+)
+SQLITE_DURATION = REGISTRY.histogram(
+    "sqlite_operation_duration_seconds", "Durata delle operazioni dello storage SQLite (attesa del thread inclusa)", ("operazione",)
+)
+LLM_DURATION = REGISTRY.histogram(
+    "llm_call_duration_seconds", "Durata delle chiamate al modello", ("esito",)
+)
+BCRYPT_DURATION = REGISTRY.histogram(
+    "bcrypt_duration_seconds", "Durata di hash e verifica bcrypt (attesa del pool inclusa)", ("operazione",)
+)
+
+
+# ============== DETTAGLIO PER RICHIESTA ==============
+
+class RequestStats:
+    """Tempi accumulati da una richiesta; aggiornato anche da thread diversi"""
+
+    def __init__(self):
+        self.db_calls = 0
+        self.db_seconds = 0.0
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, field: str, seconds: float, calls: int = 0):
+        with self._lock:
+            setattr(self, f"{field}_seconds", getattr(self, f"{field}_seconds") + seconds)
+            if calls:
+                setattr(self, f"{field}_calls", getattr(self, f"{field}_calls") + calls)
+
+    def summary(self) -> str:
+        return (
+            f"db {self.db_calls} chiamate {self.db_seconds * 1000:.0f}ms, "
+            f"llm {self.llm_calls} chiamate {self.llm_seconds * 1000:.0f}ms, "
+            f"bcrypt {self.bcrypt_seconds * 1000:.0f}ms"
+        )
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def current_stats() -> Optional[RequestStats]:
+    return _current.get()
+
+
+def observe_llm(seconds: float, esito: str = "ok"):
+    LLM_DURATION.observe(seconds, esito)
+    stats = _current.get()
+    if stats is not None:
+        stats.add("llm", seconds, calls=1)
+
+
+@contextmanager
+def time_bcrypt(operazione: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        BCRYPT_DURATION.observe(seconds, operazione)
+        stats = _current.get()
+        if stats is not None:
+            stats.add("bcrypt", seconds)
+
+
+def observe_sqlite(seconds: float, operazione: str):
+    SQLITE_DURATION.observe(seconds, operazione)
+    stats = _current.get()
+    if stats is not None:
+        stats.add("db", seconds, calls=1)
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Passato a AsyncIOMotorClient(event_listeners=[...])"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        DB_FAILURES.inc(event.command_name)
+        self._record(event)
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        DB_DURATION.observe(seconds, event.command_name)
+        stats = _current.get()
+        if stats is not None:
+            stats.add("db", seconds, calls=1)
+
+
+# ============== MIDDLEWARE ==============
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI: latenza per route e log delle richieste lente
+
+    La route è il template registrato (es. /api/entrate/{entrata_id}), così
+    gli ID non moltiplicano le serie; le richieste senza route sono
+    raggruppate in "<nessuna>".
+    """
+
+    def __init__(self, app, slow_request_ms: float = 1000, exclude_paths: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+        self.exclude_paths = exclude_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.exclude_paths:
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current.set(stats)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            _current.reset(token)
+
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "<nessuna>"
+            method = scope["method"]
+            HTTP_REQUESTS.inc(method, route_path, str(status))
+            HTTP_DURATION.observe(seconds, method, route_path)
+
+            if self.slow_request_ms and seconds * 1000 >= self.slow_request_ms:
+                logger.warning(
+                    f"Richiesta lenta {method} {route_path} {status} in {seconds * 1000:.0f}ms: {stats.summary()}"
+                )
+
+
+__all__ = [
+    'CONTENT_TYPE', 'REGISTRY', 'Registry', 'Counter', 'Histogram', 'CallbackMetric', 'RequestStats',
+    'current_stats', 'observe_llm', 'observe_sqlite', 'time_bcrypt', 'CommandMetricsListener', 'MetricsMiddleware'
+]
@@ -0,0 +1,211 @@
+# Movimenti Magazzino
+# Log append-only dei carichi/scarichi di ogni materiale. La giacenza cambia
+# solo con $inc atomici (nessuna scrittura persa tra scanner concorrenti) e
+# gli scarichi alimentano una media mobile esponenziale del consumo
+# giornaliero, salvata sul materiale: le letture di /api/materiali non
+# devono ricalcolare nulla.
+
+import os
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from pymongo import ReturnDocument
+
+TIPI_MOVIMENTO = ("carico", "scarico")
+
+# Span in giorni della media esponenziale: alpha = 2 / (span + 1)
+EWMA_SPAN = float(os.environ.get('CONSUMO_EWMA_SPAN', '14'))
+EWMA_ALPHA = 2 / (EWMA_SPAN + 1)
+
+# Giorni massimi ripresi quando un materiale torna attivo dopo una pausa
+MAX_GIORNI_FOLD = 365
+
+
+def _oggi() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def ewma_update(media: Optional[float], varianza: float, consumo: float, alpha: float = EWMA_ALPHA) -> Tuple[float, float]:
+    """Aggiorna media e varianza esponenziali con il consumo di un giorno"""
+    if media is None:
+        return consumo, 0.0
+    diff = consumo - media
+    incr = alpha * diff
+    return media + incr, (1 - alpha) * (varianza + diff * incr)
+
+
+def fold_update(materiale: dict, inizio: date, ieri: date, consumi: dict) -> dict:
+    """
+    Campi del materiale dopo aver incorporato i giorni da `inizio` a `ieri`
+
+    Args:
+        consumi: {data: quantità scaricata}; i giorni assenti valgono 0
+    """
+    media = materiale.get("consumo_ewma")
+    varianza = materiale.get("consumo_ewma_var") or 0.0
+    giorno = inizio
+    while giorno <= ieri:
+        media, varianza = ewma_update(media, varianza, consumi.get(giorno.isoformat(), 0.0))
+        giorno += timedelta(days=1)
+
+    return {
+        "consumo_ewma": media,
+        "consumo_ewma_var": varianza,
+        "consumo_ewma_fino_al": ieri.isoformat()
+    }
+
+
+def build_movimento(user_id: str, materiale_id: str, tipo: str, quantita: float, quantita_dopo: float,
+                    note: Optional[str] = None, oggi: Optional[date] = None) -> dict:
+    return {
+        "movimento_id": f"mov_{uuid.uuid4().hex[:12]}",
+        "materiale_id": materiale_id,
+        "user_id": user_id,
+        "tipo": tipo,
+        "quantita": quantita,
+        "quantita_dopo": quantita_dopo,
+        "note": note,
+        "data": (oggi or _oggi()).isoformat(),
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def fold_consumption(db, materiale: dict, oggi: Optional[date] = None) -> dict:
+    """
+    Incorpora nella media i giorni chiusi (fino a ieri) non ancora conteggiati
+
+    Eseguito al primo movimento di ogni giorno. L'aggiornamento è condizionato
+    al valore precedente di consumo_ewma_fino_al: se due richieste provano a
+    farlo insieme, solo la prima lo applica.
+    """
+    oggi = oggi or _oggi()
+    ieri = oggi - timedelta(days=1)
+    ultimo = materiale.get("consumo_ewma_fino_al")
+
+    if ultimo and ultimo >= ieri.isoformat():
+        return materiale
+
+    if ultimo:
+        inizio = date.fromisoformat(ultimo) + timedelta(days=1)
+    else:
+        primo = await db.consumi_giornalieri.find_one(
+            {"materiale_id": materiale["materiale_id"], "data": {"$lte": ieri.isoformat()}},
+            {"_id": 0, "data": 1},
+            sort=[("data", 1)]
+        )
+        if not primo:
+            return materiale
+        inizio = date.fromisoformat(primo["data"])
+
+    inizio = max(inizio, ieri - timedelta(days=MAX_GIORNI_FOLD))
+
+    consumi = {
+        row["data"]: row["quantita"]
+        async for row in db.consumi_giornalieri.find(
+            {
+                "materiale_id": materiale["materiale_id"],
+                "data": {"$gte": inizio.isoformat(), "$lte": ieri.isoformat()}
+            },
+            {"_id": 0, "data": 1, "quantita": 1}
+        )
+    }
+
+    update = fold_update(materiale, inizio, ieri, consumi)
+    result = await db.materiali.update_one(
+        {
+            "materiale_id": materiale["materiale_id"],
+            "user_id": materiale["user_id"],
+            "consumo_ewma_fino_al": ultimo
+        },
+        {"$set": update}
+    )
+    if result.modified_count:
+        materiale.update(update)
+    return materiale
+
+
+async def record_movimento(db, user_id: str, materiale_id: str, tipo: str, quantita: float,
+                           note: Optional[str] = None) -> Optional[Tuple[dict, dict]]:
+    """
+    Registra un carico o scarico e aggiorna la giacenza con $inc
+
+    Returns:
+        tuple: (movimento, materiale aggiornato) oppure None se il materiale non esiste
+    """
+    delta = quantita if tipo == "carico" else -quantita
+    oggi = _oggi()
+
+    materiale = await db.materiali.find_one_and_update(
+        {"materiale_id": materiale_id, "user_id": user_id},
+        {"$inc": {"quantita_disponibile": delta}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if materiale is None:
+        return None
+
+    movimento = build_movimento(user_id, materiale_id, tipo, quantita, materiale["quantita_disponibile"], note, oggi)
+    await db.movimenti_materiali.insert_one(movimento.copy())
+
+    if tipo == "scarico":
+        await db.consumi_giornalieri.update_one(
+            {"materiale_id": materiale_id, "data": oggi.isoformat()},
+            {"$inc": {"quantita": quantita}, "$setOnInsert": {"user_id": user_id}},
+            upsert=True
+        )
+
+    materiale = await fold_consumption(db, materiale, oggi)
+    return movimento, materiale
+
+
+async def record_rettifica(db, user_id: str, materiale_id: str, quantita: float,
+                           altri_campi: Optional[dict] = None) -> Optional[dict]:
+    """
+    Imposta la giacenza da inventario e registra la differenza come rettifica
+
+    La giacenza precedente è letta nella stessa operazione atomica, quindi la
+    differenza registrata è corretta anche con movimenti concorrenti.
+    La rettifica non entra nella media dei consumi.
+
+    Returns:
+        dict: movimento registrato oppure None se il materiale non esiste
+    """
+    precedente = await db.materiali.find_one_and_update(
+        {"materiale_id": materiale_id, "user_id": user_id},
+        {"$set": {"quantita_disponibile": quantita, **(altri_campi or {})}},
+        projection={"_id": 0, "quantita_disponibile": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if precedente is None:
+        return None
+
+    movimento = build_movimento(
+        user_id, materiale_id, "rettifica", quantita - precedente.get("quantita_disponibile", 0), quantita
+    )
+    await db.movimenti_materiali.insert_one(movimento.copy())
+    return movimento
+
+
+async def delete_materiale(db, user_id: str, materiale_id: str) -> bool:
+    """
+    Elimina il materiale con i suoi movimenti e consumi giornalieri
+
+    Il materiale va per primo: un movimento successivo non lo trova più e
+    non scrive nuove righe dopo la pulizia.
+
+    Returns:
+        bool: False se il materiale non esiste
+    """
+    result = await db.materiali.delete_one({"materiale_id": materiale_id, "user_id": user_id})
+    if not result.deleted_count:
+        return False
+    await db.movimenti_materiali.delete_many({"materiale_id": materiale_id, "user_id": user_id})
+    await db.consumi_giornalieri.delete_many({"materiale_id": materiale_id})
+    return True
+
+
+__all__ = [
+    'TIPI_MOVIMENTO', 'EWMA_ALPHA', 'MAX_GIORNI_FOLD', 'ewma_update', 'fold_update', 'build_movimento',
+    'fold_consumption', 'record_movimento', 'record_rettifica', 'delete_materiale'
+]
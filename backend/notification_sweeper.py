@@ -0,0 +1,170 @@
+# Notification Sweeper
+# Valuta periodicamente le regole di notifica (magazzino, stato, giornata
+# positiva) per tutti gli utenti con le push attive. Ogni giro legge le
+# collezioni in blocco, una query per collezione su gruppi di utenti, invece
+# delle 4+ query per utente di check_and_send_notifications.
+#
+# Uso:
+#   python notification_sweeper.py --once
+#   python notification_sweeper.py --interval 900 --shard 0 --shards 2
+#
+# Con più worker ognuno prende gli utenti con shard_hash(user_id) % shards
+# == shard, filtrati dallo storage nella query.
+# In alternativa il server può avviarlo da solo con NOTIFICHE_SWEEP_INTERVAL.
+
+import argparse
+import asyncio
+import logging
+import time
+from datetime import date
+from typing import Dict, List, Optional
+
+from forecasting import annotate_materiali
+from notifications import NotificationPipeline, add_candidates, evaluate_rules, shard_hash
+
+logger = logging.getLogger("notification_sweeper")
+
+# Utenti valutati insieme (dimensione dei $in)
+CHUNK_SIZE = 500
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Shard stabile tra processi e riavvii (hash() di Python non lo è)"""
+    return shard_hash(user_id) % shards
+
+
+def iter_enabled_prefs(store, shard: int = 0, shards: int = 1):
+    """Preferenze degli utenti con push attive che appartengono allo shard"""
+    return store.iter_push_enabled_preferences(shard, shards)
+
+
+async def _load_materiali(store, user_ids: List[str]) -> Dict[str, List[dict]]:
+    materiali = await store.list_materiali_many(user_ids)
+
+    # La previsione è per materiale: un solo calcolo vettoriale per tutto il gruppo
+    by_user: Dict[str, List[dict]] = {}
+    for m in annotate_materiali(materiali):
+        by_user.setdefault(m["user_id"], []).append(m)
+    return by_user
+
+
+async def sweep_chunk(store, prefs_chunk: List[dict], oggi: str) -> int:
+    """
+    Valuta le regole per un gruppo di utenti
+
+    Returns:
+        int: notifiche create
+    """
+    magazzino = [p["user_id"] for p in prefs_chunk if p.get("notifiche_magazzino")]
+    giornata = [
+        p["user_id"] for p in prefs_chunk
+        if p.get("notifiche_stato") or p.get("notifiche_giornata_positiva")
+    ]
+
+    materiali = await _load_materiali(store, magazzino) if magazzino else {}
+    totali = await store.get_dashboard_totals_many(giornata, oggi) if giornata else {}
+
+    pipeline = NotificationPipeline(store)
+    for prefs in prefs_chunk:
+        user_id = prefs["user_id"]
+        candidates = evaluate_rules(prefs, materiali.get(user_id, []), totali.get(user_id), oggi)
+        add_candidates(pipeline, user_id, candidates)
+
+    return len(await pipeline.flush())
+
+
+async def run_sweep(store, oggi: Optional[str] = None, shard: int = 0, shards: int = 1,
+                    chunk_size: int = CHUNK_SIZE) -> dict:
+    """
+    Un giro completo sullo shard
+
+    Returns:
+        dict: utenti valutati e notifiche create
+    """
+    oggi = oggi or date.today().isoformat()
+    stats = {"utenti": 0, "notifiche": 0}
+
+    chunk = []
+    async for prefs in iter_enabled_prefs(store, shard, shards):
+        chunk.append(prefs)
+        if len(chunk) >= chunk_size:
+            stats["notifiche"] += await sweep_chunk(store, chunk, oggi)
+            stats["utenti"] += len(chunk)
+            chunk = []
+    if chunk:
+        stats["notifiche"] += await sweep_chunk(store, chunk, oggi)
+        stats["utenti"] += len(chunk)
+
+    return stats
+
+
+async def run_forever(store, interval: float, shard: int = 0, shards: int = 1):
+    """Ripete run_sweep ogni `interval` secondi (dall'inizio del giro precedente)"""
+    while True:
+        started = time.monotonic()
+        try:
+            stats = await run_sweep(store, shard=shard, shards=shards)
+            logger.info(
+                f"Sweep notifiche shard {shard}/{shards}: {stats['utenti']} utenti, "
+                f"{stats['notifiche']} notifiche in {time.monotonic() - started:.1f}s"
+            )
+        except Exception as e:
+            logger.error(f"Sweep notifiche shard {shard}/{shards} fallito: {e}")
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+
+async def _main(argv: Optional[list] = None):
+    import os
+    from pathlib import Path
+    from dotenv import load_dotenv
+
+    import events
+    import notifications
+    import storage
+
+    parser = argparse.ArgumentParser(description="Valutazione periodica delle notifiche")
+    parser.add_argument("--once", action="store_true", help="Un solo giro e poi esce")
+    parser.add_argument("--interval", type=float, default=900, help="Secondi tra un giro e il successivo")
+    parser.add_argument("--shard", type=int, default=0, help="Indice di questo worker (0..shards-1)")
+    parser.add_argument("--shards", type=int, default=1, help="Numero totale di worker")
+    args = parser.parse_args(argv)
+    if not 0 <= args.shard < args.shards:
+        parser.error("--shard deve essere compreso tra 0 e --shards - 1")
+
+    load_dotenv(Path(__file__).parent / '.env')
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    store = storage.create_storage(
+        os.environ.get('STORAGE_BACKEND', 'mongo'),
+        mongo_url=os.environ.get('MONGO_URL'),
+        db_name=os.environ.get('DB_NAME'),
+        sqlite_path=os.environ.get('SQLITE_PATH', str(Path(__file__).parent / 'balance.db'))
+    )
+
+    # Con EVENT_BACKEND=mongo le nuove notifiche arrivano anche ai client connessi al server
+    broker = None
+    if os.environ.get('EVENT_BACKEND', 'memory') == 'mongo':
+        broker = events.create_broker(store.db, 'mongo', watch=False)
+        await broker.start()
+        events.set_broker(broker)
+
+    dispatcher = notifications.PushDispatcher(store)
+    dispatcher.start()
+    notifications.set_push_dispatcher(dispatcher)
+    try:
+        if args.once:
+            stats = await run_sweep(store, shard=args.shard, shards=args.shards)
+            print(f"✅ {stats['utenti']} utenti valutati, {stats['notifiche']} notifiche create")
+        else:
+            await run_forever(store, args.interval, args.shard, args.shards)
+    finally:
+        await dispatcher.stop()
+        if broker is not None:
+            await broker.stop()
+        await store.close()
+
+
+__all__ = ['shard_of', 'iter_enabled_prefs', 'sweep_chunk', 'run_sweep', 'run_forever']
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -2,9 +2,18 @@
 # Questo modulo gestisce l'invio di notifiche push tramite Firebase Cloud Messaging
 # NOTA: Richiede configurazione Firebase (vedi FIREBASE_SETUP.md)
 
+import asyncio
 import os
-from datetime import datetime, timezone
-from typing import Optional
+import random
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+import events
+import ledger
+from forecasting import annotate_materiali
 
 # Firebase Admin SDK (da installare quando necessario)
 # pip install firebase-admin
@@ -31,12 +40,469 @@ except Exception as e:
     print(f"⚠️  Errore configurazione Firebase: {e}")
 
 
+# Limite FCM per una singola chiamata batch
+FCM_BATCH_SIZE = 500
+
+# Una notifica non letta dello stesso tipo e soggetto blocca i duplicati per queste ore
+DEDUP_HOURS = float(os.environ.get('NOTIFICHE_DEDUP_HOURS', '24'))
+
+# Esiti di invio di un messaggio push (None = consegnato)
+PUSH_TOKEN_NON_VALIDO = "token_non_valido"
+PUSH_TEMPORANEO = "temporaneo"
+
+
+def _classify_fcm_error(exception) -> str:
+    """Token non valido, errore temporaneo (da ritentare) o altro codice"""
+    if isinstance(exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+        return PUSH_TOKEN_NON_VALIDO
+    from firebase_admin import exceptions
+    if isinstance(exception, (
+        messaging.QuotaExceededError,
+        exceptions.UnavailableError,
+        exceptions.InternalError,
+        exceptions.DeadlineExceededError
+    )):
+        return PUSH_TEMPORANEO
+    return getattr(exception, "code", None) or str(exception)
+
+
+class FirebasePushSender:
+    """Invio push tramite FCM, fino a 500 messaggi per chiamata"""
+
+    def send_batch(self, messages: List[dict]) -> List[Optional[str]]:
+        """
+        Args:
+            messages: [{"token", "title", "body"}]
+
+        Returns:
+            list: None per ogni messaggio consegnato, altrimenti PUSH_TOKEN_NON_VALIDO,
+            PUSH_TEMPORANEO o il codice di errore FCM
+        """
+        results = []
+        for start in range(0, len(messages), FCM_BATCH_SIZE):
+            chunk = [
+                messaging.Message(
+                    notification=messaging.Notification(title=m["title"], body=m["body"]),
+                    token=m["token"]
+                )
+                for m in messages[start:start + FCM_BATCH_SIZE]
+            ]
+            # send_each da firebase-admin 6.2, send_all nelle versioni precedenti
+            send = getattr(messaging, "send_each", None) or messaging.send_all
+            batch = send(chunk)
+            for response in batch.responses:
+                if response.success:
+                    results.append(None)
+                else:
+                    results.append(_classify_fcm_error(response.exception))
+        return results
+
+
+class StubPushSender:
+    """Sostituto locale di Firebase per i test: registra i messaggi invece di inviarli"""
+
+    def __init__(self, failing_tokens: Optional[Dict[str, str]] = None):
+        self.sent: List[dict] = []
+        self.failing_tokens = failing_tokens or {}
+
+    def send_batch(self, messages: List[dict]) -> List[Optional[str]]:
+        results = [self.failing_tokens.get(m["token"]) for m in messages]
+        self.sent.extend(m for m, r in zip(messages, results) if r is None)
+        return results
+
+
+_push_sender = FirebasePushSender() if FIREBASE_CONFIGURED else None
+
+
+def get_push_sender():
+    return _push_sender
+
+
+def set_push_sender(sender):
+    """Sostituisce il canale push (es. StubPushSender nei test)"""
+    global _push_sender
+    _push_sender = sender
+
+
+class PushDispatcher:
+    """
+    Consegna dei push in background
+
+    Le richieste accodano i messaggi e non aspettano FCM: i worker li
+    raggruppano in batch e chiamano il sender (sincrono) in un thread, così
+    l'event loop non resta bloccato. Gli errori temporanei sono ritentati con
+    backoff esponenziale, i token non più validi vengono rimossi dagli utenti.
+    Se la coda è piena i nuovi messaggi sono scartati: la notifica resta
+    comunque salvata in notifiche.
+
+    Args:
+        queue_size: messaggi massimi in attesa
+        workers: batch inviati in parallelo
+        max_retries: tentativi aggiuntivi per gli errori temporanei
+        backoff_base: secondi di attesa prima del primo nuovo tentativo
+    """
+
+    def __init__(self, store, queue_size: int = 10000, workers: int = 4,
+                 max_retries: int = 3, backoff_base: float = 1.0):
+        self.store = store
+        self.queue_size = queue_size
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.stats = {
+            "accodati": 0, "inviati": 0, "ritentati": 0,
+            "falliti": 0, "scartati": 0, "token_rimossi": 0
+        }
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._retries = set()
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        """Attende lo svuotamento della coda (al massimo `timeout` secondi) e ferma i worker"""
+        if not self.running:
+            return
+        for handle in self._retries:
+            handle.cancel()
+        self._retries.clear()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print(f"⚠️  Push non consegnati allo spegnimento: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def enqueue(self, messages: List[dict]) -> int:
+        """
+        Accoda i messaggi senza attendere
+
+        Returns:
+            int: messaggi accettati
+        """
+        accepted = 0
+        for message in messages:
+            if self._put(message):
+                accepted += 1
+        self.stats["accodati"] += accepted
+        return accepted
+
+    def _put(self, message: dict) -> bool:
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            self.stats["scartati"] += 1
+            return False
+
+    def _retry_later(self, message: dict):
+        tentativi = message.get("tentativi", 0) + 1
+        delay = self.backoff_base * 2 ** (tentativi - 1) * random.uniform(0.5, 1.5)
+        retry = {**message, "tentativi": tentativi}
+
+        def requeue():
+            self._retries.discard(handle)
+            self._put(retry)
+
+        handle = asyncio.get_running_loop().call_later(delay, requeue)
+        self._retries.add(handle)
+        self.stats["ritentati"] += 1
+
+    async def _worker(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < FCM_BATCH_SIZE and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._deliver(batch)
+            except Exception as e:
+                print(f"❌ Errore invio notifiche push: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _deliver(self, batch: List[dict]):
+        sender = get_push_sender()
+        if sender is None:
+            return
+
+        try:
+            results = await asyncio.to_thread(sender.send_batch, batch)
+        except Exception as e:
+            # Errore dell'intera chiamata (rete, autenticazione): tutto da ritentare
+            print(f"⚠️  Invio push fallito, nuovo tentativo: {e}")
+            results = [PUSH_TEMPORANEO] * len(batch)
+
+        dead_tokens = []
+        for message, result in zip(batch, results):
+            if result is None:
+                self.stats["inviati"] += 1
+            elif result == PUSH_TOKEN_NON_VALIDO:
+                dead_tokens.append(message)
+            elif result == PUSH_TEMPORANEO and message.get("tentativi", 0) < self.max_retries:
+                self._retry_later(message)
+            else:
+                self.stats["falliti"] += 1
+
+        if dead_tokens:
+            await self._remove_tokens(dead_tokens)
+
+    async def _remove_tokens(self, messages: List[dict]):
+        # Condizionato sul token: non cancella un token registrato nel frattempo
+        removed = await self.store.remove_fcm_tokens({(m["user_id"], m["token"]) for m in messages})
+        self.stats["token_rimossi"] += removed
+        print(f"🧹 Token FCM non validi rimossi: {removed}")
+
+
+_push_dispatcher: Optional[PushDispatcher] = None
+
+
+def get_push_dispatcher() -> Optional[PushDispatcher]:
+    return _push_dispatcher
+
+
+def set_push_dispatcher(dispatcher: Optional[PushDispatcher]):
+    """Registra il dispatcher avviato dal processo (server o sweeper)"""
+    global _push_dispatcher
+    _push_dispatcher = dispatcher
+
+
+# ============== CONTATORE NON LETTE (MongoDB) ==============
+# contatori_notifiche: {user_id, non_lette}. Gli incrementi creano il
+# contatore se manca ($inc con upsert), "segna tutte lette" lo azzera: nessun
+# percorso di richiesta lo inizializza contando le notifiche, così non c'è
+# una finestra tra conteggio e scrittura in cui un incremento va perso.
+# Gli utenti con notifiche precedenti al contatore si allineano una volta con
+# `python notifications.py --ricalcola-contatori`.
+
+async def increment_unread(db, docs: List[dict]):
+    """+1 al contatore per ogni notifica appena salvata"""
+    per_user: Dict[str, int] = {}
+    for d in docs:
+        per_user[d["user_id"]] = per_user.get(d["user_id"], 0) + 1
+    await db.contatori_notifiche.bulk_write(
+        [
+            UpdateOne({"user_id": user_id}, {"$inc": {"non_lette": n}}, upsert=True)
+            for user_id, n in sorted(per_user.items())
+        ],
+        ordered=False
+    )
+
+
+async def decrement_unread(db, user_id: str, n: int = 1):
+    # Mai sotto zero, in un solo update atomico: un contatore rimasto indietro
+    # non lascia un debito ai prossimi incrementi
+    if n:
+        await db.contatori_notifiche.update_one(
+            {"user_id": user_id},
+            [{"$set": {"non_lette": {"$max": [0, {"$subtract": ["$non_lette", n]}]}}}]
+        )
+
+
+async def get_unread_count(db, user_id: str) -> int:
+    """Notifiche non lette dell'utente (sola lettura)"""
+    contatore = await db.contatori_notifiche.find_one({"user_id": user_id}, {"_id": 0, "non_lette": 1})
+    if contatore is None:
+        # Nessuna notifica dopo l'introduzione del contatore: conta senza scrivere
+        return await db.notifiche.count_documents({"user_id": user_id, "letta": False})
+    return max(0, contatore["non_lette"])
+
+
+async def mark_all_read(db, user_id: str) -> int:
+    """
+    Segna come lette tutte le notifiche dell'utente
+
+    Il contatore scende delle sole notifiche aggiornate: una notifica
+    inserita nel frattempo resta contata.
+
+    Returns:
+        int: notifiche segnate come lette
+    """
+    result = await db.notifiche.update_many(
+        {"user_id": user_id, "letta": False},
+        {"$set": {"letta": True}}
+    )
+    await decrement_unread(db, user_id, result.modified_count)
+    return result.modified_count
+
+
+async def rebuild_unread_counters(db) -> int:
+    """
+    Ricalcola tutti i contatori dalle notifiche non lette (manutenzione)
+
+    Returns:
+        int: contatori scritti
+    """
+    non_lette = {
+        doc["_id"]: doc["n"]
+        async for doc in db.notifiche.aggregate([
+            {"$match": {"letta": False}},
+            {"$group": {"_id": "$user_id", "n": {"$sum": 1}}}
+        ])
+    }
+    # Anche i contatori degli utenti che non hanno più notifiche non lette
+    async for doc in db.contatori_notifiche.find({}, {"_id": 0, "user_id": 1}):
+        non_lette.setdefault(doc["user_id"], 0)
+    if not non_lette:
+        return 0
+    await db.contatori_notifiche.bulk_write(
+        [
+            UpdateOne({"user_id": user_id}, {"$set": {"non_lette": n}}, upsert=True)
+            for user_id, n in sorted(non_lette.items())
+        ],
+        ordered=False
+    )
+    return len(non_lette)
+
+
+def shard_hash(user_id: str) -> int:
+    """
+    Hash stabile dello user_id tra processi e riavvii (hash() di Python non lo è)
+
+    Salvato nelle preferenze come shard_hash: lo sweeper filtra il proprio
+    shard nella query ($mod di shard_hash).
+    """
+    return zlib.crc32(user_id.encode("utf-8"))
+
+
+async def assign_shard_hashes(db) -> int:
+    """
+    Scrive shard_hash nelle preferenze salvate prima del campo (manutenzione)
+
+    Returns:
+        int: preferenze aggiornate
+    """
+    operations = [
+        UpdateOne({"user_id": doc["user_id"]}, {"$set": {"shard_hash": shard_hash(doc["user_id"])}})
+        async for doc in db.notification_preferences.find({"shard_hash": {"$exists": False}}, {"_id": 0, "user_id": 1})
+    ]
+    if not operations:
+        return 0
+    result = await db.notification_preferences.bulk_write(operations, ordered=False)
+    return result.modified_count
+
+
+class NotificationPipeline:
+    """
+    Raccoglie le notifiche candidate e le scrive/invia in blocco
+
+    flush() scarta i duplicati (stesso utente, tipo e soggetto già presente
+    tra le non lette recenti), salva le nuove con una sola scrittura e
+    invia i push con chiamate batch FCM.
+    """
+
+    def __init__(self, store, dedup_hours: float = DEDUP_HOURS):
+        self.store = store
+        self.dedup_hours = dedup_hours
+        self._candidates: Dict[Tuple[str, str, Optional[str]], dict] = {}
+        self._una_volta = set()
+
+    def add(self, user_id: str, tipo: str, soggetto: Optional[str], titolo: str, messaggio: str,
+            una_volta: bool = False):
+        """
+        Aggiunge una candidata
+
+        Args:
+            soggetto: oggetto dell'avviso (materiale, giorno...)
+            una_volta: scarta la candidata anche se la notifica precedente è già stata letta
+        """
+        key = (user_id, tipo, soggetto)
+        self._candidates.setdefault(key, {
+            "user_id": user_id,
+            "tipo": tipo,
+            "soggetto": soggetto,
+            "titolo": titolo,
+            "messaggio": messaggio
+        })
+        if una_volta:
+            self._una_volta.add(key)
+
+    def __len__(self):
+        return len(self._candidates)
+
+    async def _recent_keys(self, user_ids: List[str], tipi: List[str]) -> Tuple[set, set]:
+        """Chiavi delle notifiche recenti: (non lette, tutte)"""
+        since = (datetime.now(timezone.utc) - timedelta(hours=self.dedup_hours)).isoformat()
+        return await self.store.recent_notification_keys(user_ids, tipi, since)
+
+    async def flush(self) -> List[dict]:
+        """
+        Returns:
+            list: notifiche effettivamente salvate
+        """
+        candidates, self._candidates = self._candidates, {}
+        una_volta, self._una_volta = self._una_volta, set()
+        if not candidates:
+            return []
+
+        user_ids = sorted({user_id for user_id, _, _ in candidates})
+        tipi = sorted({tipo for _, tipo, _ in candidates})
+        unread, every = await self._recent_keys(user_ids, tipi)
+
+        now = datetime.now(timezone.utc).isoformat()
+        docs = [
+            {
+                "notifica_id": f"notif_{os.urandom(6).hex()}",
+                **candidate,
+                "letta": False,
+                "created_at": now
+            }
+            for key, candidate in candidates.items()
+            if key not in unread and not (key in una_volta and key in every)
+        ]
+        if not docs:
+            return []
+
+        await self.store.insert_notifiche(docs)
+        await events.publish_many([(d["user_id"], "notifica", d) for d in docs if events.wants(d["user_id"])])
+        await self._send_push(docs)
+        return docs
+
+    async def _send_push(self, docs: List[dict]):
+        sender = get_push_sender()
+        if sender is None:
+            return
+
+        tokens = await self.store.get_fcm_tokens(sorted({d["user_id"] for d in docs}))
+
+        messages = [
+            {"user_id": d["user_id"], "token": tokens[d["user_id"]], "title": d["titolo"], "body": d["messaggio"]}
+            for d in docs if d["user_id"] in tokens
+        ]
+        if not messages:
+            return
+
+        dispatcher = get_push_dispatcher()
+        if dispatcher is not None and dispatcher.running:
+            dispatcher.enqueue(messages)
+            return
+
+        # Nessun dispatcher attivo (script una tantum): invio diretto, fuori dall'event loop
+        try:
+            results = await asyncio.to_thread(sender.send_batch, messages)
+            failed = sum(1 for r in results if r)
+            print(f"✅ Notifiche push inviate: {len(messages) - failed}/{len(messages)}")
+        except Exception as e:
+            print(f"❌ Errore invio notifiche push: {e}")
+
+
 async def send_notification(
     user_id: str,
     title: str,
     body: str,
     notification_type: str,
-    db
+    store,
+    subject: Optional[str] = None
 ) -> bool:
     """
     Invia una notifica push all'utente e salva in database
@@ -46,136 +512,165 @@ async def send_notification(
         title: Titolo notifica
         body: Corpo notifica
         notification_type: Tipo (magazzino, stato, giornata_positiva)
-        db: Database connection
+        store: Backend di storage (vedi storage.py)
+        subject: Oggetto dell'avviso, per scartare i duplicati non letti
     
     Returns:
-        bool: True se inviata con successo
+        bool: True se salvata (False se duplicata)
     """
-    
-    # Salva notifica in-app nel database
-    notifica_doc = {
-        "notifica_id": f"notif_{os.urandom(6).hex()}",
-        "user_id": user_id,
-        "tipo": notification_type,
-        "titolo": title,
-        "messaggio": body,
-        "letta": False,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
-    
-    await db.notifiche.insert_one(notifica_doc.copy())
-    
-    # Se Firebase è configurato, invia push notification
-    if FIREBASE_CONFIGURED:
-        try:
-            # Recupera FCM token dell'utente (se salvato)
-            user_doc = await db.users.find_one(
-                {"user_id": user_id},
-                {"_id": 0, "fcm_token": 1}
-            )
-            
-            if user_doc and user_doc.get("fcm_token"):
-                message = messaging.Message(
-                    notification=messaging.Notification(
-                        title=title,
-                        body=body
-                    ),
-                    token=user_doc["fcm_token"]
-                )
-                
-                messaging.send(message)
-                print(f"✅ Notifica push inviata a {user_id}")
-                return True
-        except Exception as e:
-            print(f"❌ Errore invio notifica push: {e}")
-    
-    # Notifica in-app sempre salvata
-    return True
+    pipeline = NotificationPipeline(store)
+    pipeline.add(user_id, notification_type, subject, title, body)
+    return bool(await pipeline.flush())
+
+
+# Campi dei materiali necessari alla previsione delle scorte (proiezione MongoDB)
+CAMPI_MATERIALE_REGOLE = {
+    "_id": 0, "materiale_id": 1, "user_id": 1, "nome": 1, "quantita_disponibile": 1,
+    "consumo_medio_giornaliero": 1, "giorni_consegna": 1, "consumo_ewma": 1, "consumo_ewma_var": 1,
+    "consumo_ewma_fino_al": 1
+}
+
+
+def evaluate_rules(prefs: dict, materiali: List[dict], totali: Optional[dict], oggi: str) -> List[dict]:
+    """
+    Regole di notifica per un utente
+
+    Args:
+        prefs: preferenze notifiche dell'utente
+        materiali: materiali già annotati con la previsione (annotate_materiali)
+        totali: totali del giorno come da Storage.get_dashboard_totals (None se non servono)
+        oggi: giorno valutato (YYYY-MM-DD)
+
+    Returns:
+        list: candidate {tipo, soggetto, titolo, messaggio, una_volta}
+    """
+    candidates = []
+    if not prefs.get("notifiche_push_enabled"):
+        return candidates
+
+    # 1. Magazzino critico: un avviso per materiale finché resta non letto
+    if prefs.get("notifiche_magazzino"):
+        for m in materiali:
+            if m["stato"] == "ordina_ora":
+                candidates.append({
+                    "tipo": "magazzino",
+                    "soggetto": m["materiale_id"],
+                    "titolo": "🔴 Magazzino Critico",
+                    "messaggio": f"{m['nome']}: ordina ora per evitare fermi operativi",
+                    "una_volta": False
+                })
 
+    if totali is None:
+        return candidates
 
-async def check_and_send_notifications(user_id: str, db):
+    dashboard = ledger.build_dashboard(
+        oggi,
+        totali["totale_entrate"],
+        totali["totale_costi_variabili"],
+        totali["totale_quota_fissi"]
+    )
+    utile = dashboard["utile"]
+
+    # 2. Stato operativo critico: al massimo una volta al giorno
+    if prefs.get("notifiche_stato") and dashboard["stato"] == "critico":
+        candidates.append({
+            "tipo": "stato",
+            "soggetto": oggi,
+            "titolo": "⚠️ Stato Critico",
+            "messaggio": f"Oggi: €{utile:.2f}. Rivedi costi e entrate",
+            "una_volta": True
+        })
+
+    # 3. Giornata positiva: al massimo una volta al giorno
+    if prefs.get("notifiche_giornata_positiva") and dashboard["stato"] == "positivo":
+        candidates.append({
+            "tipo": "giornata_positiva",
+            "soggetto": oggi,
+            "titolo": "🟢 Giornata Positiva",
+            "messaggio": f"Oggi: +€{utile:.2f}. Ottimo lavoro!",
+            "una_volta": True
+        })
+
+    return candidates
+
+
+def add_candidates(pipeline: NotificationPipeline, user_id: str, candidates: List[dict]):
+    for c in candidates:
+        pipeline.add(user_id, c["tipo"], c["soggetto"], c["titolo"], c["messaggio"], una_volta=c["una_volta"])
+
+
+async def check_and_send_notifications(user_id: str, store):
     """
     Controlla condizioni e invia notifiche appropriate
     
     Chiamare questo dopo:
     - Aggiornamento materiali
     - Calcolo dashboard giornaliero
+
+    Per tutti gli utenti insieme usare notification_sweeper.py.
     """
     
     # Verifica preferenze utente
-    prefs = await db.notification_preferences.find_one(
-        {"user_id": user_id},
-        {"_id": 0}
-    )
+    prefs = await store.get_notification_preferences(user_id)
     
     if not prefs or not prefs.get("notifiche_push_enabled"):
         return
     
-    # 1. Check magazzino critico
+    oggi = date.today().isoformat()
+    
+    materiali = []
     if prefs.get("notifiche_magazzino"):
-        materiali_critici = await db.materiali.find(
-            {"user_id": user_id},
-            {"_id": 0}
-        ).to_list(100)
-        
-        for m in materiali_critici:
-            consumo = m.get("consumo_medio_giornaliero", 0)
-            if consumo > 0:
-                giorni_rimasti = m["quantita_disponibile"] / consumo
-                giorni_consegna = m.get("giorni_consegna", 0)
-                
-                if giorni_rimasti <= giorni_consegna:
-                    await send_notification(
-                        user_id=user_id,
-                        title="🔴 Magazzino Critico",
-                        body=f"{m['nome']}: ordina ora per evitare fermi operativi",
-                        notification_type="magazzino",
-                        db=db
-                    )
+        materiali = annotate_materiali(await store.list_materiali_many([user_id]))
     
-    # 2. Check stato operativo
-    if prefs.get("notifiche_stato"):
-        # Calcola dashboard oggi
-        from datetime import date
-        oggi = date.today().isoformat()
-        
-        # Query entrate/costi (semplificato)
-        entrate = await db.entrate.find(
-            {"user_id": user_id, "data": oggi},
-            {"_id": 0}
-        ).to_list(100)
-        
-        costi_var = await db.costi_variabili.find(
-            {"user_id": user_id, "data": oggi},
-            {"_id": 0}
-        ).to_list(100)
-        
-        costi_fissi = await db.costi_fissi.find(
-            {"user_id": user_id},
-            {"_id": 0}
-        ).to_list(100)
-        
-        totale_entrate = sum(e["importo"] for e in entrate)
-        totale_costi_var = sum(c["importo"] for c in costi_var)
-        totale_quota_fissi = sum(c["quota_giornaliera"] for c in costi_fissi)
-        
-        utile = totale_entrate - (totale_costi_var + totale_quota_fissi)
-        
-        if utile < -100:  # Stato critico
-            await send_notification(
-                user_id=user_id,
-                title="⚠️ Stato Critico",
-                body=f"Oggi: €{utile:.2f}. Rivedi costi e entrate",
-                notification_type="stato",
-                db=db
-            )
+    totali = None
+    if prefs.get("notifiche_stato") or prefs.get("notifiche_giornata_positiva"):
+        totali = await store.get_dashboard_totals(user_id, oggi)
     
-    # 3. Check giornata positiva
-    if prefs.get("notifiche_giornata_positiva"):
-        # Usa stesso calcolo di sopra
-        # (in produzione, ottimizzare per evitare doppia query)
-        pass
+    pipeline = NotificationPipeline(store)
+    add_candidates(pipeline, user_id, evaluate_rules(prefs, materiali, totali, oggi))
+    await pipeline.flush()
 
 
 # Export functions
-__all__ = ['send_notification', 'check_and_send_notifications', 'FIREBASE_CONFIGURED']
+__all__ = [
+    'send_notification', 'check_and_send_notifications', 'FIREBASE_CONFIGURED',
+    'NotificationPipeline', 'FirebasePushSender', 'StubPushSender',
+    'get_push_sender', 'set_push_sender', 'PushDispatcher', 'get_push_dispatcher',
+    'set_push_dispatcher', 'PUSH_TOKEN_NON_VALIDO', 'PUSH_TEMPORANEO',
+    'CAMPI_MATERIALE_REGOLE', 'evaluate_rules', 'add_candidates',
+    'increment_unread', 'decrement_unread', 'get_unread_count', 'mark_all_read',
+    'rebuild_unread_counters', 'shard_hash', 'assign_shard_hashes'
+]
+
+
+async def _main(argv: Optional[list] = None):
+    import argparse
+    from pathlib import Path
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    parser = argparse.ArgumentParser(description="Manutenzione notifiche")
+    parser.add_argument("--ricalcola-contatori", action="store_true",
+                        help="Ricalcola i contatori delle non lette dalle notifiche")
+    parser.add_argument("--assegna-shard", action="store_true",
+                        help="Scrive shard_hash nelle preferenze che non lo hanno")
+    args = parser.parse_args(argv)
+    if not (args.ricalcola_contatori or args.assegna_shard):
+        parser.error("nessuna operazione richiesta")
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if args.ricalcola_contatori:
+            scritti = await rebuild_unread_counters(db)
+            print(f"✅ Contatori notifiche ricalcolati: {scritti}")
+        if args.assegna_shard:
+            scritti = await assign_shard_hashes(db)
+            print(f"✅ Preferenze con shard_hash: {scritti}")
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
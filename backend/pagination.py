@@ -0,0 +1,122 @@
+# Keyset Pagination
+# Paginazione a cursore su (created_at, id) per le liste di entrate e costi,
+# e streaming NDJSON man mano che il backend di storage legge i documenti.
+#
+# Durante il backfill di dates.py created_at può essere una stringa ISO o un
+# datetime: MongoDB ordina tutte le stringhe prima di tutte le date, e il
+# cursore ricorda il tipo per riprendere dal punto giusto.
+
+import base64
+import json
+from datetime import date, datetime
+from typing import AsyncIterator, Optional, Tuple, Union
+
+from pymongo import ASCENDING
+
+import serialization
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+STREAM_BATCH_SIZE = 500
+
+
+def encode_cursor(created_at, doc_id: str) -> str:
+    """Cursore opaco per la pagina successiva"""
+    value = [created_at, doc_id]
+    if isinstance(created_at, datetime):
+        value.append("datetime")
+    raw = json.dumps(value, default=_json_default)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[Union[str, datetime], str]:
+    """
+    Decodifica un cursore prodotto da encode_cursor
+
+    Returns:
+        tuple: (created_at, id); created_at è un datetime se lo era nel documento
+
+    Raises:
+        ValueError: se il cursore non è valido
+    """
+    try:
+        created_at, doc_id, *tipo = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(created_at, str) or not isinstance(doc_id, str):
+            raise ValueError
+        if tipo == ["datetime"]:
+            created_at = datetime.fromisoformat(created_at)
+        elif tipo:
+            raise ValueError
+    except Exception:
+        raise ValueError("Cursore non valido")
+    return created_at, doc_id
+
+
+def keyset_query(query: dict, id_field: str, cursor: Optional[str]) -> dict:
+    """Aggiunge alla query la condizione 'dopo il cursore' su (created_at, id)"""
+    if not cursor:
+        return query
+
+    created_at, doc_id = decode_cursor(cursor)
+    dopo = [
+        {"created_at": {"$gt": created_at}},
+        {"created_at": created_at, id_field: {"$gt": doc_id}}
+    ]
+    if isinstance(created_at, str):
+        # I documenti già convertiti vengono dopo tutte le stringhe
+        dopo.append({"created_at": {"$type": "date"}})
+    return {**query, "$and": query.get("$and", []) + [{"$or": dopo}]}
+
+
+def keyset_sort(id_field: str) -> list:
+    return [("created_at", ASCENDING), (id_field, ASCENDING)]
+
+
+async def fetch_page(collection, query: dict, id_field: str, limit: int, cursor: Optional[str] = None):
+    """
+    Legge una pagina ordinata per (created_at, id)
+
+    Returns:
+        tuple: (documenti, cursore della pagina successiva o None)
+    """
+    docs = await collection.find(
+        keyset_query(query, id_field, cursor),
+        {"_id": 0}
+    ).sort(keyset_sort(id_field)).limit(limit + 1).to_list(limit + 1)
+
+    next_cursor = None
+    if len(docs) > limit:
+        docs = docs[:limit]
+        last = docs[-1]
+        next_cursor = encode_cursor(last["created_at"], last[id_field])
+
+    return docs, next_cursor
+
+
+async def iter_documents(collection, query: dict, id_field: str, cursor: Optional[str] = None) -> AsyncIterator[dict]:
+    """Documenti dopo il cursore in ordine (created_at, id), a batch dal cursore Motor"""
+    mongo_cursor = collection.find(
+        keyset_query(query, id_field, cursor),
+        {"_id": 0}
+    ).sort(keyset_sort(id_field)).batch_size(STREAM_BATCH_SIZE)
+
+    async for doc in mongo_cursor:
+        yield doc
+
+
+async def stream_ndjson(docs: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    """Una riga JSON per documento, man mano che arrivano dal backend di storage"""
+    async for doc in docs:
+        yield serialization.dumps(doc) + b"\n"
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+__all__ = [
+    'NDJSON_MEDIA_TYPE', 'encode_cursor', 'decode_cursor', 'keyset_query',
+    'STREAM_BATCH_SIZE', 'fetch_page', 'iter_documents', 'stream_ndjson'
+]
@@ -0,0 +1,62 @@
+# Password Hashing
+# bcrypt è volutamente lento e CPU-bound: hash e verifica girano su un pool
+# di thread dedicato (bcrypt rilascia il GIL) così il loop di uvicorn resta
+# libero di servire le altre richieste durante un login.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+import metrics
+
+
+class PasswordHasher:
+    """
+    Hash e verifica bcrypt fuori dal loop asyncio
+
+    Args:
+        rounds: cost factor bcrypt per i nuovi hash
+        max_workers: hash/verifiche eseguiti in parallelo; le richieste
+            oltre il limite attendono senza occupare thread
+    """
+
+    def __init__(self, rounds: int = 12, max_workers: int = 4):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _run(self, fn, *args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def hash(self, password: str) -> str:
+        with metrics.time_bcrypt("hash"):
+            hashed = await self._run(
+                bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds)
+            )
+        return hashed.decode('utf-8')
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        with metrics.time_bcrypt("verify"):
+            return await self._run(
+                bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8')
+            )
+
+    def needs_rehash(self, password_hash: str) -> bool:
+        """True se l'hash è stato creato con un cost factor diverso da quello configurato"""
+        try:
+            return int(password_hash.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+__all__ = ['PasswordHasher']
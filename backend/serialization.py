@@ -0,0 +1,56 @@
+# JSON Serialization
+# Serializzazione JSON delle risposte con orjson: liste fino a 1000
+# documenti vengono scritte in una sola chiamata C invece che con
+# jsonable_encoder + json.dumps.
+#
+# FastJSONResponse è la response class di default di api_router. I route
+# che restituiscono liste grandi la istanziano direttamente: così FastAPI
+# salta anche jsonable_encoder e i documenti arrivano a orjson così come
+# escono dallo storage (datetime e date compresi).
+#
+# orjson è opzionale: senza, le stesse funzioni usano json della libreria
+# standard con lo stesso output compatto.
+
+import json
+from datetime import date, datetime
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+def _default(value):
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    # Scalari numpy (forecasting.py) senza OPT_SERIALIZE_NUMPY
+    if hasattr(value, "item") and hasattr(value, "dtype"):
+        return value.item()
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+def dumps(content) -> bytes:
+    """JSON compatto in UTF-8"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializzata con dumps()"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+__all__ = ['ORJSON_AVAILABLE', 'dumps', 'FastJSONResponse']
@@ -1,31 +1,80 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Cookie
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response, Cookie, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional
 import uuid
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
 import asyncio
-import bcrypt
+import hashlib
+import hmac
+
+import bulk_import
+import compression
+import dates
+import events
+import export
+import forecasting
+import insights as insights_ai
+import ledger
+import llm
+import metrics
+import movimenti
+import notification_sweeper
+import notifications
+import pagination
+import serialization
+import storage
+from passwords import PasswordHasher
+from singleflight import SingleFlight
+from session_cache import SessionCache
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Storage backend: "mongo" (default) or "sqlite" for tests and single-shop installs (see storage.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'mongo')
+store = storage.create_storage(
+    STORAGE_BACKEND,
+    mongo_url=os.environ.get('MONGO_URL'),
+    db_name=os.environ.get('DB_NAME'),
+    sqlite_path=os.environ.get('SQLITE_PATH', str(ROOT_DIR / 'balance.db'))
+)
+
+# In-process session cache (see session_cache.py)
+session_cache = SessionCache(
+    max_size=int(os.environ.get('SESSION_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.environ.get('SESSION_CACHE_TTL', '60'))
+)
+
+# bcrypt runs on a bounded thread pool (see passwords.py)
+password_hasher = PasswordHasher(
+    rounds=int(os.environ.get('BCRYPT_ROUNDS', '12')),
+    max_workers=int(os.environ.get('PASSWORD_HASH_WORKERS', '4'))
+)
+
+# Push notifications are delivered by background workers (see notifications.py)
+push_dispatcher = notifications.PushDispatcher(
+    store,
+    queue_size=int(os.environ.get('PUSH_QUEUE_SIZE', '10000')),
+    workers=int(os.environ.get('PUSH_WORKERS', '4')),
+    max_retries=int(os.environ.get('PUSH_MAX_RETRIES', '3')),
+    backoff_base=float(os.environ.get('PUSH_BACKOFF_SECONDS', '1'))
+)
+
+# Live events for /api/eventi: "memory" (single process) or "mongo" (change streams, mongo storage only)
+event_broker = events.create_broker(store.db, os.environ.get('EVENT_BACKEND', 'memory'))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get('EVENT_HEARTBEAT_SECONDS', '15'))
 
 # Create the main app without a prefix
 app = FastAPI()
 
 # Create a router with the /api prefix
-api_router = APIRouter(prefix="/api")
+api_router = APIRouter(prefix="/api", default_response_class=serialization.FastJSONResponse)
 
 # ============== MODELS ==============
 
@@ -84,6 +133,21 @@ class Materiale(BaseModel):
     consumo_medio_giornaliero: Optional[float] = 0
     giorni_consegna: Optional[int] = 0
     costo_unitario: Optional[float] = 0
+    # Consumo stimato dai movimenti (see movimenti.py)
+    consumo_ewma: Optional[float] = None
+    consumo_ewma_var: Optional[float] = None
+    created_at: datetime
+
+class MovimentoMateriale(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    movimento_id: str
+    materiale_id: str
+    user_id: str
+    tipo: str
+    quantita: float
+    quantita_dopo: float
+    note: Optional[str] = None
+    data: str
     created_at: datetime
 
 class Notifica(BaseModel):
@@ -91,6 +155,7 @@ class Notifica(BaseModel):
     notifica_id: str
     user_id: str
     tipo: str
+    soggetto: Optional[str] = None
     titolo: str
     messaggio: str
     letta: bool = False
@@ -103,6 +168,8 @@ class InsightAI(BaseModel):
     data: str
     tipo: str
     contenuto: str
+    fallback: bool = False
+    expires_at: Optional[datetime] = None
     created_at: datetime
 
 # ============== INPUT MODELS ==============
@@ -128,12 +195,12 @@ class CostoFissoInput(BaseModel):
 class CostoVariabileInput(BaseModel):
     descrizione: str
     importo: float
-    data: str
+    data: date
 
 class EntrataInput(BaseModel):
     descrizione: str
     importo: float
-    data: str
+    data: date
     tipo: str = "registrata"
 
 class MaterialeInput(BaseModel):
@@ -160,17 +227,24 @@ class MaterialeUpdate(BaseModel):
     fornitore_telefono: Optional[str] = None
     fornitore_sito: Optional[str] = None
 
+class MovimentoInput(BaseModel):
+    tipo: str
+    quantita: float
+    note: Optional[str] = None
+
 # ============== HELPER FUNCTIONS ==============
 
+MAX_PAGE_SIZE = 5000
+
+BULK_IMPORT_MAX_ROWS = int(os.environ.get('BULK_IMPORT_MAX_ROWS', '10000'))
+BULK_IMPORT_MAX_BYTES = int(os.environ.get('BULK_IMPORT_MAX_BYTES', str(5 * 1024 * 1024)))
+
 async def get_session_from_cookie(session_token: Optional[str]) -> Optional[dict]:
     """Get session from cookie or Authorization header"""
     if not session_token:
         return None
     
-    session_doc = await db.user_sessions.find_one(
-        {"session_token": session_token},
-        {"_id": 0}
-    )
+    session_doc = await store.get_session(session_token)
     
     if not session_doc:
         return None
@@ -185,8 +259,16 @@ async def get_session_from_cookie(session_token: Optional[str]) -> Optional[dict
     if expires_at < datetime.now(timezone.utc):
         return None
     
+    session_doc["expires_at"] = expires_at
     return session_doc
 
+def user_from_doc(user_doc: dict) -> User:
+    """Build a User from a users document"""
+    # Older documents store the timestamp as an ISO string (see dates.py)
+    user_doc['created_at'] = dates.to_datetime(user_doc['created_at'])
+    
+    return User(**user_doc)
+
 async def get_current_user(request: Request, session_token: Optional[str] = Cookie(None)) -> User:
     """Get current user from session"""
     # Try cookie first
@@ -196,23 +278,190 @@ async def get_current_user(request: Request, session_token: Optional[str] = Cook
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.split(" ")[1]
     
+    if session_token:
+        cached_user = session_cache.get(session_token)
+        if cached_user is not None:
+            return cached_user
+    
     session_doc = await get_session_from_cookie(session_token)
     if not session_doc:
         raise HTTPException(status_code=401, detail="Non autorizzato")
     
-    user_doc = await db.users.find_one(
-        {"user_id": session_doc["user_id"]},
-        {"_id": 0}
-    )
+    user_doc = await store.get_user(session_doc["user_id"])
     
     if not user_doc:
         raise HTTPException(status_code=404, detail="Utente non trovato")
     
-    # Convert timestamp if needed
-    if isinstance(user_doc.get('created_at'), str):
-        user_doc['created_at'] = datetime.fromisoformat(user_doc['created_at'])
+    await record_last_seen(user_doc)
+    user = user_from_doc(user_doc)
+    session_cache.put(session_token, user, session_doc["expires_at"])
+    return user
+
+# last_seen_at drives insights_batch.py: at most one write per user per day
+LAST_SEEN_RESOLUTION = timedelta(days=1)
+
+async def record_last_seen(user_doc: dict):
+    """Refresh users.last_seen_at when the stored value is older than LAST_SEEN_RESOLUTION"""
+    now = datetime.now(timezone.utc)
+    last_seen = user_doc.get("last_seen_at")
+    if last_seen is None or now - dates.to_datetime(last_seen) >= LAST_SEEN_RESOLUTION:
+        await store.update_user(user_doc["user_id"], {"last_seen_at": now})
+
+def build_entrata_doc(user_id: str, input: EntrataInput) -> dict:
+    return {
+        "entrata_id": f"ent_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "descrizione": input.descrizione,
+        "importo": input.importo,
+        "data": input.data.isoformat(),
+        "tipo": input.tipo,
+        "created_at": datetime.now(timezone.utc)
+    }
+
+def build_costo_variabile_doc(user_id: str, input: CostoVariabileInput) -> dict:
+    return {
+        "costo_id": f"cv_{uuid.uuid4().hex[:12]}",
+        "user_id": user_id,
+        "descrizione": input.descrizione,
+        "importo": input.importo,
+        "data": input.data.isoformat(),
+        "created_at": datetime.now(timezone.utc)
+    }
+
+async def read_limited_body(request: Request, max_bytes: int) -> bytes:
+    """Request body, answering 413 as soon as it exceeds max_bytes"""
+    troppo_grande = HTTPException(status_code=413, detail=f"Massimo {max_bytes} byte per importazione")
+    try:
+        declared = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Content-Length non valido")
+    if declared > max_bytes:
+        raise troppo_grande
+    
+    # Chunked uploads carry no Content-Length: count the bytes as they arrive
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise troppo_grande
+    return bytes(body)
+
+async def import_ledger_rows(request: Request, user: User, input_model, build_doc, collezione: str) -> dict:
+    """Validate, insert and aggregate a CSV/JSON bulk upload, reporting per-row errors"""
+    body = await read_limited_body(request, BULK_IMPORT_MAX_BYTES)
+    try:
+        rows = bulk_import.parse_rows(body, request.headers.get("content-type", ""), max_rows=BULK_IMPORT_MAX_ROWS)
+    except bulk_import.TooManyRowsError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    valid, errori = bulk_import.validate_rows(rows, input_model)
+    docs = [(riga, build_doc(user.user_id, input)) for riga, input in valid]
+    
+    inserted, write_errors = await store.insert_ledger_many(collezione, user.user_id, docs)
+    if inserted:
+        await bump_versions(user.user_id, "dashboard")
+    await publish_dashboard(user.user_id, [doc["data"] for doc in inserted])
+    
+    errori = sorted(errori + write_errors, key=lambda e: e["riga"])
+    return {
+        "totale_righe": len(rows),
+        "inseriti": len(inserted),
+        "errori": errori
+    }
+
+async def publish_dashboard(user_id: str, giorni: list):
+    """Push the updated day totals to the user's live connections (see events.py)"""
+    if not events.wants(user_id):
+        return
+    dashboards = [await store.get_dashboard(user_id, data) for data in sorted(set(giorni))]
+    await events.publish_many([(user_id, "dashboard", d) for d in dashboards])
+
+async def publish_materiale(user_id: str, materiale_id: str, azione: str, materiale: Optional[dict] = None):
+    """Push a materiale change, with its stock forecast, to the user's live connections"""
+    if not events.wants(user_id):
+        return
+    if materiale is None and azione != "eliminato":
+        materiale = await store.get_materiale(user_id, materiale_id)
+    if materiale is not None:
+        materiale = forecasting.annotate_materiali([dict(materiale)])[0]
+    await events.publish(user_id, "materiali", {
+        "azione": azione,
+        "materiale_id": materiale_id,
+        "materiale": materiale
+    })
+
+def etag_headers(etag: str) -> dict:
+    return {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+        "Vary": "Cookie, Authorization"
+    }
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the client's If-None-Match already names this ETag (weak comparison)"""
+    if_none_match = request.headers.get("if-none-match", "")
+    # Compressed responses carry the weak form of the ETag (see compression.py)
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag.removeprefix("W/") in tags or if_none_match.strip() == "*"
+
+def conditional_json_response(request: Request, content, etag: str) -> Response:
+    """JSON response with an ETag, or an empty 304 if the client already has it"""
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    return serialization.FastJSONResponse(content=content, headers=etag_headers(etag))
+
+async def version_etag(user_id: str, risorsa: str, *extra: str) -> str:
+    """
+    Strong ETag from the user's version counter for a read endpoint
+    
+    Only the counters are read, so a 304 never touches the underlying
+    collections. `extra` covers inputs the counter does not track, such as
+    the requested day or today's date for the stock forecast.
+    """
+    versioni = await store.get_versions(user_id)
+    chiave = ":".join([user_id, versioni["epoca"], risorsa, str(versioni[risorsa]), *extra])
+    return f'"{hashlib.sha256(chiave.encode("utf-8")).hexdigest()[:32]}"'
+
+async def bump_versions(user_id: str, *risorse: str):
+    """Invalidate the ETags of the read endpoints a write has changed"""
+    await store.bump_versions(user_id, list(risorse))
+
+async def list_ledger_documents(collezione: str, user_id: str, data: Optional[str], limit: int, cursor: Optional[str], format: str,
+                                from_: Optional[str] = None, to: Optional[str] = None):
+    """Serve a ledger list as a keyset page (next cursor in X-Next-Cursor) or as an NDJSON stream"""
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="Formato non valido (json, ndjson)")
+    
+    try:
+        giorno = dates.parse_data(data) if data else None
+        dal = dates.parse_data(from_) if from_ else None
+        al = dates.parse_data(to) if to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato data non valido (YYYY-MM-DD)")
+    
+    if dal and al and al < dal:
+        raise HTTPException(status_code=400, detail="Intervallo di date non valido")
+    
+    try:
+        if cursor:
+            pagination.decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if format == "ndjson":
+        return StreamingResponse(
+            pagination.stream_ndjson(store.iter_ledger(collezione, user_id, giorno, cursor, dal, al)),
+            media_type=pagination.NDJSON_MEDIA_TYPE
+        )
     
-    return User(**user_doc)
+    docs, next_cursor = await store.list_ledger(collezione, user_id, giorno, limit, cursor, dal, al)
+    # Returned directly: up to MAX_PAGE_SIZE documents skip jsonable_encoder
+    return serialization.FastJSONResponse(
+        content=docs,
+        headers={"X-Next-Cursor": next_cursor} if next_cursor else None
+    )
 
 # ============== AUTH ROUTES ==============
 
@@ -220,12 +469,12 @@ async def get_current_user(request: Request, session_token: Optional[str] = Cook
 async def register(input: RegisterInput, response: Response):
     """Register new user with email and password"""
     # Check if user already exists
-    existing_user = await db.users.find_one({"email": input.email}, {"_id": 0})
+    existing_user = await store.get_user_by_email(input.email)
     if existing_user:
         raise HTTPException(status_code=400, detail="Utente già registrato con questa email")
     
     # Hash password
-    hashed_password = bcrypt.hashpw(input.password.encode('utf-8'), bcrypt.gensalt())
+    hashed_password = await password_hasher.hash(input.password)
     
     # Create new user
     user_id = f"user_{uuid.uuid4().hex[:12]}"
@@ -233,18 +482,18 @@ async def register(input: RegisterInput, response: Response):
         "user_id": user_id,
         "email": input.email,
         "name": input.name,
-        "password_hash": hashed_password.decode('utf-8'),
+        "password_hash": hashed_password,
         "picture": None,
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "created_at": datetime.now(timezone.utc),
         "subscription_tier": "free",
         "auth_method": "email"
     }
     
-    await db.users.insert_one(user_doc.copy())
+    await store.insert_user(user_doc)
     
     # Create session
     session_token = f"sess_{uuid.uuid4().hex}"
-    await db.user_sessions.insert_one({
+    await store.insert_session({
         "user_id": user_id,
         "session_token": session_token,
         "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
@@ -263,7 +512,7 @@ async def register(input: RegisterInput, response: Response):
     )
     
     # Check if user has profile
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+    profile = await store.get_profile(user_id)
     
     return {
         "user": {
@@ -280,19 +529,25 @@ async def register(input: RegisterInput, response: Response):
 async def login(input: LoginInput, response: Response):
     """Login with email and password"""
     # Find user
-    user_doc = await db.users.find_one({"email": input.email}, {"_id": 0})
+    user_doc = await store.get_user_by_email(input.email)
     if not user_doc or user_doc.get("auth_method") != "email":
         raise HTTPException(status_code=401, detail="Email o password non corretti")
     
     # Verify password
-    if not bcrypt.checkpw(input.password.encode('utf-8'), user_doc["password_hash"].encode('utf-8')):
+    if not await password_hasher.verify(input.password, user_doc["password_hash"]):
         raise HTTPException(status_code=401, detail="Email o password non corretti")
     
     user_id = user_doc["user_id"]
     
+    # Rehash transparently when BCRYPT_ROUNDS changed
+    if password_hasher.needs_rehash(user_doc["password_hash"]):
+        await store.replace_password_hash(
+            user_id, user_doc["password_hash"], await password_hasher.hash(input.password)
+        )
+    
     # Create session
     session_token = f"sess_{uuid.uuid4().hex}"
-    await db.user_sessions.insert_one({
+    await store.insert_session({
         "user_id": user_id,
         "session_token": session_token,
         "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
@@ -311,7 +566,7 @@ async def login(input: LoginInput, response: Response):
     )
     
     # Check if user has profile
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+    profile = await store.get_profile(user_id)
     
     return {
         "user": {
@@ -349,7 +604,7 @@ async def process_session(request: Request, response: Response):
             raise HTTPException(status_code=500, detail=f"Errore autenticazione: {str(e)}")
     
     # Check if user exists
-    user_doc = await db.users.find_one({"email": auth_data["email"]}, {"_id": 0})
+    user_doc = await store.get_user_by_email(auth_data["email"])
     
     if not user_doc:
         # Create new user
@@ -359,24 +614,23 @@ async def process_session(request: Request, response: Response):
             "email": auth_data["email"],
             "name": auth_data["name"],
             "picture": auth_data.get("picture"),
-            "created_at": datetime.now(timezone.utc).isoformat(),
+            "created_at": datetime.now(timezone.utc),
             "subscription_tier": "free"
         }
-        await db.users.insert_one(user_doc.copy())
+        await store.insert_user(user_doc)
     else:
         user_id = user_doc["user_id"]
         # Update user data
-        await db.users.update_one(
-            {"user_id": user_id},
-            {"$set": {
-                "name": auth_data["name"],
-                "picture": auth_data.get("picture")
-            }}
-        )
+        await store.update_user(user_id, {
+            "name": auth_data["name"],
+            "picture": auth_data.get("picture")
+        })
+        session_cache.invalidate_user(user_id)
+        await bump_versions(user_id, "profile")
     
     # Create session
     session_token = auth_data["session_token"]
-    await db.user_sessions.insert_one({
+    await store.insert_session({
         "user_id": user_id,
         "session_token": session_token,
         "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
@@ -395,7 +649,7 @@ async def process_session(request: Request, response: Response):
     )
     
     # Check if user has profile
-    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+    profile = await store.get_profile(user_id)
     
     return {
         "user": {
@@ -414,7 +668,7 @@ async def get_me(request: Request, session_token: Optional[str] = Cookie(None)):
     user = await get_current_user(request, session_token)
     
     # Check if user has profile
-    profile = await db.user_profiles.find_one({"user_id": user.user_id}, {"_id": 0})
+    profile = await store.get_profile(user.user_id)
     
     return {
         "user": user.model_dump(),
@@ -425,7 +679,8 @@ async def get_me(request: Request, session_token: Optional[str] = Cookie(None)):
 async def logout(request: Request, response: Response, session_token: Optional[str] = Cookie(None)):
     """Logout user"""
     if session_token:
-        await db.user_sessions.delete_many({"session_token": session_token})
+        await store.delete_session(session_token)
+        session_cache.invalidate_token(session_token)
     
     response.delete_cookie("session_token", path="/")
     return {"message": "Logout effettuato"}
@@ -438,7 +693,7 @@ async def complete_onboarding(request: Request, input: OnboardingInput, session_
     user = await get_current_user(request, session_token)
     
     # Check if profile already exists
-    existing = await db.user_profiles.find_one({"user_id": user.user_id}, {"_id": 0})
+    existing = await store.get_profile(user.user_id)
     if existing:
         raise HTTPException(status_code=400, detail="Profilo già esistente")
     
@@ -450,25 +705,25 @@ async def complete_onboarding(request: Request, input: OnboardingInput, session_
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.user_profiles.insert_one(profile_doc.copy())
-    # Return profile without MongoDB _id
-    profile_doc.pop('_id', None)
+    await store.insert_profile(profile_doc)
+    await bump_versions(user.user_id, "profile")
     return {"message": "Onboarding completato", "profile": profile_doc}
 
 @api_router.get("/profile")
 async def get_profile(request: Request, session_token: Optional[str] = Cookie(None)):
-    """Get user profile"""
+    """Get user profile; answers 304 while nothing in it has changed"""
     user = await get_current_user(request, session_token)
     
-    profile = await db.user_profiles.find_one({"user_id": user.user_id}, {"_id": 0})
+    etag = await version_etag(user.user_id, "profile")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    
+    profile = await store.get_profile(user.user_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profilo non trovato")
     
     # Get notification preferences
-    notif_prefs = await db.notification_preferences.find_one(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    )
+    notif_prefs = await store.get_notification_preferences(user.user_id)
     
     if not notif_prefs:
         # Create default preferences
@@ -480,13 +735,13 @@ async def get_profile(request: Request, session_token: Optional[str] = Cookie(No
             "notifiche_giornata_positiva": True,
             "created_at": datetime.now(timezone.utc).isoformat()
         }
-        await db.notification_preferences.insert_one(notif_prefs.copy())
+        await store.insert_notification_preferences(notif_prefs)
     
-    return {
+    return conditional_json_response(request, {
         "user": user.model_dump(),
         "profile": profile,
         "notification_preferences": notif_prefs
-    }
+    }, etag)
 
 @api_router.patch("/profile/notifications")
 async def update_notification_preferences(request: Request, session_token: Optional[str] = Cookie(None)):
@@ -495,11 +750,8 @@ async def update_notification_preferences(request: Request, session_token: Optio
     data = await request.json()
     
     # Update preferences
-    await db.notification_preferences.update_one(
-        {"user_id": user.user_id},
-        {"$set": data},
-        upsert=True
-    )
+    await store.update_notification_preferences(user.user_id, data)
+    await bump_versions(user.user_id, "profile")
     
     return {"message": "Preferenze aggiornate"}
 
@@ -507,68 +759,61 @@ async def update_notification_preferences(request: Request, session_token: Optio
 
 @api_router.get("/dashboard")
 async def get_dashboard(request: Request, data: str, session_token: Optional[str] = Cookie(None)):
-    """Get dashboard data for a specific date"""
+    """Get dashboard data for a specific date; answers 304 while the ledger is unchanged"""
     user = await get_current_user(request, session_token)
     
-    # Get entrate for the day
-    entrate = await db.entrate.find(
-        {"user_id": user.user_id, "data": data},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    totale_entrate = sum(e["importo"] for e in entrate)
-    
-    # Get costi variabili for the day
-    costi_var = await db.costi_variabili.find(
-        {"user_id": user.user_id, "data": data},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    totale_costi_var = sum(c["importo"] for c in costi_var)
+    etag = await version_etag(user.user_id, "dashboard", data)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    
+    return conditional_json_response(request, await store.get_dashboard(user.user_id, data), etag)
+
+@api_router.get("/dashboard/range")
+async def get_dashboard_range(
+    request: Request,
+    from_: str = Query(..., alias="from"),
+    to: str = Query(...),
+    granularity: str = "day",
+    session_token: Optional[str] = Cookie(None)
+):
+    """Get dashboard series between two dates (inclusive)"""
+    user = await get_current_user(request, session_token)
     
-    # Get costi fissi (quota giornaliera)
-    costi_fissi = await db.costi_fissi.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).to_list(1000)
+    if granularity not in ledger.GRANULARITA:
+        raise HTTPException(status_code=400, detail="Granularità non valida (day, week, month)")
     
-    totale_quota_fissi = sum(c["quota_giornaliera"] for c in costi_fissi)
+    try:
+        dal = date.fromisoformat(from_)
+        al = date.fromisoformat(to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato data non valido (YYYY-MM-DD)")
     
-    # Calculate utile
-    totale_costi = totale_costi_var + totale_quota_fissi
-    utile = totale_entrate - totale_costi
+    if al < dal:
+        raise HTTPException(status_code=400, detail="Intervallo di date non valido")
+    if (al - dal).days + 1 > ledger.MAX_GIORNI_RANGE:
+        raise HTTPException(status_code=400, detail=f"Intervallo massimo {ledger.MAX_GIORNI_RANGE} giorni")
     
-    # Determine stato
-    if utile > 0:
-        stato = "positivo"
-    elif utile >= -100:
-        stato = "attenzione"
-    else:
-        stato = "critico"
+    serie = await store.get_dashboard_range(user.user_id, dal, al, granularity)
     
     return {
-        "data": data,
-        "utile": round(utile, 2),
-        "entrate": round(totale_entrate, 2),
-        "costi": round(totale_costi, 2),
-        "costi_variabili": round(totale_costi_var, 2),
-        "quota_fissi": round(totale_quota_fissi, 2),
-        "stato": stato
+        "from": dal.isoformat(),
+        "to": al.isoformat(),
+        "granularity": granularity,
+        "serie": serie
     }
 
 # ============== COSTI ROUTES ==============
 
 @api_router.get("/costi/fissi")
 async def get_costi_fissi(request: Request, session_token: Optional[str] = Cookie(None)):
-    """Get all fixed costs"""
+    """Get all fixed costs; answers 304 while they are unchanged"""
     user = await get_current_user(request, session_token)
     
-    costi = await db.costi_fissi.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).to_list(1000)
+    etag = await version_etag(user.user_id, "costi_fissi")
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
     
-    return costi
+    return conditional_json_response(request, await store.list_costi_fissi(user.user_id), etag)
 
 @api_router.post("/costi/fissi")
 async def create_costo_fisso(request: Request, input: CostoFissoInput, session_token: Optional[str] = Cookie(None)):
@@ -584,9 +829,9 @@ async def create_costo_fisso(request: Request, input: CostoFissoInput, session_t
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.costi_fissi.insert_one(costo_doc.copy())
-    # Return document without MongoDB _id
-    costo_doc.pop('_id', None)
+    await store.insert_costo_fisso(costo_doc)
+    await bump_versions(user.user_id, "costi_fissi", "dashboard")
+    await publish_dashboard(user.user_id, [date.today().isoformat()])
     return costo_doc
 
 @api_router.delete("/costi/fissi/{costo_id}")
@@ -594,131 +839,178 @@ async def delete_costo_fisso(request: Request, costo_id: str, session_token: Opt
     """Delete fixed cost"""
     user = await get_current_user(request, session_token)
     
-    result = await db.costi_fissi.delete_one({"costo_id": costo_id, "user_id": user.user_id})
-    if result.deleted_count == 0:
+    deleted = await store.delete_costo_fisso(user.user_id, costo_id)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Costo non trovato")
     
+    await bump_versions(user.user_id, "costi_fissi", "dashboard")
+    await publish_dashboard(user.user_id, [date.today().isoformat()])
+    
     return {"message": "Costo eliminato"}
 
 @api_router.get("/costi/variabili")
-async def get_costi_variabili(request: Request, data: Optional[str] = None, session_token: Optional[str] = Cookie(None)):
-    """Get variable costs"""
+async def get_costi_variabili(
+    request: Request,
+    data: Optional[str] = None,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: str = "json",
+    session_token: Optional[str] = Cookie(None)
+):
+    """Get variable costs for a day or a from/to range (keyset paginated, or streamed as NDJSON)"""
     user = await get_current_user(request, session_token)
     
-    query = {"user_id": user.user_id}
-    if data:
-        query["data"] = data
-    
-    costi = await db.costi_variabili.find(query, {"_id": 0}).to_list(1000)
-    return costi
+    return await list_ledger_documents("costi_variabili", user.user_id, data, limit, cursor, format, from_, to)
 
 @api_router.post("/costi/variabili")
 async def create_costo_variabile(request: Request, input: CostoVariabileInput, session_token: Optional[str] = Cookie(None)):
     """Create variable cost"""
     user = await get_current_user(request, session_token)
     
-    costo_doc = {
-        "costo_id": f"cv_{uuid.uuid4().hex[:12]}",
-        "user_id": user.user_id,
-        "descrizione": input.descrizione,
-        "importo": input.importo,
-        "data": input.data,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    costo_doc = build_costo_variabile_doc(user.user_id, input)
     
-    await db.costi_variabili.insert_one(costo_doc.copy())
-    # Return document without MongoDB _id
-    costo_doc.pop('_id', None)
+    await store.insert_ledger("costi_variabili", costo_doc)
+    await bump_versions(user.user_id, "dashboard")
+    await publish_dashboard(user.user_id, [costo_doc["data"]])
     return costo_doc
 
+@api_router.post("/costi/variabili/bulk")
+async def import_costi_variabili(request: Request, session_token: Optional[str] = Cookie(None)):
+    """Bulk import variable costs from CSV or a JSON array"""
+    user = await get_current_user(request, session_token)
+    
+    return await import_ledger_rows(
+        request, user, CostoVariabileInput, build_costo_variabile_doc, "costi_variabili"
+    )
+
 @api_router.delete("/costi/variabili/{costo_id}")
 async def delete_costo_variabile(request: Request, costo_id: str, session_token: Optional[str] = Cookie(None)):
     """Delete variable cost"""
     user = await get_current_user(request, session_token)
     
-    result = await db.costi_variabili.delete_one({"costo_id": costo_id, "user_id": user.user_id})
-    if result.deleted_count == 0:
+    deleted = await store.delete_ledger("costi_variabili", user.user_id, costo_id)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Costo non trovato")
     
+    await bump_versions(user.user_id, "dashboard")
+    await publish_dashboard(user.user_id, [deleted["data"]])
+    
     return {"message": "Costo eliminato"}
 
 # ============== ENTRATE ROUTES ==============
 
 @api_router.get("/entrate")
-async def get_entrate(request: Request, data: Optional[str] = None, session_token: Optional[str] = Cookie(None)):
-    """Get entrate"""
+async def get_entrate(
+    request: Request,
+    data: Optional[str] = None,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: str = "json",
+    session_token: Optional[str] = Cookie(None)
+):
+    """Get entrate for a day or a from/to range (keyset paginated, or streamed as NDJSON)"""
     user = await get_current_user(request, session_token)
     
-    query = {"user_id": user.user_id}
-    if data:
-        query["data"] = data
-    
-    entrate = await db.entrate.find(query, {"_id": 0}).to_list(1000)
-    return entrate
+    return await list_ledger_documents("entrate", user.user_id, data, limit, cursor, format, from_, to)
 
 @api_router.post("/entrate")
 async def create_entrata(request: Request, input: EntrataInput, session_token: Optional[str] = Cookie(None)):
     """Create entrata"""
     user = await get_current_user(request, session_token)
     
-    entrata_doc = {
-        "entrata_id": f"ent_{uuid.uuid4().hex[:12]}",
-        "user_id": user.user_id,
-        "descrizione": input.descrizione,
-        "importo": input.importo,
-        "data": input.data,
-        "tipo": input.tipo,
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    entrata_doc = build_entrata_doc(user.user_id, input)
     
-    await db.entrate.insert_one(entrata_doc.copy())
-    # Return document without MongoDB _id
-    entrata_doc.pop('_id', None)
+    await store.insert_ledger("entrate", entrata_doc)
+    await bump_versions(user.user_id, "dashboard")
+    await publish_dashboard(user.user_id, [entrata_doc["data"]])
     return entrata_doc
 
+@api_router.post("/entrate/bulk")
+async def import_entrate(request: Request, session_token: Optional[str] = Cookie(None)):
+    """Bulk import entrate from CSV or a JSON array"""
+    user = await get_current_user(request, session_token)
+    
+    return await import_ledger_rows(
+        request, user, EntrataInput, build_entrata_doc, "entrate"
+    )
+
 @api_router.delete("/entrate/{entrata_id}")
 async def delete_entrata(request: Request, entrata_id: str, session_token: Optional[str] = Cookie(None)):
     """Delete entrata"""
     user = await get_current_user(request, session_token)
     
-    result = await db.entrate.delete_one({"entrata_id": entrata_id, "user_id": user.user_id})
-    if result.deleted_count == 0:
+    deleted = await store.delete_ledger("entrate", user.user_id, entrata_id)
+    if not deleted:
         raise HTTPException(status_code=404, detail="Entrata non trovata")
     
+    await bump_versions(user.user_id, "dashboard")
+    await publish_dashboard(user.user_id, [deleted["data"]])
+    
     return {"message": "Entrata eliminata"}
 
+# ============== EXPORT ROUTES ==============
+
+@api_router.get("/export/{collezione}")
+async def export_collezione(
+    request: Request,
+    collezione: str,
+    format: str = "parquet",
+    since: Optional[str] = None,
+    session_token: Optional[str] = Cookie(None)
+):
+    """Stream a collection as Parquet or Arrow IPC; the X-Export-Watermark header is the next `since`"""
+    user = await get_current_user(request, session_token)
+    
+    if not export.PYARROW_AVAILABLE:
+        raise HTTPException(status_code=501, detail="Export non disponibile: pyarrow non installato")
+    if collezione not in export.COLONNE:
+        raise HTTPException(status_code=404, detail="Collezione non esportabile")
+    if format not in export.FORMATI:
+        raise HTTPException(status_code=400, detail="Formato non valido (parquet, arrow)")
+    
+    try:
+        dal = export.parse_watermark(since) if since else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Fixed before reading and lagging the clock: rows created during the download,
+    # or committed late, go to the next export
+    fino_a = export.new_watermark()
+    filename = f"{collezione}_{fino_a[:10]}.{export.FORMATI[format]['estensione']}"
+    
+    return StreamingResponse(
+        export.stream_export(store, collezione, user.user_id, format, dal, fino_a),
+        media_type=export.FORMATI[format]["media_type"],
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Export-Watermark": fino_a
+        }
+    )
+
 # ============== MATERIALI ROUTES ==============
 
 @api_router.get("/materiali")
 async def get_materiali(request: Request, session_token: Optional[str] = Cookie(None)):
-    """Get materiali with status"""
+    """Get materiali with status; answers 304 while they are unchanged"""
     user = await get_current_user(request, session_token)
     
-    materiali = await db.materiali.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).to_list(1000)
-    
-    # Calculate status for each materiale
-    for m in materiali:
-        consumo = m.get("consumo_medio_giornaliero", 0)
-        if consumo > 0:
-            giorni_rimasti = m["quantita_disponibile"] / consumo
-            giorni_consegna = m.get("giorni_consegna", 0)
-            
-            if giorni_rimasti <= giorni_consegna:
-                m["stato"] = "ordina_ora"
-            elif giorni_rimasti <= giorni_consegna * 2:
-                m["stato"] = "attenzione"
-            else:
-                m["stato"] = "ok"
-            
-            m["giorni_rimasti"] = round(giorni_rimasti, 1)
-        else:
-            m["stato"] = "ok"
-            m["giorni_rimasti"] = None
-    
-    return materiali
+    # The stock-out forecast moves with the calendar day
+    etag = await version_etag(user.user_id, "materiali", date.today().isoformat())
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=etag_headers(etag))
+    
+    return conditional_json_response(request, await load_materiali_con_stato(user.user_id), etag)
+
+async def load_materiali_con_stato(user_id: str) -> list:
+    """Load a user's materiali annotated with the stock forecast (see forecasting.py)"""
+    materiali = await store.list_materiali(user_id)
+    
+    # Stock-out forecast for all materiali in one vectorized pass
+    return forecasting.annotate_materiali(materiali)
 
 @api_router.post("/materiali")
 async def create_materiale(request: Request, input: MaterialeInput, session_token: Optional[str] = Cookie(None)):
@@ -741,9 +1033,9 @@ async def create_materiale(request: Request, input: MaterialeInput, session_toke
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    await db.materiali.insert_one(materiale_doc.copy())
-    # Return document without MongoDB _id
-    materiale_doc.pop('_id', None)
+    await store.insert_materiale(materiale_doc)
+    await bump_versions(user.user_id, "materiali")
+    await publish_materiale(user.user_id, materiale_doc["materiale_id"], "creato", materiale_doc)
     return materiale_doc
 
 @api_router.patch("/materiali/{materiale_id}")
@@ -756,60 +1048,132 @@ async def update_materiale(request: Request, materiale_id: str, input: Materiale
     if not update_data:
         raise HTTPException(status_code=400, detail="Nessun campo da aggiornare")
     
-    result = await db.materiali.update_one(
-        {"materiale_id": materiale_id, "user_id": user.user_id},
-        {"$set": update_data}
-    )
+    if "quantita_disponibile" in update_data:
+        # Inventory count: logged as a rettifica movement
+        quantita = update_data.pop("quantita_disponibile")
+        found = await store.record_rettifica(user.user_id, materiale_id, quantita, update_data)
+    else:
+        found = await store.update_materiale(user.user_id, materiale_id, update_data)
     
-    if result.matched_count == 0:
+    if not found:
         raise HTTPException(status_code=404, detail="Materiale non trovato")
     
+    await bump_versions(user.user_id, "materiali")
+    await publish_materiale(user.user_id, materiale_id, "aggiornato")
+    
     return {"message": "Materiale aggiornato"}
 
+@api_router.post("/materiali/{materiale_id}/movimenti")
+async def create_movimento(request: Request, materiale_id: str, input: MovimentoInput, session_token: Optional[str] = Cookie(None)):
+    """Record a stock load (carico) or unload (scarico)"""
+    user = await get_current_user(request, session_token)
+    
+    if input.tipo not in movimenti.TIPI_MOVIMENTO:
+        raise HTTPException(status_code=400, detail="Tipo movimento non valido (carico, scarico)")
+    if input.quantita <= 0:
+        raise HTTPException(status_code=400, detail="La quantità deve essere positiva")
+    
+    result = await store.record_movimento(user.user_id, materiale_id, input.tipo, input.quantita, input.note)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Materiale non trovato")
+    
+    movimento, materiale = result
+    materiale = forecasting.annotate_materiali([materiale])[0]
+    await bump_versions(user.user_id, "materiali")
+    await publish_materiale(user.user_id, materiale_id, "movimento", materiale)
+    return {
+        "movimento": movimento,
+        "materiale": materiale
+    }
+
+@api_router.get("/materiali/{materiale_id}/movimenti")
+async def get_movimenti(request: Request, materiale_id: str, limit: int = Query(100, ge=1, le=1000), session_token: Optional[str] = Cookie(None)):
+    """Get the latest stock movements of a materiale"""
+    user = await get_current_user(request, session_token)
+    
+    return serialization.FastJSONResponse(content=await store.list_movimenti(user.user_id, materiale_id, limit))
+
 @api_router.delete("/materiali/{materiale_id}")
 async def delete_materiale(request: Request, materiale_id: str, session_token: Optional[str] = Cookie(None)):
     """Delete materiale"""
     user = await get_current_user(request, session_token)
     
-    result = await db.materiali.delete_one({"materiale_id": materiale_id, "user_id": user.user_id})
-    if result.deleted_count == 0:
+    if not await store.delete_materiale(user.user_id, materiale_id):
         raise HTTPException(status_code=404, detail="Materiale non trovato")
     
+    await bump_versions(user.user_id, "materiali")
+    await publish_materiale(user.user_id, materiale_id, "eliminato")
+    
     return {"message": "Materiale eliminato"}
 
 # ============== INSIGHT AI ROUTES ==============
 
+# One generation per (user_id, data) at a time in this process
+insight_flights = SingleFlight()
+
+# Seconds allowed for each LLM call and for the whole generation
+INSIGHT_LLM_TIMEOUT = float(os.environ.get('INSIGHT_LLM_TIMEOUT', '15'))
+INSIGHT_TOTAL_BUDGET = float(os.environ.get('INSIGHT_TOTAL_BUDGET', '25'))
+# Seconds a rule-based fallback is served before the LLM is tried again
+INSIGHT_FALLBACK_TTL = float(os.environ.get('INSIGHT_FALLBACK_TTL', '600'))
+
 @api_router.get("/insights")
 async def get_insights(request: Request, data: str, session_token: Optional[str] = Cookie(None)):
     """Get AI insights for a specific date"""
     user = await get_current_user(request, session_token)
     
-    # Check if insights already exist for this date
-    existing = await db.insights_ai.find(
-        {"user_id": user.user_id, "data": data},
-        {"_id": 0}
-    ).to_list(100)
+    # Check if insights already exist for this date (expired fallbacks are retried)
+    existing = await store.find_insights(user.user_id, data)
     
-    if existing:
+    if existing and not insights_ai.expired_fallbacks(existing):
         return existing
     
-    # Generate new insights
-    profile = await db.user_profiles.find_one({"user_id": user.user_id}, {"_id": 0})
-    
-    # Get dashboard data
-    dashboard = await get_dashboard(request, data, session_token)
-    
-    # Get entrate and costi for context
-    entrate = await db.entrate.find({"user_id": user.user_id, "data": data}, {"_id": 0}).to_list(100)
-    costi_var = await db.costi_variabili.find({"user_id": user.user_id, "data": data}, {"_id": 0}).to_list(100)
-    costi_fissi = await db.costi_fissi.find({"user_id": user.user_id}, {"_id": 0}).to_list(100)
+    # Concurrent requests wait for the generation already in flight
+    return await insight_flights.do(
+        (user.user_id, data),
+        lambda: generate_insights(user, data)
+    )
+
+async def load_day_snapshot(user_id: str, data: str) -> dict:
+    """
+    Load everything the insights need for one user and day, once
+    
+    The queries run concurrently. Totals and counts come from the daily
+    aggregates; only the first entries of the day are fetched for the prompt.
+    """
+    profile, totali, (entrate, _), (costi_var, _), materiali = await asyncio.gather(
+        store.get_profile(user_id),
+        store.get_dashboard_totals(user_id, data),
+        store.list_ledger("entrate", user_id, data, 3),
+        store.list_ledger("costi_variabili", user_id, data, 3),
+        load_materiali_con_stato(user_id)
+    )
     
-    # Get materiali status
-    materiali = await get_materiali(request, session_token)
-    materiali_critici = [m for m in materiali if m.get("stato") == "ordina_ora"]
+    return {
+        "data": data,
+        "profile": profile,
+        "totali": totali,
+        "dashboard": ledger.build_dashboard(
+            data,
+            totali["totale_entrate"],
+            totali["totale_costi_variabili"],
+            totali["totale_quota_fissi"]
+        ),
+        "entrate": entrate,
+        "costi_variabili": costi_var,
+        "materiali_critici": [m for m in materiali if m.get("stato") == "ordina_ora"]
+    }
+
+def build_insight_context(snapshot: dict) -> str:
+    """Context string given to the LLM"""
+    data = snapshot["data"]
+    profile = snapshot["profile"]
+    dashboard = snapshot["dashboard"]
+    totali = snapshot["totali"]
+    entrate = snapshot["entrate"]
+    costi_var = snapshot["costi_variabili"]
     
-    # Prepare context for AI
-    context = f"""
+    return f"""
 Data: {data}
 Tipo attività: {profile.get('tipo_attivita', 'N/A') if profile else 'N/A'}
 Settore: {profile.get('settore', 'N/A') if profile else 'N/A'}
@@ -820,100 +1184,43 @@ Dashboard:
 - Costi totali: €{dashboard['costi']}
 - Stato: {dashboard['stato']}
 
-Entrate ({len(entrate)}): {', '.join([f"{e['descrizione']} (€{e['importo']})" for e in entrate[:3]])}
-Costi variabili ({len(costi_var)}): {', '.join([f"{c['descrizione']} (€{c['importo']})" for c in costi_var[:3]])}
-Costi fissi mensili: {len(costi_fissi)} voci
-Materiali critici: {len(materiali_critici)}
+Entrate ({totali['num_entrate']}): {', '.join([f"{e['descrizione']} (€{e['importo']})" for e in entrate[:3]])}
+Costi variabili ({totali['num_costi_variabili']}): {', '.join([f"{c['descrizione']} (€{c['importo']})" for c in costi_var[:3]])}
+Costi fissi mensili: {totali['num_costi_fissi']} voci
+Materiali critici: {len(snapshot['materiali_critici'])}
 """
-    
-    insights = []
-    
-    if user.subscription_tier == "free":
-        # FREE: 1 insight generico
-        prompt = f"""Sei un consulente aziendale per PMI italiane. Basandoti sui dati forniti, genera UN SOLO insight breve (max 2 frasi) per l'utente.
-
-{context}
-
-L'insight deve essere:
-- Pratico e operativo
-- In italiano semplice
-- Prudente (usa "potrebbe", "sembra", "considera")
-- Senza certezze assolute
 
-Non parlare di tasse, IVA o contabilità fiscale.
-"""
-        
-        try:
-            llm = LlmChat(
-                api_key=os.environ.get('EMERGENT_LLM_KEY'),
-                session_id=f"insight_{user.user_id}_{data}",
-                system_message="Sei un consulente aziendale che fornisce suggerimenti prudenti e pratici."
-            )
-            llm.with_model("openai", "gpt-5.2")
-            
-            user_message = UserMessage(text=prompt)
-            response = await llm.send_message(user_message)
-            
-            insights.append({
-                "insight_id": f"ins_{uuid.uuid4().hex[:12]}",
-                "user_id": user.user_id,
-                "data": data,
-                "tipo": "generale",
-                "contenuto": response.strip(),
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
-        except Exception as e:
-            # Fallback insight
-            insights.append({
-                "insight_id": f"ins_{uuid.uuid4().hex[:12]}",
-                "user_id": user.user_id,
-                "data": data,
-                "tipo": "generale",
-                "contenuto": f"Il tuo utile oggi è di €{dashboard['utile']}. {'Ottimo lavoro!' if dashboard['utile'] > 0 else 'Considera di rivedere i costi.'}",
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
+async def generate_insights(user: User, data: str) -> list:
+    """Generate, store and return the insights of a day (also used by insights_batch.py)"""
+    # A previous flight may have completed since the caller checked
+    existing = await store.find_insights(user.user_id, data)
+    retry = insights_ai.expired_fallbacks(existing)
+    if existing and not retry:
+        return existing
     
-    else:
-        # PRO: 3 insights fissi
-        prompts = [
-            ("positivo", "Identifica UN punto positivo o un successo nei dati di oggi (max 2 frasi)."),
-            ("rischio", "Identifica UN potenziale rischio o area di attenzione (max 2 frasi)."),
-            ("azione", "Suggerisci UN'azione concreta che l'utente potrebbe fare domani (max 2 frasi).")
-        ]
-        
-        for tipo, instruction in prompts:
-            prompt = f"""{instruction}
-
-{context}
-
-Risposta in italiano, tono pratico e prudente. Non parlare di tasse o contabilità fiscale.
-"""
-            
-            try:
-                llm = LlmChat(
-                    api_key=os.environ.get('EMERGENT_LLM_KEY'),
-                    session_id=f"insight_{tipo}_{user.user_id}_{data}",
-                    system_message="Sei un consulente aziendale esperto."
-                )
-                llm.with_model("openai", "gpt-5.2")
-                
-                user_message = UserMessage(text=prompt)
-                response = await llm.send_message(user_message)
-                
-                insights.append({
-                    "insight_id": f"ins_{uuid.uuid4().hex[:12]}",
-                    "user_id": user.user_id,
-                    "data": data,
-                    "tipo": tipo,
-                    "contenuto": response.strip(),
-                    "created_at": datetime.now(timezone.utc).isoformat()
-                })
-            except:
-                pass
-    
-    # Save insights to database
+    # Generate new insights from a single snapshot of the day
+    snapshot = await load_day_snapshot(user.user_id, data)
+    context = build_insight_context(snapshot)
+    
+    insights = await insights_ai.generate(
+        llm.get_llm(),
+        user.user_id,
+        user.subscription_tier,
+        data,
+        context,
+        snapshot["dashboard"],
+        materiali_critici=len(snapshot["materiali_critici"]),
+        call_timeout=INSIGHT_LLM_TIMEOUT,
+        total_budget=INSIGHT_TOTAL_BUDGET,
+        fallback_ttl=INSIGHT_FALLBACK_TTL,
+        tipi=retry or None
+    )
+    
+    # Save insights to database (a new one replaces a stored fallback)
     if insights:
-        await db.insights_ai.insert_many([i.copy() for i in insights])
+        await store.store_insights(insights)
+        # Return what is stored, in case another worker won the race
+        return await store.find_insights(user.user_id, data)
     
     return insights
 
@@ -924,28 +1231,67 @@ async def get_notifiche(request: Request, session_token: Optional[str] = Cookie(
     """Get user notifications"""
     user = await get_current_user(request, session_token)
     
-    notifiche = await db.notifiche.find(
-        {"user_id": user.user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(100)
-    
-    return notifiche
+    return serialization.FastJSONResponse(content=await store.list_notifiche(user.user_id))
 
 @api_router.patch("/notifiche/{notifica_id}/letta")
 async def mark_notifica_letta(request: Request, notifica_id: str, session_token: Optional[str] = Cookie(None)):
     """Mark notification as read"""
     user = await get_current_user(request, session_token)
     
-    result = await db.notifiche.update_one(
-        {"notifica_id": notifica_id, "user_id": user.user_id},
-        {"$set": {"letta": True}}
-    )
-    
-    if result.matched_count == 0:
+    # The unread counter only moves for the request that actually flipped `letta`
+    if await store.mark_notifica_letta(user.user_id, notifica_id) is None:
         raise HTTPException(status_code=404, detail="Notifica non trovata")
     
     return {"message": "Notifica aggiornata"}
 
+@api_router.patch("/notifiche/letta-tutte")
+async def mark_all_notifiche_lette(request: Request, session_token: Optional[str] = Cookie(None)):
+    """Mark every unread notification as read"""
+    user = await get_current_user(request, session_token)
+    
+    aggiornate = await store.mark_all_notifiche_lette(user.user_id)
+    
+    return {"message": "Notifiche aggiornate", "aggiornate": aggiornate}
+
+@api_router.get("/notifiche/unread-count")
+async def get_notifiche_unread_count(request: Request, session_token: Optional[str] = Cookie(None)):
+    """Unread notification badge; answers 304 when the count is unchanged"""
+    user = await get_current_user(request, session_token)
+    
+    non_lette = await store.get_unread_count(user.user_id)
+    
+    return conditional_json_response(request, {"non_lette": non_lette}, f'W/"{non_lette}"')
+
+# ============== LIVE EVENTS ROUTES ==============
+
+@api_router.get("/eventi")
+async def stream_eventi(request: Request, session_token: Optional[str] = Cookie(None)):
+    """Server-Sent Events stream: new notifiche, day totals and materiali changes"""
+    user = await get_current_user(request, session_token)
+    
+    subscription = event_broker.subscribe(user.user_id)
+    
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                event = await subscription.get(timeout=EVENT_HEARTBEAT_SECONDS)
+                if event is not None:
+                    yield events.format_sse(event)
+                elif await request.is_disconnected():
+                    break
+                else:
+                    # Comment line: keeps proxies from closing an idle connection
+                    yield ": ping\n\n"
+        finally:
+            subscription.close()
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # ============== SUBSCRIPTION ROUTES ==============
 
 @api_router.post("/subscription/upgrade")
@@ -955,13 +1301,48 @@ async def upgrade_subscription(request: Request, session_token: Optional[str] =
     
     # TODO: Integrate Stripe
     # For now, just upgrade directly
-    await db.users.update_one(
-        {"user_id": user.user_id},
-        {"$set": {"subscription_tier": "pro"}}
-    )
+    await store.update_user(user.user_id, {"subscription_tier": "pro"})
+    session_cache.invalidate_user(user.user_id)
+    await bump_versions(user.user_id, "profile")
     
     return {"message": "Upgrade a PRO completato", "tier": "pro"}
 
+# ============== INTERNAL ROUTES ==============
+
+# /metrics is served on the app itself, outside /api: with METRICS_TOKEN set the
+# scraper must send it as a Bearer token (Prometheus `authorization` config);
+# without it the endpoint is public and should only be reachable from the
+# internal network
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(request: Request):
+    """Prometheus scrape endpoint (see metrics.py)"""
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("authorization", "").encode("utf-8"), f"Bearer {METRICS_TOKEN}".encode("utf-8")
+    ):
+        raise HTTPException(status_code=401, detail="Non autenticato")
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+metrics.REGISTRY.callback(
+    "session_cache_events_total", "Session cache hits, misses, evictions and invalidations",
+    lambda: {(k,): session_cache.stats()[k] for k in ("hits", "misses", "evictions", "invalidations")},
+    labelnames=("evento",), type="counter"
+)
+metrics.REGISTRY.callback(
+    "session_cache_size", "Sessions currently cached",
+    lambda: {(): session_cache.stats().get("size", 0)}
+)
+metrics.REGISTRY.callback(
+    "push_dispatcher_messages_total", "Push messages by outcome",
+    lambda: {(k,): v for k, v in push_dispatcher.stats.items()},
+    labelnames=("esito",), type="counter"
+)
+metrics.REGISTRY.callback(
+    "event_subscribers", "Open /api/eventi connections in this process",
+    lambda: {(): event_broker.subscriber_count()}
+)
+
 # Include the router in the main app
 app.include_router(api_router)
 
@@ -971,6 +1352,20 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Export-Watermark", "ETag"],
+)
+
+# Negotiated brotli/gzip for JSON bodies above the threshold; streams pass through
+app.add_middleware(
+    compression.CompressionMiddleware,
+    minimum_size=int(os.environ.get('COMPRESSION_MIN_SIZE', str(compression.DEFAULT_MIN_SIZE)))
+)
+
+# Outermost middleware: times the whole request, CORS included
+app.add_middleware(
+    metrics.MetricsMiddleware,
+    slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS', '1000')),
+    exclude_paths=("/metrics", "/api/eventi")
 )
 
 # Configure logging
@@ -980,6 +1375,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def provision_indexes():
+    # MongoDB indexes (indexes.py); SQLite tables and indexes already exist once connected
+    if os.environ.get('AUTO_INDEXES', '1') == '0':
+        return
+    try:
+        await store.ensure_schema(dry_run=os.environ.get('INDEXES_DRY_RUN') == '1')
+    except Exception as e:
+        logger.error(f"Provisioning indici fallito: {e}")
+
+@app.on_event("startup")
+async def check_metrics_access():
+    if not METRICS_TOKEN:
+        logger.warning("METRICS_TOKEN non impostato: /metrics è accessibile senza autenticazione")
+
+@app.on_event("startup")
+async def check_codecs():
+    # orjson and brotli are pinned in requirements.txt but the modules fall back
+    # silently without them: make the slower fallback visible, or fatal if required
+    mancanti = [
+        f"{nome} ({ripiego})" for nome, disponibile, ripiego in (
+            ("orjson", serialization.ORJSON_AVAILABLE, "JSON con il modulo json standard"),
+            ("brotli", compression.BROTLI_AVAILABLE, "compressione solo gzip")
+        )
+        if not disponibile
+    ]
+    if not mancanti:
+        return
+    messaggio = f"Pacchetti non installati: {', '.join(mancanti)}"
+    if os.environ.get('REQUIRE_CODECS') == '1':
+        raise RuntimeError(messaggio)
+    logger.warning(messaggio)
+
+@app.on_event("startup")
+async def start_event_broker():
+    await event_broker.start()
+    events.set_broker(event_broker)
+
+@app.on_event("startup")
+async def start_push_dispatcher():
+    push_dispatcher.start()
+    notifications.set_push_dispatcher(push_dispatcher)
+
+# In-process notification sweeper, off by default: with several uvicorn
+# workers prefer dedicated `python notification_sweeper.py --shard N` processes
+notification_sweep_task: Optional[asyncio.Task] = None
+
+@app.on_event("startup")
+async def start_notification_sweeper():
+    global notification_sweep_task
+    interval = float(os.environ.get('NOTIFICHE_SWEEP_INTERVAL', '0'))
+    if interval <= 0:
+        return
+    notification_sweep_task = asyncio.create_task(notification_sweeper.run_forever(
+        store,
+        interval,
+        shard=int(os.environ.get('NOTIFICHE_SHARD', '0')),
+        shards=int(os.environ.get('NOTIFICHE_SHARDS', '1'))
+    ))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    if notification_sweep_task is not None:
+        notification_sweep_task.cancel()
+    await push_dispatcher.stop()
+    await event_broker.stop()
+    await store.close()
+    password_hasher.shutdown()
\ No newline at end of file
@@ -0,0 +1,102 @@
+# Session Cache
+# Cache in-process davanti a get_current_user: evita i due round trip a MongoDB
+# (user_sessions + users) per ogni richiesta autenticata.
+
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Set, Tuple
+
+
+class SessionCache:
+    """
+    Cache LRU limitata di session_token -> utente.
+
+    Ogni voce scade al primo tra `expires_at` della sessione e il TTL
+    configurato, così una modifica fatta da un altro worker viene vista
+    al massimo dopo `ttl_seconds`. Le invalidazioni locali (logout,
+    upgrade, aggiornamenti utente) sono immediate.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl_seconds: float = 60.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[str, Set[str]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, session_token: str) -> Optional[Any]:
+        entry = self._entries.get(session_token)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        user, valid_until = entry
+        if valid_until <= time.monotonic():
+            self._remove(session_token)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(session_token)
+        self.hits += 1
+        return user
+
+    def put(self, session_token: str, user: Any, expires_at: datetime) -> None:
+        if self.max_size <= 0:
+            return
+
+        # Converte expires_at (wall clock) in una scadenza monotonic
+        remaining = (expires_at - datetime.now(timezone.utc)).total_seconds()
+        ttl = min(self.ttl_seconds, remaining)
+        if ttl <= 0:
+            return
+
+        if session_token in self._entries:
+            self._remove(session_token)
+
+        self._entries[session_token] = (user, time.monotonic() + ttl)
+        self._tokens_by_user.setdefault(user.user_id, set()).add(session_token)
+
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate_token(self, session_token: Optional[str]) -> None:
+        if session_token and session_token in self._entries:
+            self._remove(session_token)
+            self.invalidations += 1
+
+    def invalidate_user(self, user_id: str) -> None:
+        for session_token in list(self._tokens_by_user.get(user_id, ())):
+            self._remove(session_token)
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, session_token: str) -> None:
+        user, _ = self._entries.pop(session_token)
+        tokens = self._tokens_by_user.get(user.user_id)
+        if tokens is not None:
+            tokens.discard(session_token)
+            if not tokens:
+                del self._tokens_by_user[user.user_id]
+
+
+__all__ = ['SessionCache']
@@ -0,0 +1,39 @@
+# Single Flight
+# Coalesce chiamate concorrenti con la stessa chiave: la prima esegue il
+# lavoro, le altre attendono lo stesso risultato invece di ripeterlo.
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """
+    Una sola esecuzione in corso per chiave, nel processo corrente
+
+    Il lavoro gira in un task separato: se un chiamante viene cancellato
+    (es. client disconnesso) gli altri continuano ad attendere il risultato.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._inflight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Evita "exception was never retrieved" se tutti i chiamanti sono stati cancellati
+        if not task.cancelled():
+            task.exception()
+
+
+__all__ = ['SingleFlight']
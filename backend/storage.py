@@ -0,0 +1,798 @@
+# Storage
+# Livello di accesso ai dati usato dal server: utenti, sessioni, entrate,
+# costi, materiali, notifiche e insight passano da qui invece che da
+# chiamate Motor sparse nei route.
+#
+# Backend (STORAGE_BACKEND):
+#   mongo   - MongoDB tramite Motor (default), con i riepiloghi
+#             materializzati di ledger.py e gli indici di indexes.py
+#   sqlite  - file SQLite locale (SQLITE_PATH), senza server da gestire:
+#             pensato per i test e per le installazioni di un solo negozio
+#             (vedi storage_sqlite.py)
+#
+# Le due implementazioni restituiscono documenti con gli stessi campi, così
+# route, modelli e client non vedono differenze.
+
+import uuid
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timezone
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from pymongo import ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import bulk_import
+import dates
+import indexes
+import ledger
+import metrics
+import movimenti
+import notifications
+import pagination
+
+# Collezioni di movimenti contabili e relativo campo id
+LEDGER_ID_FIELDS = {
+    "entrate": "entrata_id",
+    "costi_variabili": "costo_id"
+}
+
+# Collezioni esportabili (export.py) e relativo campo id per l'ordinamento
+EXPORT_ID_FIELDS = {
+    **LEDGER_ID_FIELDS,
+    "costi_fissi": "costo_id",
+    "materiali": "materiale_id"
+}
+
+# Risorse in lettura con un contatore di versione per utente (ETag dei GET)
+RISORSE_VERSIONATE = ("dashboard", "materiali", "costi_fissi", "profile")
+
+BACKENDS = ("mongo", "sqlite")
+
+
+class Storage(ABC):
+    """
+    Interfaccia comune dei backend di storage
+
+    Ogni metodo restituisce documenti senza `_id`. I metodi che scrivono
+    movimenti contabili aggiornano anche i totali della dashboard.
+    """
+
+    # Database Motor, solo per il backend mongo (change stream degli eventi)
+    db = None
+
+    @abstractmethod
+    async def ensure_schema(self, dry_run: bool = False):
+        """Indici (mongo) o tabelle e indici (sqlite)"""
+
+    @abstractmethod
+    async def close(self):
+        ...
+
+    # ============== UTENTI E SESSIONI ==============
+
+    @abstractmethod
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def get_user_by_email(self, email: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def insert_user(self, user_doc: dict):
+        ...
+
+    @abstractmethod
+    async def update_user(self, user_id: str, fields: dict) -> bool:
+        """
+        Returns:
+            bool: False se l'utente non esiste
+        """
+
+    @abstractmethod
+    async def replace_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        """Sostituisce l'hash solo se è ancora `old_hash` (rehash concorrenti)"""
+
+    @abstractmethod
+    async def insert_session(self, session_doc: dict):
+        ...
+
+    @abstractmethod
+    async def get_session(self, session_token: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def delete_session(self, session_token: str):
+        ...
+
+    @abstractmethod
+    def iter_active_user_ids(self, since: datetime) -> AsyncIterator[str]:
+        """
+        Utenti visti (last_seen_at) o con una sessione creata da `since`, in
+        ordine di user_id. Le sessioni coprono gli utenti che non hanno ancora
+        last_seen_at, ma scadono dopo 7 giorni
+        """
+
+    # ============== PROFILO E PREFERENZE ==============
+
+    @abstractmethod
+    async def get_profile(self, user_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def insert_profile(self, profile_doc: dict):
+        ...
+
+    @abstractmethod
+    async def get_notification_preferences(self, user_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def insert_notification_preferences(self, prefs_doc: dict):
+        ...
+
+    @abstractmethod
+    async def update_notification_preferences(self, user_id: str, fields: dict):
+        """Aggiorna i campi indicati, creando le preferenze se mancano"""
+
+    @abstractmethod
+    def iter_push_enabled_preferences(self, shard: int = 0, shards: int = 1) -> AsyncIterator[dict]:
+        """
+        Preferenze degli utenti con notifiche_push_enabled, solo quelle con
+        notifications.shard_hash(user_id) % shards == shard (filtro nella query)
+        """
+
+    # ============== DASHBOARD ==============
+
+    @abstractmethod
+    async def get_dashboard_totals(self, user_id: str, data: str) -> dict:
+        """
+        Returns:
+            dict: totale_entrate, num_entrate, totale_costi_variabili,
+            num_costi_variabili, totale_quota_fissi, num_costi_fissi
+        """
+
+    @abstractmethod
+    async def get_dashboard_totals_many(self, user_ids: List[str], data: str) -> Dict[str, dict]:
+        """
+        Totali del giorno per un gruppo di utenti (sweeper delle notifiche)
+
+        Returns:
+            dict: {user_id: {totale_entrate, totale_costi_variabili, totale_quota_fissi}}
+        """
+
+    @abstractmethod
+    async def get_dashboard_range(self, user_id: str, dal: date, al: date, granularity: str = "day") -> list:
+        """Serie come da ledger.build_dashboard_series"""
+
+    async def get_dashboard(self, user_id: str, data: str) -> dict:
+        totali = await self.get_dashboard_totals(user_id, data)
+        return ledger.build_dashboard(
+            data,
+            totali["totale_entrate"],
+            totali["totale_costi_variabili"],
+            totali["totale_quota_fissi"]
+        )
+
+    # ============== ENTRATE E COSTI ==============
+
+    @abstractmethod
+    async def list_ledger(self, collezione: str, user_id: str, data: Optional[str], limit: int,
+                          cursor: Optional[str] = None, dal: Optional[date] = None,
+                          al: Optional[date] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        Pagina di entrate o costi variabili ordinata per (created_at, id)
+
+        Args:
+            data: solo i documenti di questo giorno
+            dal, al: solo i documenti con data nell'intervallo (estremi inclusi)
+
+        Raises:
+            ValueError: se il cursore non è valido
+
+        Returns:
+            tuple: (documenti, cursore della pagina successiva o None)
+        """
+
+    @abstractmethod
+    def iter_ledger(self, collezione: str, user_id: str, data: Optional[str], cursor: Optional[str] = None,
+                    dal: Optional[date] = None, al: Optional[date] = None) -> AsyncIterator[dict]:
+        """Tutti i documenti dopo il cursore, letti a blocchi (streaming NDJSON)"""
+
+    @abstractmethod
+    async def insert_ledger(self, collezione: str, doc: dict):
+        ...
+
+    @abstractmethod
+    async def insert_ledger_many(self, collezione: str, user_id: str,
+                                 docs: List[Tuple[int, dict]]) -> Tuple[List[dict], List[dict]]:
+        """
+        Importazione massiva: un errore di scrittura scarta solo la sua riga
+
+        Returns:
+            tuple: (documenti inseriti, [{"riga", "errore"}])
+        """
+
+    @abstractmethod
+    async def delete_ledger(self, collezione: str, user_id: str, doc_id: str) -> Optional[dict]:
+        """
+        Returns:
+            dict: documento eliminato oppure None se non esiste
+        """
+
+    @abstractmethod
+    async def list_costi_fissi(self, user_id: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def insert_costo_fisso(self, costo_doc: dict):
+        ...
+
+    @abstractmethod
+    async def delete_costo_fisso(self, user_id: str, costo_id: str) -> Optional[dict]:
+        ...
+
+    # ============== MATERIALI ==============
+
+    @abstractmethod
+    async def list_materiali(self, user_id: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def list_materiali_many(self, user_ids: List[str]) -> List[dict]:
+        """Materiali di più utenti, con i soli campi delle regole di notifica"""
+
+    @abstractmethod
+    async def get_materiale(self, user_id: str, materiale_id: str) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def insert_materiale(self, materiale_doc: dict):
+        ...
+
+    @abstractmethod
+    async def update_materiale(self, user_id: str, materiale_id: str, fields: dict) -> bool:
+        ...
+
+    @abstractmethod
+    async def delete_materiale(self, user_id: str, materiale_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def record_movimento(self, user_id: str, materiale_id: str, tipo: str, quantita: float,
+                               note: Optional[str] = None) -> Optional[Tuple[dict, dict]]:
+        """Come movimenti.record_movimento"""
+
+    @abstractmethod
+    async def record_rettifica(self, user_id: str, materiale_id: str, quantita: float,
+                               altri_campi: Optional[dict] = None) -> Optional[dict]:
+        """Come movimenti.record_rettifica"""
+
+    @abstractmethod
+    async def list_movimenti(self, user_id: str, materiale_id: str, limit: int) -> List[dict]:
+        """Movimenti dal più recente"""
+
+    # ============== VERSIONI ==============
+
+    @abstractmethod
+    async def get_versions(self, user_id: str) -> dict:
+        """
+        Versioni delle risorse in lettura di un utente, per gli ETag
+
+        `epoca` è un valore casuale scelto alla creazione dei contatori: se
+        i contatori vengono persi e ripartono da zero, gli ETag già in mano
+        ai client non tornano validi.
+
+        Returns:
+            dict: {"epoca", <risorsa>: versione} per ogni RISORSE_VERSIONATE
+        """
+
+    @abstractmethod
+    async def bump_versions(self, user_id: str, risorse: List[str]):
+        """
+        +1 alle versioni delle risorse toccate da una scrittura, dopo la scrittura
+
+        Raises:
+            ValueError: risorsa non in RISORSE_VERSIONATE
+        """
+
+    # ============== EXPORT ==============
+
+    @abstractmethod
+    def iter_export(self, collezione: str, user_id: str, dal: Optional[str], fino_a: str) -> AsyncIterator[dict]:
+        """
+        Documenti con created_at in (dal, fino_a], in ordine (created_at, id)
+        e letti a blocchi: l'export non carica mai tutta la storia in memoria
+        """
+
+    # ============== NOTIFICHE ==============
+
+    @abstractmethod
+    async def list_notifiche(self, user_id: str, limit: int = 100) -> List[dict]:
+        """Notifiche dalla più recente"""
+
+    @abstractmethod
+    async def mark_notifica_letta(self, user_id: str, notifica_id: str) -> Optional[bool]:
+        """
+        Returns:
+            None se la notifica non esiste, False se era già letta, True se aggiornata
+        """
+
+    @abstractmethod
+    async def mark_all_notifiche_lette(self, user_id: str) -> int:
+        ...
+
+    @abstractmethod
+    async def get_unread_count(self, user_id: str) -> int:
+        ...
+
+    @abstractmethod
+    async def recent_notification_keys(self, user_ids: List[str], tipi: List[str], since: str) -> Tuple[Set[tuple], Set[tuple]]:
+        """
+        Chiavi (user_id, tipo, soggetto) delle notifiche create da `since`
+
+        Returns:
+            tuple: (chiavi non lette, tutte le chiavi)
+        """
+
+    @abstractmethod
+    async def insert_notifiche(self, docs: List[dict]):
+        ...
+
+    @abstractmethod
+    async def get_fcm_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        ...
+
+    @abstractmethod
+    async def remove_fcm_tokens(self, pairs: Set[Tuple[str, str]]) -> int:
+        """
+        Rimuove i token non più validi, solo se l'utente ha ancora lo stesso token
+
+        Returns:
+            int: utenti modificati
+        """
+
+    # ============== INSIGHT ==============
+
+    @abstractmethod
+    async def find_insights(self, user_id: str, data: str) -> List[dict]:
+        ...
+
+    @abstractmethod
+    async def store_insights(self, insights: List[dict]):
+        """Insert-if-absent su (user_id, data, tipo): worker concorrenti non creano duplicati"""
+
+    @abstractmethod
+    async def completed_batch_users(self, run_id: str) -> Set[str]:
+        """Utenti già completati da insights_batch.py per `run_id`"""
+
+    @abstractmethod
+    async def set_batch_progress(self, run_id: str, user_id: str, stato: str):
+        ...
+
+    @abstractmethod
+    async def reset_batch_progress(self, run_id: str):
+        ...
+
+
+class MongoStorage(Storage):
+    """Backend MongoDB: riepiloghi materializzati (ledger.py) e contatore non lette (notifications.py)"""
+
+    def __init__(self, client, db_name: str):
+        self.client = client
+        self.db = client[db_name]
+
+    async def ensure_schema(self, dry_run: bool = False):
+        return await indexes.ensure_indexes(self.db, dry_run=dry_run)
+
+    async def close(self):
+        self.client.close()
+
+    # ============== UTENTI E SESSIONI ==============
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        return await self.db.users.find_one({"user_id": user_id}, {"_id": 0})
+
+    async def get_user_by_email(self, email: str) -> Optional[dict]:
+        return await self.db.users.find_one({"email": email}, {"_id": 0})
+
+    async def insert_user(self, user_doc: dict):
+        await self.db.users.insert_one({**user_doc, "created_at": dates.to_datetime(user_doc["created_at"])})
+        await ledger.init_user(self.db, user_doc["user_id"])
+
+    async def update_user(self, user_id: str, fields: dict) -> bool:
+        result = await self.db.users.update_one({"user_id": user_id}, {"$set": fields})
+        return result.matched_count > 0
+
+    async def replace_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        result = await self.db.users.update_one(
+            {"user_id": user_id, "password_hash": old_hash},
+            {"$set": {"password_hash": new_hash}}
+        )
+        return result.modified_count > 0
+
+    async def insert_session(self, session_doc: dict):
+        await self.db.user_sessions.insert_one(session_doc.copy())
+
+    async def get_session(self, session_token: str) -> Optional[dict]:
+        return await self.db.user_sessions.find_one({"session_token": session_token}, {"_id": 0})
+
+    async def delete_session(self, session_token: str):
+        await self.db.user_sessions.delete_many({"session_token": session_token})
+
+    async def iter_active_user_ids(self, since: datetime) -> AsyncIterator[str]:
+        user_ids = set()
+        async for doc in self.db.users.find({"last_seen_at": {"$gte": since}}, {"_id": 0, "user_id": 1}):
+            user_ids.add(doc["user_id"])
+        async for row in self.db.user_sessions.aggregate([
+            {"$match": {"created_at": {"$gte": since}}},
+            {"$group": {"_id": "$user_id"}}
+        ]):
+            user_ids.add(row["_id"])
+        for user_id in sorted(user_ids):
+            yield user_id
+
+    # ============== PROFILO E PREFERENZE ==============
+
+    async def get_profile(self, user_id: str) -> Optional[dict]:
+        return await self.db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
+
+    async def insert_profile(self, profile_doc: dict):
+        await self.db.user_profiles.insert_one(profile_doc.copy())
+
+    async def get_notification_preferences(self, user_id: str) -> Optional[dict]:
+        return await self.db.notification_preferences.find_one({"user_id": user_id}, {"_id": 0, "shard_hash": 0})
+
+    async def insert_notification_preferences(self, prefs_doc: dict):
+        await self.db.notification_preferences.insert_one(
+            {**prefs_doc, "shard_hash": notifications.shard_hash(prefs_doc["user_id"])}
+        )
+
+    async def update_notification_preferences(self, user_id: str, fields: dict):
+        await self.db.notification_preferences.update_one(
+            {"user_id": user_id},
+            {"$set": {**fields, "shard_hash": notifications.shard_hash(user_id)}},
+            upsert=True
+        )
+
+    async def iter_push_enabled_preferences(self, shard: int = 0, shards: int = 1) -> AsyncIterator[dict]:
+        query = {"notifiche_push_enabled": True}
+        if shards > 1:
+            # Le preferenze senza shard_hash (precedenti al campo, vedi
+            # notifications --assegna-shard) sono filtrate qui
+            query["$or"] = [
+                {"$expr": {"$eq": [{"$mod": ["$shard_hash", shards]}, shard]}},
+                {"shard_hash": {"$exists": False}}
+            ]
+        async for prefs in self.db.notification_preferences.find(query, {"_id": 0}):
+            if prefs.pop("shard_hash", None) is None and notifications.shard_hash(prefs["user_id"]) % shards != shard:
+                continue
+            yield prefs
+
+    # ============== DASHBOARD ==============
+
+    async def get_dashboard_totals(self, user_id: str, data: str) -> dict:
+        return await ledger.get_dashboard_totals(self.db, user_id, data)
+
+    async def get_dashboard_totals_many(self, user_ids: List[str], data: str) -> Dict[str, dict]:
+        return await ledger.get_dashboard_totals_many(self.db, user_ids, data)
+
+    async def get_dashboard_range(self, user_id: str, dal: date, al: date, granularity: str = "day") -> list:
+        return await ledger.get_dashboard_range(self.db, user_id, dal, al, granularity)
+
+    # ============== ENTRATE E COSTI ==============
+
+    async def list_ledger(self, collezione: str, user_id: str, data: Optional[str], limit: int,
+                          cursor: Optional[str] = None, dal: Optional[date] = None,
+                          al: Optional[date] = None) -> Tuple[List[dict], Optional[str]]:
+        docs, next_cursor = await pagination.fetch_page(
+            self.db[collezione], _ledger_query(user_id, data, dal, al), LEDGER_ID_FIELDS[collezione], limit, cursor
+        )
+        return [_ledger_from_mongo(doc) for doc in docs], next_cursor
+
+    async def iter_ledger(self, collezione: str, user_id: str, data: Optional[str], cursor: Optional[str] = None,
+                          dal: Optional[date] = None, al: Optional[date] = None) -> AsyncIterator[dict]:
+        async for doc in pagination.iter_documents(
+            self.db[collezione], _ledger_query(user_id, data, dal, al), LEDGER_ID_FIELDS[collezione], cursor
+        ):
+            yield _ledger_from_mongo(doc)
+
+    async def insert_ledger(self, collezione: str, doc: dict):
+        await self.db[collezione].insert_one(_ledger_to_mongo(doc))
+        await _record_ledger(self.db, collezione, doc)
+
+    async def insert_ledger_many(self, collezione: str, user_id: str,
+                                 docs: List[Tuple[int, dict]]) -> Tuple[List[dict], List[dict]]:
+        inserted, errors = await bulk_import.insert_chunks(
+            self.db[collezione], [(riga, _ledger_to_mongo(doc)) for riga, doc in docs]
+        )
+        inserted = [_ledger_from_mongo(doc) for doc in inserted]
+        if collezione == "entrate":
+            await ledger.record_entrate_bulk(self.db, user_id, inserted)
+        else:
+            await ledger.record_costi_variabili_bulk(self.db, user_id, inserted)
+        return inserted, errors
+
+    async def delete_ledger(self, collezione: str, user_id: str, doc_id: str) -> Optional[dict]:
+        deleted = await self.db[collezione].find_one_and_delete(
+            {LEDGER_ID_FIELDS[collezione]: doc_id, "user_id": user_id},
+            projection={"_id": 0}
+        )
+        if deleted is None:
+            return None
+        deleted = _ledger_from_mongo(deleted)
+        await _record_ledger(self.db, collezione, deleted, segno=-1)
+        return deleted
+
+    async def list_costi_fissi(self, user_id: str) -> List[dict]:
+        return await self.db.costi_fissi.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
+
+    async def insert_costo_fisso(self, costo_doc: dict):
+        await self.db.costi_fissi.insert_one(costo_doc.copy())
+        await ledger.record_costo_fisso(self.db, costo_doc["user_id"], costo_doc["quota_giornaliera"])
+
+    async def delete_costo_fisso(self, user_id: str, costo_id: str) -> Optional[dict]:
+        deleted = await self.db.costi_fissi.find_one_and_delete(
+            {"costo_id": costo_id, "user_id": user_id},
+            projection={"_id": 0}
+        )
+        if deleted is not None:
+            await ledger.record_costo_fisso(self.db, user_id, deleted["quota_giornaliera"], segno=-1)
+        return deleted
+
+    # ============== MATERIALI ==============
+
+    async def list_materiali(self, user_id: str) -> List[dict]:
+        return await self.db.materiali.find({"user_id": user_id}, {"_id": 0}).to_list(None)
+
+    async def list_materiali_many(self, user_ids: List[str]) -> List[dict]:
+        return await self.db.materiali.find(
+            {"user_id": {"$in": user_ids}},
+            notifications.CAMPI_MATERIALE_REGOLE
+        ).to_list(None)
+
+    async def get_materiale(self, user_id: str, materiale_id: str) -> Optional[dict]:
+        return await self.db.materiali.find_one({"materiale_id": materiale_id, "user_id": user_id}, {"_id": 0})
+
+    async def insert_materiale(self, materiale_doc: dict):
+        await self.db.materiali.insert_one(materiale_doc.copy())
+
+    async def update_materiale(self, user_id: str, materiale_id: str, fields: dict) -> bool:
+        result = await self.db.materiali.update_one(
+            {"materiale_id": materiale_id, "user_id": user_id},
+            {"$set": fields}
+        )
+        return result.matched_count > 0
+
+    async def delete_materiale(self, user_id: str, materiale_id: str) -> bool:
+        return await movimenti.delete_materiale(self.db, user_id, materiale_id)
+
+    async def record_movimento(self, user_id: str, materiale_id: str, tipo: str, quantita: float,
+                               note: Optional[str] = None) -> Optional[Tuple[dict, dict]]:
+        return await movimenti.record_movimento(self.db, user_id, materiale_id, tipo, quantita, note)
+
+    async def record_rettifica(self, user_id: str, materiale_id: str, quantita: float,
+                               altri_campi: Optional[dict] = None) -> Optional[dict]:
+        return await movimenti.record_rettifica(self.db, user_id, materiale_id, quantita, altri_campi)
+
+    async def list_movimenti(self, user_id: str, materiale_id: str, limit: int) -> List[dict]:
+        return await self.db.movimenti_materiali.find(
+            {"user_id": user_id, "materiale_id": materiale_id},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(limit)
+
+    # ============== VERSIONI ==============
+
+    async def get_versions(self, user_id: str) -> dict:
+        doc = await self.db.versioni.find_one({"user_id": user_id}, {"_id": 0})
+        if doc is None:
+            # $setOnInsert: se un'altra richiesta l'ha già creato vince la sua epoca
+            doc = await self.db.versioni.find_one_and_update(
+                {"user_id": user_id},
+                {"$setOnInsert": {"epoca": uuid.uuid4().hex}},
+                projection={"_id": 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        return {"epoca": doc["epoca"], **{r: doc.get(r, 0) for r in RISORSE_VERSIONATE}}
+
+    async def bump_versions(self, user_id: str, risorse: List[str]):
+        _check_risorse(risorse)
+        await self.db.versioni.update_one(
+            {"user_id": user_id},
+            {
+                "$inc": {r: 1 for r in risorse},
+                "$set": {"updated_at": datetime.now(timezone.utc)},
+                "$setOnInsert": {"epoca": uuid.uuid4().hex}
+            },
+            upsert=True
+        )
+
+    # ============== EXPORT ==============
+
+    def iter_export(self, collezione: str, user_id: str, dal: Optional[str], fino_a: str) -> AsyncIterator[dict]:
+        return pagination.iter_documents(
+            self.db[collezione],
+            {"user_id": user_id, "$or": dates.datetime_range_filter("created_at", dal, fino_a)},
+            EXPORT_ID_FIELDS[collezione]
+        )
+
+    # ============== NOTIFICHE ==============
+
+    async def list_notifiche(self, user_id: str, limit: int = 100) -> List[dict]:
+        return await self.db.notifiche.find(
+            {"user_id": user_id},
+            {"_id": 0}
+        ).sort("created_at", -1).to_list(limit)
+
+    async def mark_notifica_letta(self, user_id: str, notifica_id: str) -> Optional[bool]:
+        result = await self.db.notifiche.update_one(
+            {"notifica_id": notifica_id, "user_id": user_id},
+            {"$set": {"letta": True}}
+        )
+        if result.matched_count == 0:
+            return None
+        # Solo la richiesta che ha davvero cambiato `letta` decrementa il contatore
+        if result.modified_count:
+            await notifications.decrement_unread(self.db, user_id)
+        return result.modified_count > 0
+
+    async def mark_all_notifiche_lette(self, user_id: str) -> int:
+        return await notifications.mark_all_read(self.db, user_id)
+
+    async def get_unread_count(self, user_id: str) -> int:
+        return await notifications.get_unread_count(self.db, user_id)
+
+    async def recent_notification_keys(self, user_ids: List[str], tipi: List[str], since: str) -> Tuple[Set[tuple], Set[tuple]]:
+        unread, every = set(), set()
+        async for doc in self.db.notifiche.find(
+            {
+                "user_id": {"$in": user_ids},
+                "tipo": {"$in": tipi},
+                "created_at": {"$gte": since}
+            },
+            {"_id": 0, "user_id": 1, "tipo": 1, "soggetto": 1, "letta": 1}
+        ):
+            key = (doc["user_id"], doc["tipo"], doc.get("soggetto"))
+            every.add(key)
+            if not doc.get("letta"):
+                unread.add(key)
+        return unread, every
+
+    async def insert_notifiche(self, docs: List[dict]):
+        await self.db.notifiche.insert_many([d.copy() for d in docs], ordered=False)
+        await notifications.increment_unread(self.db, docs)
+
+    async def get_fcm_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        tokens = {}
+        async for user_doc in self.db.users.find(
+            {"user_id": {"$in": user_ids}, "fcm_token": {"$nin": [None, ""]}},
+            {"_id": 0, "user_id": 1, "fcm_token": 1}
+        ):
+            tokens[user_doc["user_id"]] = user_doc["fcm_token"]
+        return tokens
+
+    async def remove_fcm_tokens(self, pairs: Set[Tuple[str, str]]) -> int:
+        result = await self.db.users.bulk_write(
+            [
+                UpdateOne({"user_id": user_id, "fcm_token": token}, {"$unset": {"fcm_token": ""}})
+                for user_id, token in sorted(pairs)
+            ],
+            ordered=False
+        )
+        return result.modified_count
+
+    # ============== INSIGHT ==============
+
+    async def find_insights(self, user_id: str, data: str) -> List[dict]:
+        return await self.db.insights_ai.find(
+            {"user_id": user_id, "data": data},
+            {"_id": 0}
+        ).to_list(100)
+
+    async def store_insights(self, insights: List[dict]):
+        # Un insight a regole salvato lascia il posto a quello nuovo
+        await self.db.insights_ai.bulk_write([
+            ReplaceOne({"user_id": i["user_id"], "data": i["data"], "tipo": i["tipo"], "fallback": True}, i.copy())
+            for i in insights
+        ], ordered=False)
+        try:
+            await self.db.insights_ai.bulk_write([
+                UpdateOne(
+                    {"user_id": i["user_id"], "data": i["data"], "tipo": i["tipo"]},
+                    {"$setOnInsert": i.copy()},
+                    upsert=True
+                )
+                for i in insights
+            ], ordered=False)
+        except BulkWriteError as e:
+            # Duplicate key: un altro worker ha salvato lo stesso insight per primo
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+
+    async def completed_batch_users(self, run_id: str) -> Set[str]:
+        completed = set()
+        async for row in self.db.insights_batch_progress.find(
+            {"run_id": run_id, "stato": "completato"},
+            {"_id": 0, "user_id": 1}
+        ):
+            completed.add(row["user_id"])
+        return completed
+
+    async def set_batch_progress(self, run_id: str, user_id: str, stato: str):
+        await self.db.insights_batch_progress.update_one(
+            {"run_id": run_id, "user_id": user_id},
+            {"$set": {"stato": stato, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+
+    async def reset_batch_progress(self, run_id: str):
+        await self.db.insights_batch_progress.delete_many({"run_id": run_id})
+
+
+def _check_risorse(risorse: List[str]):
+    sconosciute = [r for r in risorse if r not in RISORSE_VERSIONATE]
+    if sconosciute:
+        raise ValueError(f"Risorse senza versione: {', '.join(sconosciute)}")
+
+
+def _ledger_query(user_id: str, data: Optional[str], dal: Optional[date] = None,
+                  al: Optional[date] = None) -> dict:
+    query = {"user_id": user_id}
+    if data:
+        query["data"] = dates.data_filter(data)
+    if dal is not None or al is not None:
+        query["$and"] = [{"$or": dates.data_range_filter(dal, al)}]
+    return query
+
+
+def _ledger_to_mongo(doc: dict) -> dict:
+    # Date native su MongoDB (vedi dates.py)
+    return {
+        **doc,
+        "data": dates.data_to_mongo(doc["data"]),
+        "created_at": dates.to_datetime(doc["created_at"])
+    }
+
+
+def _ledger_from_mongo(doc: dict) -> dict:
+    # Stessi campi del backend SQLite, qualunque sia la forma salvata
+    return {
+        **doc,
+        "data": dates.format_data(doc["data"]),
+        "created_at": dates.to_datetime(doc["created_at"])
+    }
+
+
+async def _record_ledger(db, collezione: str, doc: dict, segno: int = 1):
+    if collezione == "entrate":
+        await ledger.record_entrata(db, doc["user_id"], doc["data"], doc["importo"], segno=segno)
+    else:
+        await ledger.record_costo_variabile(db, doc["user_id"], doc["data"], doc["importo"], segno=segno)
+
+
+def create_storage(backend: str = "mongo", mongo_url: Optional[str] = None, db_name: Optional[str] = None,
+                   sqlite_path: Optional[str] = None) -> Storage:
+    """
+    Backend scelto da STORAGE_BACKEND
+
+    Raises:
+        ValueError: backend sconosciuto o configurazione mancante
+    """
+    if backend == "mongo":
+        if not mongo_url or not db_name:
+            raise ValueError("STORAGE_BACKEND=mongo richiede MONGO_URL e DB_NAME")
+        # Letto qui e non all'import: test e benchmark possono sostituire il client
+        from motor.motor_asyncio import AsyncIOMotorClient
+        # Il command listener porta il tempo del database in metrics.py
+        client = AsyncIOMotorClient(mongo_url, event_listeners=[metrics.CommandMetricsListener()])
+        return MongoStorage(client, db_name)
+    if backend == "sqlite":
+        if not sqlite_path:
+            raise ValueError("STORAGE_BACKEND=sqlite richiede SQLITE_PATH")
+        from storage_sqlite import SqliteStorage
+        return SqliteStorage(sqlite_path)
+    raise ValueError(f"STORAGE_BACKEND non valido: {backend}")
+
+
+__all__ = ['LEDGER_ID_FIELDS', 'EXPORT_ID_FIELDS', 'RISORSE_VERSIONATE', 'BACKENDS', 'Storage', 'MongoStorage', 'create_storage']
@@ -0,0 +1,1007 @@
+# SQLite Storage
+# Backend di storage su un file SQLite (STORAGE_BACKEND=sqlite): nessun
+# server da gestire, per i test e per le installazioni di un solo negozio.
+#
+# Una sola connessione, usata da un thread dedicato: le operazioni sono
+# serializzate e le letture-modifica-scrittura (giacenze, rettifiche, media
+# dei consumi) girano in una transazione. Con più processi sullo stesso file
+# il WAL permette letture concorrenti e BEGIN IMMEDIATE serializza le
+# scritture.
+#
+# La dashboard non ha riepiloghi materializzati: totali del giorno e serie
+# per periodo sono aggregazioni SQL sugli indici (user_id, data, importo)
+# di entrate e costi variabili.
+
+import asyncio
+import json
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+
+import bulk_import
+import dates
+import ledger
+import metrics
+import movimenti
+import notifications
+import pagination
+from storage import EXPORT_ID_FIELDS, LEDGER_ID_FIELDS, RISORSE_VERSIONATE, Storage
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    name TEXT,
+    password_hash TEXT,
+    picture TEXT,
+    created_at TEXT,
+    subscription_tier TEXT,
+    auth_method TEXT,
+    fcm_token TEXT,
+    last_seen_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS user_sessions (
+    session_token TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS user_sessions_expires_at ON user_sessions (expires_at);
+-- Utenti attivi per insights_batch.py
+CREATE INDEX IF NOT EXISTS user_sessions_created_at_user_id ON user_sessions (created_at, user_id);
+
+CREATE TABLE IF NOT EXISTS user_profiles (
+    user_id TEXT PRIMARY KEY,
+    tipo_attivita TEXT,
+    settore TEXT,
+    obiettivi TEXT,
+    created_at TEXT
+);
+
+-- Documento JSON: PATCH /api/profile/notifications accetta campi liberi
+CREATE TABLE IF NOT EXISTS notification_preferences (
+    user_id TEXT PRIMARY KEY,
+    dati TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notification_preferences_push_enabled
+    ON notification_preferences (json_extract(dati, '$.notifiche_push_enabled'));
+
+CREATE TABLE IF NOT EXISTS entrate (
+    entrata_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    descrizione TEXT,
+    importo REAL NOT NULL,
+    data TEXT NOT NULL,
+    tipo TEXT,
+    created_at TEXT NOT NULL
+);
+-- Copre le somme della dashboard senza leggere le righe
+CREATE INDEX IF NOT EXISTS entrate_user_id_data_importo ON entrate (user_id, data, importo);
+-- Keyset pagination su (created_at, id)
+CREATE INDEX IF NOT EXISTS entrate_user_id_created_at_id ON entrate (user_id, created_at, entrata_id);
+
+CREATE TABLE IF NOT EXISTS costi_variabili (
+    costo_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    descrizione TEXT,
+    importo REAL NOT NULL,
+    data TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS costi_variabili_user_id_data_importo ON costi_variabili (user_id, data, importo);
+CREATE INDEX IF NOT EXISTS costi_variabili_user_id_created_at_id ON costi_variabili (user_id, created_at, costo_id);
+
+CREATE TABLE IF NOT EXISTS costi_fissi (
+    costo_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    descrizione TEXT,
+    importo_mensile REAL,
+    quota_giornaliera REAL NOT NULL,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS costi_fissi_user_id ON costi_fissi (user_id);
+
+CREATE TABLE IF NOT EXISTS materiali (
+    materiale_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    nome TEXT,
+    quantita_disponibile REAL NOT NULL DEFAULT 0,
+    unita_misura TEXT,
+    consumo_medio_giornaliero REAL,
+    giorni_consegna INTEGER,
+    costo_unitario REAL,
+    fornitore TEXT,
+    fornitore_email TEXT,
+    fornitore_telefono TEXT,
+    fornitore_sito TEXT,
+    consumo_ewma REAL,
+    consumo_ewma_var REAL,
+    consumo_ewma_fino_al TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS materiali_user_id ON materiali (user_id);
+
+CREATE TABLE IF NOT EXISTS movimenti_materiali (
+    movimento_id TEXT PRIMARY KEY,
+    materiale_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    quantita REAL NOT NULL,
+    quantita_dopo REAL,
+    note TEXT,
+    data TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS movimenti_materiali_user_id_materiale_id_created_at
+    ON movimenti_materiali (user_id, materiale_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS consumi_giornalieri (
+    materiale_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    quantita REAL NOT NULL,
+    PRIMARY KEY (materiale_id, data)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS notifiche (
+    notifica_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    soggetto TEXT,
+    titolo TEXT,
+    messaggio TEXT,
+    letta INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notifiche_user_id_created_at ON notifiche (user_id, created_at DESC);
+-- Conteggio delle non lette e deduplica senza leggere le righe
+CREATE INDEX IF NOT EXISTS notifiche_user_id_letta_created_at ON notifiche (user_id, letta, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS insights_ai (
+    insight_id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    tipo TEXT NOT NULL,
+    contenuto TEXT,
+    -- Testo a regole, rigenerato dopo expires_at
+    fallback INTEGER,
+    expires_at TEXT,
+    created_at TEXT,
+    -- Un solo insight per tipo e giorno: protegge da generazioni concorrenti
+    UNIQUE (user_id, data, tipo)
+);
+
+-- Versioni per gli ETag dei GET (storage.RISORSE_VERSIONATE)
+CREATE TABLE IF NOT EXISTS versioni (
+    user_id TEXT PRIMARY KEY,
+    epoca TEXT NOT NULL,
+    dashboard INTEGER NOT NULL DEFAULT 0,
+    materiali INTEGER NOT NULL DEFAULT 0,
+    costi_fissi INTEGER NOT NULL DEFAULT 0,
+    profile INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS insights_batch_progress (
+    run_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    stato TEXT NOT NULL,
+    updated_at TEXT,
+    PRIMARY KEY (run_id, user_id)
+) WITHOUT ROWID;
+"""
+
+# Colonne con valori JSON e booleani, convertiti in lettura e scrittura
+# Colonne aggiunte dopo la prima versione di SCHEMA: CREATE TABLE IF NOT
+# EXISTS non le aggiunge ai file esistenti, _schema sì
+ADDED_COLUMNS = [
+    ("users", "last_seen_at", "TEXT"),
+    ("insights_ai", "fallback", "INTEGER"),
+    ("insights_ai", "expires_at", "TEXT")
+]
+
+# Indici sulle colonne aggiunte, creati dopo la migrazione
+ADDED_INDEXES = """
+-- Utenti attivi per insights_batch.py
+CREATE INDEX IF NOT EXISTS users_last_seen_at ON users (last_seen_at);
+"""
+
+_JSON_COLUMNS = {"user_profiles": ("obiettivi",)}
+_BOOL_COLUMNS = {"notifiche": ("letta",), "insights_ai": ("fallback",)}
+# REAL salvati come interi (es. 8.0) tornano int da RETURNING: riportati a float come su MongoDB
+_REAL_COLUMNS = {
+    "entrate": ("importo",),
+    "costi_variabili": ("importo",),
+    "costi_fissi": ("importo_mensile", "quota_giornaliera"),
+    "materiali": ("quantita_disponibile", "consumo_medio_giornaliero", "costo_unitario", "consumo_ewma", "consumo_ewma_var"),
+    "movimenti_materiali": ("quantita", "quantita_dopo")
+}
+
+# Chiave del periodo calcolata in SQL, come ledger.period_key. Settimana
+# ISO: anno e numero del giovedì della settimana (SQLite < 3.46 non ha %G/%V)
+_GIOVEDI = "date(data, '-3 days', 'weekday 4')"
+_PERIOD_SQL = {
+    "day": "data",
+    "week": f"printf('%s-W%02d', strftime('%Y', {_GIOVEDI}), (CAST(strftime('%j', {_GIOVEDI}) AS INTEGER) - 1) / 7 + 1)",
+    "month": "substr(data, 1, 7)"
+}
+
+# Parametri per istruzione: i gruppi di utenti dello sweeper stanno sotto il limite di SQLite
+MAX_PARAMS = 900
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _placeholders(values) -> str:
+    return ", ".join("?" for _ in values)
+
+
+def _chunks(values: list, size: int = MAX_PARAMS):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _to_db(table: str, column: str, value):
+    if column in _JSON_COLUMNS.get(table, ()):
+        return json.dumps(value)
+    # Date e orari come testo ISO: l'ordine lessicografico è quello cronologico
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _to_doc(table: str, row: Optional[sqlite3.Row]) -> Optional[dict]:
+    if row is None:
+        return None
+    doc = dict(row)
+    for column in _JSON_COLUMNS.get(table, ()):
+        if doc.get(column) is not None:
+            doc[column] = json.loads(doc[column])
+    for column in _BOOL_COLUMNS.get(table, ()):
+        if doc.get(column) is not None:
+            doc[column] = bool(doc[column])
+    for column in _REAL_COLUMNS.get(table, ()):
+        if doc.get(column) is not None:
+            doc[column] = float(doc[column])
+    return doc
+
+
+class SqliteStorage(Storage):
+    """
+    Backend SQLite
+
+    Args:
+        path: file del database (":memory:" per un database temporaneo)
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._columns: Dict[str, Set[str]] = {}
+
+    # ============== CONNESSIONE ==============
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: le transazioni sono esplicite (_transaction)
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        # Shard dello sweeper calcolato nella query (iter_push_enabled_preferences)
+        conn.create_function("shard_hash", 1, notifications.shard_hash, deterministic=True)
+        conn.execute("PRAGMA busy_timeout = 5000")
+        if self.path != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        _schema(conn)
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            self._columns[table] = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        return conn
+
+    def _call(self, fn, args):
+        if self._conn is None:
+            self._conn = self._connect()
+        return fn(self._conn, *args)
+
+    async def _run(self, fn, *args):
+        """Esegue fn(conn, *args) nel thread del database"""
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+        finally:
+            metrics.observe_sqlite(time.perf_counter() - started, fn.__name__.lstrip("_"))
+
+    async def ensure_schema(self, dry_run: bool = False):
+        # Le tabelle sono create all'apertura della connessione (CREATE ... IF NOT EXISTS)
+        if dry_run:
+            print(SCHEMA)
+            return
+        await self._run(_schema)
+
+    async def close(self):
+        def _close(conn):
+            conn.close()
+
+        if self._conn is not None:
+            await self._run(_close)
+            self._conn = None
+        self._executor.shutdown(wait=True)
+
+    def _check_columns(self, table: str, fields) -> List[str]:
+        columns = list(fields)
+        unknown = [c for c in columns if c not in self._columns[table]]
+        if unknown:
+            raise ValueError(f"Campi non previsti in {table}: {', '.join(unknown)}")
+        return columns
+
+    def _insert(self, conn, table: str, doc: dict, or_ignore: bool = False) -> int:
+        columns = self._check_columns(table, doc)
+        cursor = conn.execute(
+            f"INSERT {'OR IGNORE ' if or_ignore else ''}INTO {table} ({', '.join(columns)}) "
+            f"VALUES ({_placeholders(columns)})",
+            [_to_db(table, c, doc[c]) for c in columns]
+        )
+        return cursor.rowcount
+
+    def _update(self, conn, table: str, fields: dict, where: dict) -> int:
+        columns = self._check_columns(table, fields)
+        cursor = conn.execute(
+            f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)} "
+            f"WHERE {' AND '.join(f'{c} = ?' for c in where)}",
+            [_to_db(table, c, fields[c]) for c in columns] + list(where.values())
+        )
+        return cursor.rowcount
+
+    def _find_one(self, conn, table: str, where: dict) -> Optional[dict]:
+        row = conn.execute(
+            f"SELECT * FROM {table} WHERE {' AND '.join(f'{c} = ?' for c in where)} LIMIT 1",
+            list(where.values())
+        ).fetchone()
+        return _to_doc(table, row)
+
+    async def _get(self, table: str, **where) -> Optional[dict]:
+        def _find_one(conn):
+            return self._find_one(conn, table, where)
+        return await self._run(_find_one)
+
+    async def _add(self, table: str, doc: dict):
+        def _insert(conn):
+            self._insert(conn, table, doc)
+        await self._run(_insert)
+
+    # ============== UTENTI E SESSIONI ==============
+
+    async def get_user(self, user_id: str) -> Optional[dict]:
+        return await self._get("users", user_id=user_id)
+
+    async def get_user_by_email(self, email: str) -> Optional[dict]:
+        return await self._get("users", email=email)
+
+    async def insert_user(self, user_doc: dict):
+        await self._add("users", user_doc)
+
+    async def update_user(self, user_id: str, fields: dict) -> bool:
+        def _update_user(conn):
+            return self._update(conn, "users", fields, {"user_id": user_id}) > 0
+        return await self._run(_update_user)
+
+    async def replace_password_hash(self, user_id: str, old_hash: str, new_hash: str) -> bool:
+        def _replace_password_hash(conn):
+            return self._update(
+                conn, "users", {"password_hash": new_hash}, {"user_id": user_id, "password_hash": old_hash}
+            ) > 0
+        return await self._run(_replace_password_hash)
+
+    async def insert_session(self, session_doc: dict):
+        def _insert_session(conn):
+            with _transaction(conn):
+                # Niente TTL come in MongoDB: le sessioni scadute si eliminano qui
+                conn.execute(
+                    "DELETE FROM user_sessions WHERE expires_at < ?",
+                    (datetime.now(timezone.utc).isoformat(),)
+                )
+                self._insert(conn, "user_sessions", session_doc)
+        await self._run(_insert_session)
+
+    async def get_session(self, session_token: str) -> Optional[dict]:
+        return await self._get("user_sessions", session_token=session_token)
+
+    async def delete_session(self, session_token: str):
+        def _delete_session(conn):
+            conn.execute("DELETE FROM user_sessions WHERE session_token = ?", (session_token,))
+        await self._run(_delete_session)
+
+    async def iter_active_user_ids(self, since: datetime) -> AsyncIterator[str]:
+        def _active_user_ids(conn):
+            return [row[0] for row in conn.execute(
+                "SELECT user_id FROM users WHERE last_seen_at >= ? "
+                "UNION SELECT user_id FROM user_sessions WHERE created_at >= ? ORDER BY user_id",
+                (since.isoformat(), since.isoformat())
+            )]
+        for user_id in await self._run(_active_user_ids):
+            yield user_id
+
+    # ============== PROFILO E PREFERENZE ==============
+
+    async def get_profile(self, user_id: str) -> Optional[dict]:
+        return await self._get("user_profiles", user_id=user_id)
+
+    async def insert_profile(self, profile_doc: dict):
+        await self._add("user_profiles", profile_doc)
+
+    async def get_notification_preferences(self, user_id: str) -> Optional[dict]:
+        def _get_preferences(conn):
+            row = conn.execute(
+                "SELECT dati FROM notification_preferences WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+        return await self._run(_get_preferences)
+
+    async def insert_notification_preferences(self, prefs_doc: dict):
+        def _insert_preferences(conn):
+            conn.execute(
+                "INSERT INTO notification_preferences (user_id, dati) VALUES (?, ?)",
+                (prefs_doc["user_id"], json.dumps(prefs_doc))
+            )
+        await self._run(_insert_preferences)
+
+    async def update_notification_preferences(self, user_id: str, fields: dict):
+        def _update_preferences(conn):
+            # json_patch fonde i campi nel documento esistente, come $set
+            conn.execute(
+                "INSERT INTO notification_preferences (user_id, dati) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET dati = json_patch(dati, ?)",
+                (user_id, json.dumps({**fields, "user_id": user_id}), json.dumps(fields))
+            )
+        await self._run(_update_preferences)
+
+    async def iter_push_enabled_preferences(self, shard: int = 0, shards: int = 1) -> AsyncIterator[dict]:
+        def _push_enabled_page(conn, after, limit):
+            return [json.loads(row[1]) for row in conn.execute(
+                "SELECT user_id, dati FROM notification_preferences "
+                "WHERE json_extract(dati, '$.notifiche_push_enabled') = 1 AND user_id > ? "
+                "AND shard_hash(user_id) % ? = ? "
+                "ORDER BY user_id LIMIT ?",
+                (after, shards, shard, limit)
+            )]
+
+        after = ""
+        while True:
+            page = await self._run(_push_enabled_page, after, pagination.STREAM_BATCH_SIZE)
+            for prefs in page:
+                yield prefs
+            if len(page) < pagination.STREAM_BATCH_SIZE:
+                return
+            after = page[-1]["user_id"]
+
+    # ============== DASHBOARD ==============
+
+    async def get_dashboard_totals(self, user_id: str, data: str) -> dict:
+        def _dashboard_totals(conn):
+            totali = {}
+            for table, totale, num in (
+                ("entrate", "totale_entrate", "num_entrate"),
+                ("costi_variabili", "totale_costi_variabili", "num_costi_variabili")
+            ):
+                row = conn.execute(
+                    f"SELECT TOTAL(importo), COUNT(*) FROM {table} WHERE user_id = ? AND data = ?",
+                    (user_id, data)
+                ).fetchone()
+                totali[totale], totali[num] = row[0], row[1]
+            row = conn.execute(
+                "SELECT TOTAL(quota_giornaliera), COUNT(*) FROM costi_fissi WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            totali["totale_quota_fissi"], totali["num_costi_fissi"] = row[0], row[1]
+            return totali
+        return await self._run(_dashboard_totals)
+
+    async def get_dashboard_totals_many(self, user_ids: List[str], data: str) -> Dict[str, dict]:
+        def _dashboard_totals_many(conn):
+            totali = {
+                user_id: {"totale_entrate": 0, "totale_costi_variabili": 0, "totale_quota_fissi": 0}
+                for user_id in user_ids
+            }
+            for chunk in _chunks(user_ids):
+                for table, column, campo, giorno in (
+                    ("entrate", "importo", "totale_entrate", True),
+                    ("costi_variabili", "importo", "totale_costi_variabili", True),
+                    ("costi_fissi", "quota_giornaliera", "totale_quota_fissi", False)
+                ):
+                    sql = f"SELECT user_id, SUM({column}) FROM {table} WHERE user_id IN ({_placeholders(chunk)})"
+                    params = list(chunk)
+                    if giorno:
+                        sql += " AND data = ?"
+                        params.append(data)
+                    for user_id, totale in conn.execute(sql + " GROUP BY user_id", params):
+                        totali[user_id][campo] = totale
+            return totali
+        return await self._run(_dashboard_totals_many)
+
+    async def get_dashboard_range(self, user_id: str, dal: date, al: date, granularity: str = "day") -> list:
+        periodo = _PERIOD_SQL[granularity]
+
+        def _dashboard_range(conn):
+            # Prima le somme per giorno (sull'indice), poi il raggruppamento per periodo
+            rows = conn.execute(
+                f"""
+                SELECT {periodo} AS periodo, SUM(entrate) AS entrate, SUM(costi_variabili) AS costi_variabili
+                FROM (
+                    SELECT data, SUM(importo) AS entrate, 0.0 AS costi_variabili
+                    FROM entrate WHERE user_id = ? AND data BETWEEN ? AND ? GROUP BY data
+                    UNION ALL
+                    SELECT data, 0.0, SUM(importo)
+                    FROM costi_variabili WHERE user_id = ? AND data BETWEEN ? AND ? GROUP BY data
+                )
+                GROUP BY periodo
+                """,
+                (user_id, dal.isoformat(), al.isoformat()) * 2
+            ).fetchall()
+            quota_fissi = conn.execute(
+                "SELECT TOTAL(quota_giornaliera) FROM costi_fissi WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()[0]
+            return {row["periodo"]: dict(row) for row in rows}, quota_fissi
+
+        totali, quota_fissi = await self._run(_dashboard_range)
+        return ledger.build_dashboard_series(dal, al, granularity, totali, quota_fissi)
+
+    # ============== ENTRATE E COSTI ==============
+
+    def _ledger_page(self, conn, collezione: str, user_id: str, data: Optional[str], limit: int,
+                     after: Optional[tuple], dal: Optional[date] = None, al: Optional[date] = None) -> List[dict]:
+        id_field = LEDGER_ID_FIELDS[collezione]
+        sql = f"SELECT * FROM {collezione} WHERE user_id = ?"
+        params = [user_id]
+        if data:
+            sql += " AND data = ?"
+            params.append(dates.format_data(data))
+        if dal is not None:
+            sql += " AND data >= ?"
+            params.append(dates.format_data(dal))
+        if al is not None:
+            sql += " AND data <= ?"
+            params.append(dates.format_data(al))
+        if after:
+            sql += f" AND (created_at, {id_field}) > (?, ?)"
+            params.extend(_to_db(collezione, "created_at", value) for value in after)
+        sql += f" ORDER BY created_at, {id_field} LIMIT ?"
+        params.append(limit)
+        return [dict(row) for row in conn.execute(sql, params)]
+
+    async def list_ledger(self, collezione: str, user_id: str, data: Optional[str], limit: int,
+                          cursor: Optional[str] = None, dal: Optional[date] = None,
+                          al: Optional[date] = None) -> Tuple[List[dict], Optional[str]]:
+        after = pagination.decode_cursor(cursor) if cursor else None
+        docs = await self._run(self._ledger_page, collezione, user_id, data, limit + 1, after, dal, al)
+
+        next_cursor = None
+        if len(docs) > limit:
+            docs = docs[:limit]
+            last = docs[-1]
+            next_cursor = pagination.encode_cursor(last["created_at"], last[LEDGER_ID_FIELDS[collezione]])
+        return docs, next_cursor
+
+    async def iter_ledger(self, collezione: str, user_id: str, data: Optional[str], cursor: Optional[str] = None,
+                          dal: Optional[date] = None, al: Optional[date] = None) -> AsyncIterator[dict]:
+        id_field = LEDGER_ID_FIELDS[collezione]
+        after = pagination.decode_cursor(cursor) if cursor else None
+        while True:
+            page = await self._run(
+                self._ledger_page, collezione, user_id, data, pagination.STREAM_BATCH_SIZE, after, dal, al
+            )
+            for doc in page:
+                yield doc
+            if len(page) < pagination.STREAM_BATCH_SIZE:
+                return
+            after = (page[-1]["created_at"], page[-1][id_field])
+
+    async def insert_ledger(self, collezione: str, doc: dict):
+        await self._add(collezione, doc)
+
+    async def insert_ledger_many(self, collezione: str, user_id: str,
+                                 docs: List[Tuple[int, dict]]) -> Tuple[List[dict], List[dict]]:
+        def _insert_ledger_many(conn, chunk):
+            inserted, errors = [], []
+            with _transaction(conn):
+                for riga, doc in chunk:
+                    try:
+                        self._insert(conn, collezione, doc)
+                        inserted.append(doc)
+                    except sqlite3.IntegrityError as e:
+                        errors.append({"riga": riga, "errore": str(e)})
+            return inserted, errors
+
+        inserted, errors = [], []
+        # Una transazione per blocco: le altre richieste non aspettano l'intero file
+        for chunk in _chunks(docs, bulk_import.CHUNK_SIZE):
+            chunk_inserted, chunk_errors = await self._run(_insert_ledger_many, chunk)
+            inserted.extend(chunk_inserted)
+            errors.extend(chunk_errors)
+        return inserted, errors
+
+    async def delete_ledger(self, collezione: str, user_id: str, doc_id: str) -> Optional[dict]:
+        def _delete_ledger(conn):
+            rows = conn.execute(
+                f"DELETE FROM {collezione} WHERE {LEDGER_ID_FIELDS[collezione]} = ? AND user_id = ? RETURNING *",
+                (doc_id, user_id)
+            ).fetchall()
+            return _to_doc(collezione, rows[0]) if rows else None
+        return await self._run(_delete_ledger)
+
+    async def list_costi_fissi(self, user_id: str) -> List[dict]:
+        def _list_costi_fissi(conn):
+            return [dict(row) for row in conn.execute(
+                "SELECT * FROM costi_fissi WHERE user_id = ? ORDER BY created_at, costo_id LIMIT 1000",
+                (user_id,)
+            )]
+        return await self._run(_list_costi_fissi)
+
+    async def insert_costo_fisso(self, costo_doc: dict):
+        await self._add("costi_fissi", costo_doc)
+
+    async def delete_costo_fisso(self, user_id: str, costo_id: str) -> Optional[dict]:
+        def _delete_costo_fisso(conn):
+            rows = conn.execute(
+                "DELETE FROM costi_fissi WHERE costo_id = ? AND user_id = ? RETURNING *",
+                (costo_id, user_id)
+            ).fetchall()
+            return _to_doc("costi_fissi", rows[0]) if rows else None
+        return await self._run(_delete_costo_fisso)
+
+    # ============== MATERIALI ==============
+
+    async def list_materiali(self, user_id: str) -> List[dict]:
+        def _list_materiali(conn):
+            return [dict(row) for row in conn.execute(
+                "SELECT * FROM materiali WHERE user_id = ? ORDER BY created_at, materiale_id",
+                (user_id,)
+            )]
+        return await self._run(_list_materiali)
+
+    async def list_materiali_many(self, user_ids: List[str]) -> List[dict]:
+        def _list_materiali_many(conn):
+            materiali = []
+            for chunk in _chunks(user_ids):
+                materiali.extend(dict(row) for row in conn.execute(
+                    "SELECT materiale_id, user_id, nome, quantita_disponibile, consumo_medio_giornaliero, "
+                    "giorni_consegna, consumo_ewma, consumo_ewma_var, consumo_ewma_fino_al "
+                    f"FROM materiali WHERE user_id IN ({_placeholders(chunk)})",
+                    chunk
+                ))
+            return materiali
+        return await self._run(_list_materiali_many)
+
+    async def get_materiale(self, user_id: str, materiale_id: str) -> Optional[dict]:
+        return await self._get("materiali", materiale_id=materiale_id, user_id=user_id)
+
+    async def insert_materiale(self, materiale_doc: dict):
+        await self._add("materiali", materiale_doc)
+
+    async def update_materiale(self, user_id: str, materiale_id: str, fields: dict) -> bool:
+        def _update_materiale(conn):
+            return self._update(conn, "materiali", fields, {"materiale_id": materiale_id, "user_id": user_id}) > 0
+        return await self._run(_update_materiale)
+
+    async def delete_materiale(self, user_id: str, materiale_id: str) -> bool:
+        def _delete_materiale(conn):
+            with _transaction(conn):
+                if not conn.execute(
+                    "DELETE FROM materiali WHERE materiale_id = ? AND user_id = ?",
+                    (materiale_id, user_id)
+                ).rowcount:
+                    return False
+                # Storico e consumi del materiale non servono più a nessuna lettura
+                conn.execute(
+                    "DELETE FROM movimenti_materiali WHERE user_id = ? AND materiale_id = ?", (user_id, materiale_id)
+                )
+                conn.execute("DELETE FROM consumi_giornalieri WHERE materiale_id = ?", (materiale_id,))
+                return True
+        return await self._run(_delete_materiale)
+
+    def _fold_consumption(self, conn, materiale: dict, oggi: date):
+        # Stessi passi di movimenti.fold_consumption, dentro la transazione del movimento
+        ieri = oggi - timedelta(days=1)
+        ultimo = materiale.get("consumo_ewma_fino_al")
+        if ultimo and ultimo >= ieri.isoformat():
+            return
+
+        if ultimo:
+            inizio = date.fromisoformat(ultimo) + timedelta(days=1)
+        else:
+            primo = conn.execute(
+                "SELECT MIN(data) FROM consumi_giornalieri WHERE materiale_id = ? AND data <= ?",
+                (materiale["materiale_id"], ieri.isoformat())
+            ).fetchone()[0]
+            if primo is None:
+                return
+            inizio = date.fromisoformat(primo)
+
+        inizio = max(inizio, ieri - timedelta(days=movimenti.MAX_GIORNI_FOLD))
+        consumi = dict(conn.execute(
+            "SELECT data, quantita FROM consumi_giornalieri WHERE materiale_id = ? AND data BETWEEN ? AND ?",
+            (materiale["materiale_id"], inizio.isoformat(), ieri.isoformat())
+        ).fetchall())
+
+        update = movimenti.fold_update(materiale, inizio, ieri, consumi)
+        self._update(conn, "materiali", update, {"materiale_id": materiale["materiale_id"]})
+        materiale.update(update)
+
+    async def record_movimento(self, user_id: str, materiale_id: str, tipo: str, quantita: float,
+                               note: Optional[str] = None) -> Optional[Tuple[dict, dict]]:
+        def _record_movimento(conn):
+            delta = quantita if tipo == "carico" else -quantita
+            oggi = datetime.now(timezone.utc).date()
+            with _transaction(conn):
+                rows = conn.execute(
+                    "UPDATE materiali SET quantita_disponibile = quantita_disponibile + ? "
+                    "WHERE materiale_id = ? AND user_id = ? RETURNING *",
+                    (delta, materiale_id, user_id)
+                ).fetchall()
+                if not rows:
+                    return None
+                materiale = _to_doc("materiali", rows[0])
+
+                movimento = movimenti.build_movimento(
+                    user_id, materiale_id, tipo, quantita, materiale["quantita_disponibile"], note, oggi
+                )
+                self._insert(conn, "movimenti_materiali", movimento)
+
+                if tipo == "scarico":
+                    conn.execute(
+                        "INSERT INTO consumi_giornalieri (materiale_id, data, user_id, quantita) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (materiale_id, data) DO UPDATE SET quantita = quantita + excluded.quantita",
+                        (materiale_id, oggi.isoformat(), user_id, quantita)
+                    )
+
+                self._fold_consumption(conn, materiale, oggi)
+            return movimento, materiale
+        return await self._run(_record_movimento)
+
+    async def record_rettifica(self, user_id: str, materiale_id: str, quantita: float,
+                               altri_campi: Optional[dict] = None) -> Optional[dict]:
+        def _record_rettifica(conn):
+            with _transaction(conn):
+                precedente = conn.execute(
+                    "SELECT quantita_disponibile FROM materiali WHERE materiale_id = ? AND user_id = ?",
+                    (materiale_id, user_id)
+                ).fetchone()
+                if precedente is None:
+                    return None
+                self._update(
+                    conn, "materiali",
+                    {"quantita_disponibile": quantita, **(altri_campi or {})},
+                    {"materiale_id": materiale_id, "user_id": user_id}
+                )
+                movimento = movimenti.build_movimento(
+                    user_id, materiale_id, "rettifica", quantita - (precedente[0] or 0), quantita
+                )
+                self._insert(conn, "movimenti_materiali", movimento)
+            return movimento
+        return await self._run(_record_rettifica)
+
+    async def list_movimenti(self, user_id: str, materiale_id: str, limit: int) -> List[dict]:
+        def _list_movimenti(conn):
+            return [dict(row) for row in conn.execute(
+                "SELECT * FROM movimenti_materiali WHERE user_id = ? AND materiale_id = ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (user_id, materiale_id, limit)
+            )]
+        return await self._run(_list_movimenti)
+
+    # ============== VERSIONI ==============
+
+    async def get_versions(self, user_id: str) -> dict:
+        def _get_versions(conn):
+            # Se un'altra richiesta ha già creato i contatori vince la sua epoca
+            conn.execute(
+                "INSERT OR IGNORE INTO versioni (user_id, epoca) VALUES (?, ?)", (user_id, uuid.uuid4().hex)
+            )
+            row = conn.execute(
+                f"SELECT epoca, {', '.join(RISORSE_VERSIONATE)} FROM versioni WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            return dict(row)
+        return await self._run(_get_versions)
+
+    async def bump_versions(self, user_id: str, risorse: List[str]):
+        sconosciute = [r for r in risorse if r not in RISORSE_VERSIONATE]
+        if sconosciute:
+            raise ValueError(f"Risorse senza versione: {', '.join(sconosciute)}")
+
+        def _bump_versions(conn):
+            conn.execute(
+                f"INSERT INTO versioni (user_id, epoca, updated_at, {', '.join(risorse)}) "
+                f"VALUES (?, ?, ?, {', '.join('1' for _ in risorse)}) "
+                f"ON CONFLICT (user_id) DO UPDATE SET updated_at = excluded.updated_at, "
+                + ", ".join(f"{r} = {r} + 1" for r in risorse),
+                (user_id, uuid.uuid4().hex, datetime.now(timezone.utc).isoformat())
+            )
+        await self._run(_bump_versions)
+
+    # ============== EXPORT ==============
+
+    def _export_page(self, conn, collezione: str, user_id: str, dal: Optional[str], fino_a: str, limit: int,
+                     after: Optional[Tuple[str, str]]) -> List[dict]:
+        id_field = EXPORT_ID_FIELDS[collezione]
+        sql = f"SELECT * FROM {collezione} WHERE user_id = ? AND created_at <= ?"
+        params = [user_id, fino_a]
+        if dal:
+            sql += " AND created_at > ?"
+            params.append(dal)
+        if after:
+            sql += f" AND (created_at, {id_field}) > (?, ?)"
+            params.extend(after)
+        sql += f" ORDER BY created_at, {id_field} LIMIT ?"
+        params.append(limit)
+        return [_to_doc(collezione, row) for row in conn.execute(sql, params)]
+
+    async def iter_export(self, collezione: str, user_id: str, dal: Optional[str],
+                          fino_a: str) -> AsyncIterator[dict]:
+        id_field = EXPORT_ID_FIELDS[collezione]
+        after = None
+        while True:
+            page = await self._run(
+                self._export_page, collezione, user_id, dal, fino_a, pagination.STREAM_BATCH_SIZE, after
+            )
+            for doc in page:
+                yield doc
+            if len(page) < pagination.STREAM_BATCH_SIZE:
+                return
+            after = (page[-1]["created_at"], page[-1][id_field])
+
+    # ============== NOTIFICHE ==============
+
+    async def list_notifiche(self, user_id: str, limit: int = 100) -> List[dict]:
+        def _list_notifiche(conn):
+            return [_to_doc("notifiche", row) for row in conn.execute(
+                "SELECT * FROM notifiche WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit)
+            )]
+        return await self._run(_list_notifiche)
+
+    async def mark_notifica_letta(self, user_id: str, notifica_id: str) -> Optional[bool]:
+        def _mark_notifica_letta(conn):
+            row = conn.execute(
+                "SELECT letta FROM notifiche WHERE notifica_id = ? AND user_id = ?",
+                (notifica_id, user_id)
+            ).fetchone()
+            if row is None:
+                return None
+            return conn.execute(
+                "UPDATE notifiche SET letta = 1 WHERE notifica_id = ? AND user_id = ? AND letta = 0",
+                (notifica_id, user_id)
+            ).rowcount > 0
+        return await self._run(_mark_notifica_letta)
+
+    async def mark_all_notifiche_lette(self, user_id: str) -> int:
+        def _mark_all_notifiche_lette(conn):
+            return conn.execute(
+                "UPDATE notifiche SET letta = 1 WHERE user_id = ? AND letta = 0", (user_id,)
+            ).rowcount
+        return await self._run(_mark_all_notifiche_lette)
+
+    async def get_unread_count(self, user_id: str) -> int:
+        # Nessun contatore: il conteggio legge solo l'indice (user_id, letta, created_at)
+        def _unread_count(conn):
+            return conn.execute(
+                "SELECT COUNT(*) FROM notifiche WHERE user_id = ? AND letta = 0", (user_id,)
+            ).fetchone()[0]
+        return await self._run(_unread_count)
+
+    async def recent_notification_keys(self, user_ids: List[str], tipi: List[str], since: str) -> Tuple[Set[tuple], Set[tuple]]:
+        def _recent_notification_keys(conn):
+            unread, every = set(), set()
+            for chunk in _chunks(user_ids, MAX_PARAMS - len(tipi) - 1):
+                for row in conn.execute(
+                    "SELECT user_id, tipo, soggetto, letta FROM notifiche "
+                    f"WHERE user_id IN ({_placeholders(chunk)}) AND tipo IN ({_placeholders(tipi)}) AND created_at >= ?",
+                    [*chunk, *tipi, since]
+                ):
+                    key = (row["user_id"], row["tipo"], row["soggetto"])
+                    every.add(key)
+                    if not row["letta"]:
+                        unread.add(key)
+            return unread, every
+        return await self._run(_recent_notification_keys)
+
+    async def insert_notifiche(self, docs: List[dict]):
+        def _insert_notifiche(conn):
+            with _transaction(conn):
+                for doc in docs:
+                    self._insert(conn, "notifiche", doc)
+        await self._run(_insert_notifiche)
+
+    async def get_fcm_tokens(self, user_ids: List[str]) -> Dict[str, str]:
+        def _fcm_tokens(conn):
+            tokens = {}
+            for chunk in _chunks(user_ids):
+                for user_id, token in conn.execute(
+                    f"SELECT user_id, fcm_token FROM users WHERE user_id IN ({_placeholders(chunk)}) "
+                    "AND fcm_token IS NOT NULL AND fcm_token != ''",
+                    chunk
+                ):
+                    tokens[user_id] = token
+            return tokens
+        return await self._run(_fcm_tokens)
+
+    async def remove_fcm_tokens(self, pairs: Set[Tuple[str, str]]) -> int:
+        def _remove_fcm_tokens(conn):
+            removed = 0
+            with _transaction(conn):
+                for user_id, token in sorted(pairs):
+                    removed += conn.execute(
+                        "UPDATE users SET fcm_token = NULL WHERE user_id = ? AND fcm_token = ?",
+                        (user_id, token)
+                    ).rowcount
+            return removed
+        return await self._run(_remove_fcm_tokens)
+
+    # ============== INSIGHT ==============
+
+    async def find_insights(self, user_id: str, data: str) -> List[dict]:
+        def _find_insights(conn):
+            return [_to_doc("insights_ai", row) for row in conn.execute(
+                "SELECT * FROM insights_ai WHERE user_id = ? AND data = ? LIMIT 100",
+                (user_id, data)
+            )]
+        return await self._run(_find_insights)
+
+    async def store_insights(self, insights: List[dict]):
+        def _store_insights(conn):
+            with _transaction(conn):
+                for insight in insights:
+                    # Un insight a regole salvato lascia il posto a quello nuovo
+                    columns = self._check_columns("insights_ai", insight)
+                    conn.execute(
+                        f"INSERT INTO insights_ai ({', '.join(columns)}) VALUES ({_placeholders(columns)}) "
+                        f"ON CONFLICT (user_id, data, tipo) DO UPDATE SET "
+                        f"{', '.join(f'{c} = excluded.{c}' for c in columns)} WHERE insights_ai.fallback = 1",
+                        [_to_db("insights_ai", c, insight[c]) for c in columns]
+                    )
+        await self._run(_store_insights)
+
+    async def completed_batch_users(self, run_id: str) -> Set[str]:
+        def _completed_batch_users(conn):
+            return {row[0] for row in conn.execute(
+                "SELECT user_id FROM insights_batch_progress WHERE run_id = ? AND stato = 'completato'",
+                (run_id,)
+            )}
+        return await self._run(_completed_batch_users)
+
+    async def set_batch_progress(self, run_id: str, user_id: str, stato: str):
+        def _set_batch_progress(conn):
+            conn.execute(
+                "INSERT INTO insights_batch_progress (run_id, user_id, stato, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (run_id, user_id) DO UPDATE SET stato = excluded.stato, updated_at = excluded.updated_at",
+                (run_id, user_id, stato, datetime.now(timezone.utc).isoformat())
+            )
+        await self._run(_set_batch_progress)
+
+    async def reset_batch_progress(self, run_id: str):
+        def _reset_batch_progress(conn):
+            conn.execute("DELETE FROM insights_batch_progress WHERE run_id = ?", (run_id,))
+        await self._run(_reset_batch_progress)
+
+
+def _schema(conn):
+    conn.executescript(SCHEMA)
+    for table, column, tipo in ADDED_COLUMNS:
+        if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {tipo}")
+    conn.executescript(ADDED_INDEXES)
+
+
+__all__ = ['SCHEMA', 'ADDED_COLUMNS', 'ADDED_INDEXES', 'SqliteStorage']
@@ -0,0 +1,96 @@
+# Test Fixtures
+# L'app FastAPI gira in processo (httpx ASGITransport) sopra uno storage
+# nuovo per ogni test. La fixture `store` è parametrizzata: ogni test che
+# la usa, direttamente o tramite `client`, gira una volta con MongoDB
+# (mongomock-motor, nessun server necessario) e una con SQLite su un file
+# temporaneo.
+#
+# server.py crea store, cache delle sessioni e dispatcher push all'import:
+# le fixture li sostituiscono, gli hook di startup non vengono eseguiti.
+
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import httpx
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND_DIR))
+
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = ":memory:"
+os.environ["MONGO_URL"] = "mongodb://localhost:27017"
+os.environ["DB_NAME"] = "balance_test"
+os.environ["LLM_BACKEND"] = "fake"
+os.environ["LLM_FAKE_LATENCY"] = "0"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["NOTIFICHE_SWEEP_INTERVAL"] = "0"
+
+# Prima di ogni import di storage/server: create_storage legge il client da qui
+import motor.motor_asyncio  # noqa: E402
+import mongomock_motor  # noqa: E402
+
+motor.motor_asyncio.AsyncIOMotorClient = mongomock_motor.AsyncMongoMockClient
+
+import server  # noqa: E402
+import storage  # noqa: E402
+from session_cache import SessionCache  # noqa: E402
+
+BACKENDS = ("mongo", "sqlite")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(params=BACKENDS)
+async def store(request, tmp_path):
+    if request.param == "mongo":
+        backend = storage.create_storage(
+            "mongo", mongo_url=os.environ["MONGO_URL"], db_name=f"balance_test_{uuid.uuid4().hex[:8]}"
+        )
+    else:
+        backend = storage.create_storage("sqlite", sqlite_path=str(tmp_path / "balance.db"))
+    await backend.ensure_schema()
+    yield backend
+    await backend.close()
+
+
+@pytest.fixture
+async def client(store, monkeypatch):
+    monkeypatch.setattr(server, "store", store)
+    monkeypatch.setattr(server.push_dispatcher, "store", store)
+    monkeypatch.setattr(server, "session_cache", SessionCache())
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="https://test") as http:
+        yield http
+
+
+@pytest.fixture
+def register(client):
+    """Registra un utente e restituisce gli header Authorization"""
+    async def _register(email: str = "mario@example.it", name: str = "Mario") -> dict:
+        response = await client.post(
+            "/api/auth/register", json={"email": email, "password": "password123", "name": name}
+        )
+        assert response.status_code == 200, response.text
+        # Il cookie avrebbe la precedenza sull'header: ogni test sceglie l'utente con Authorization
+        client.cookies.clear()
+        return {"Authorization": f"Bearer {response.cookies.get('session_token')}"}
+    return _register
+
+
+@pytest.fixture
+async def auth(client, register) -> dict:
+    """Header di un utente registrato con onboarding completato"""
+    headers = await register()
+    response = await client.post(
+        "/api/onboarding",
+        headers=headers,
+        json={"tipo_attivita": "negozio", "settore": "commercio", "obiettivi": ["risparmiare"]}
+    )
+    assert response.status_code == 200, response.text
+    return headers
@@ -0,0 +1,235 @@
+# Test API
+# Flussi principali dell'API su entrambi i backend di storage (vedi
+# conftest.py): lo stesso test deve dare lo stesso risultato con MongoDB e
+# con SQLite.
+
+from datetime import date, timedelta
+
+import logging
+
+import pytest
+
+import compression
+import notifications
+import serialization
+import server
+
+pytestmark = pytest.mark.anyio
+
+OGGI = date.today()
+
+
+async def test_register_login_logout(client, register):
+    headers = await register(email="luca@example.it", name="Luca")
+
+    response = await client.get("/api/auth/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["user"]["email"] == "luca@example.it"
+    assert response.json()["has_profile"] is False
+
+    response = await client.post("/api/auth/register", json={"email": "luca@example.it", "password": "x", "name": "L"})
+    assert response.status_code == 400
+
+    response = await client.post("/api/auth/login", json={"email": "luca@example.it", "password": "sbagliata"})
+    assert response.status_code == 401
+    response = await client.post("/api/auth/login", json={"email": "luca@example.it", "password": "password123"})
+    assert response.status_code == 200
+    token = response.cookies.get("session_token")
+
+    # Il logout legge la sessione dal cookie impostato dal login
+    response = await client.post("/api/auth/logout")
+    assert response.status_code == 200
+    response = await client.get("/api/auth/me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 401
+    response = await client.get("/api/auth/me", headers=headers)
+    assert response.status_code == 200
+
+
+async def test_profile_and_notification_preferences(client, auth):
+    response = await client.get("/api/profile", headers=auth)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["profile"]["tipo_attivita"] == "negozio"
+    assert body["notification_preferences"]["notifiche_stato"] is True
+
+    response = await client.patch("/api/profile/notifications", headers=auth, json={"notifiche_stato": False})
+    assert response.status_code == 200
+    response = await client.get("/api/profile", headers=auth)
+    assert response.json()["notification_preferences"]["notifiche_stato"] is False
+
+
+async def test_dashboard_totals(client, auth):
+    ieri = OGGI - timedelta(days=1)
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "vendite", "importo": 250.5, "data": OGGI.isoformat()})
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "vendite", "importo": 100, "data": ieri.isoformat()})
+    response = await client.post("/api/costi/variabili", headers=auth, json={"descrizione": "spesa", "importo": 40, "data": OGGI.isoformat()})
+    costo_id = response.json()["costo_id"]
+    await client.post("/api/costi/fissi", headers=auth, json={"descrizione": "affitto", "importo_mensile": 300})
+
+    response = await client.get("/api/dashboard", headers=auth, params={"data": OGGI.isoformat()})
+    assert response.status_code == 200
+    dashboard = response.json()
+    assert dashboard["entrate"] == 250.5
+    assert dashboard["costi_variabili"] == 40
+    assert dashboard["quota_fissi"] == 10
+    assert dashboard["utile"] == 200.5
+    assert dashboard["stato"] == "positivo"
+
+    response = await client.delete(f"/api/costi/variabili/{costo_id}", headers=auth)
+    assert response.status_code == 200
+    response = await client.get("/api/dashboard", headers=auth, params={"data": OGGI.isoformat()})
+    assert response.json()["costi_variabili"] == 0
+
+    response = await client.get(
+        "/api/dashboard/range", headers=auth, params={"from": ieri.isoformat(), "to": OGGI.isoformat()}
+    )
+    assert response.status_code == 200
+    assert [giorno["entrate"] for giorno in response.json()["serie"]] == [100, 250.5]
+
+
+async def test_ledger_pagination_and_ndjson(client, auth):
+    for i in range(12):
+        data = (OGGI - timedelta(days=i % 3)).isoformat()
+        await client.post("/api/entrate", headers=auth, json={"descrizione": f"v{i}", "importo": i + 1, "data": data})
+
+    visti, cursor = [], None
+    while True:
+        params = {"limit": 5, **({"cursor": cursor} if cursor else {})}
+        response = await client.get("/api/entrate", headers=auth, params=params)
+        assert response.status_code == 200
+        visti += [doc["entrata_id"] for doc in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert len(visti) == len(set(visti)) == 12
+
+    response = await client.get("/api/entrate", headers=auth, params={"data": OGGI.isoformat()})
+    assert len(response.json()) == 4
+
+    response = await client.get("/api/entrate", headers=auth, params={"format": "ndjson"})
+    assert len(response.text.strip().splitlines()) == 12
+
+    response = await client.get("/api/entrate", headers=auth, params={"cursor": "non-valido"})
+    assert response.status_code == 400
+
+
+async def test_bulk_import_reports_invalid_rows(client, auth):
+    csv = "descrizione,importo,data\n" + "".join(f"r{i},{i + 1},{OGGI.isoformat()}\n" for i in range(5)) + "x,abc,2024-01-01\n"
+    response = await client.post("/api/entrate/bulk", headers={**auth, "content-type": "text/csv"}, content=csv)
+    assert response.status_code == 200
+    assert response.json()["inseriti"] == 5
+    assert len(response.json()["errori"]) == 1
+
+    response = await client.get("/api/dashboard", headers=auth, params={"data": OGGI.isoformat()})
+    assert response.json()["entrate"] == 15
+
+
+async def test_materiali_and_movimenti(client, auth):
+    response = await client.post("/api/materiali", headers=auth, json={
+        "nome": "farina", "quantita_disponibile": 10, "unita_misura": "kg",
+        "consumo_medio_giornaliero": 2, "giorni_consegna": 3, "costo_unitario": 1.5
+    })
+    assert response.status_code == 200
+    materiale_id = response.json()["materiale_id"]
+
+    response = await client.post(f"/api/materiali/{materiale_id}/movimenti", headers=auth, json={"tipo": "scarico", "quantita": 4})
+    assert response.status_code == 200
+    assert response.json()["materiale"]["quantita_disponibile"] == 6
+
+    response = await client.patch(f"/api/materiali/{materiale_id}", headers=auth, json={"quantita_disponibile": 8})
+    assert response.status_code == 200
+
+    response = await client.get(f"/api/materiali/{materiale_id}/movimenti", headers=auth)
+    assert [movimento["tipo"] for movimento in response.json()] == ["rettifica", "scarico"]
+
+    response = await client.get("/api/materiali", headers=auth)
+    assert response.json()[0]["quantita_disponibile"] == 8
+
+    response = await client.delete(f"/api/materiali/{materiale_id}", headers=auth)
+    assert response.status_code == 200
+    response = await client.get("/api/materiali", headers=auth)
+    assert response.json() == []
+
+
+async def test_users_are_isolated(client, auth, register):
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "v", "importo": 10, "data": OGGI.isoformat()})
+    altro = await register(email="anna@example.it", name="Anna")
+
+    response = await client.get("/api/entrate", headers=altro)
+    assert response.json() == []
+    response = await client.get("/api/dashboard", headers=altro, params={"data": OGGI.isoformat()})
+    assert response.json()["entrate"] == 0
+
+
+async def test_notifiche_unread_count(client, auth, store):
+    user_id = (await client.get("/api/auth/me", headers=auth)).json()["user"]["user_id"]
+    pipeline = notifications.NotificationPipeline(store)
+    for tipo in ("stato_rosso", "giornata_positiva"):
+        pipeline.add(user_id, tipo, None, f"titolo {tipo}", "messaggio")
+    await pipeline.flush()
+
+    response = await client.get("/api/notifiche/unread-count", headers=auth)
+    assert response.json()["non_lette"] == 2
+
+    notifiche = (await client.get("/api/notifiche", headers=auth)).json()
+    await client.patch(f"/api/notifiche/{notifiche[0]['notifica_id']}/letta", headers=auth)
+    await client.patch(f"/api/notifiche/{notifiche[0]['notifica_id']}/letta", headers=auth)
+    response = await client.get("/api/notifiche/unread-count", headers=auth)
+    assert response.json()["non_lette"] == 1
+
+    await client.patch("/api/notifiche/letta-tutte", headers=auth)
+    response = await client.get("/api/notifiche/unread-count", headers=auth)
+    assert response.json()["non_lette"] == 0
+
+
+async def test_insights_with_fake_llm(client, auth):
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "v", "importo": 10, "data": OGGI.isoformat()})
+    response = await client.get("/api/insights", headers=auth, params={"data": OGGI.isoformat()})
+    assert response.status_code == 200
+    assert len(response.json()) > 0
+
+
+def metric_value(text: str, series: str) -> float:
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.split()[-1])
+    raise AssertionError(f"{series} non trovata")
+
+
+async def test_session_cache_counters_only_on_metrics(client, auth):
+    await client.get("/api/auth/me", headers=auth)
+    await client.get("/api/auth/me", headers=auth)
+
+    response = await client.get("/internal/session-cache")
+    assert response.status_code == 404
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    # onboarding e le due letture: la prima lettura riempie la cache, le altre la trovano
+    assert metric_value(response.text, 'session_cache_events_total{evento="misses"}') >= 1
+    assert metric_value(response.text, 'session_cache_events_total{evento="hits"}') >= 2
+    assert metric_value(response.text, "session_cache_size") == 1
+
+
+async def test_metrics_requires_token_when_configured(client, monkeypatch):
+    monkeypatch.setattr(server, "METRICS_TOKEN", "segreto")
+    assert (await client.get("/metrics")).status_code == 401
+    assert (await client.get("/metrics", headers={"Authorization": "Bearer altro"})).status_code == 401
+    response = await client.get("/metrics", headers={"Authorization": "Bearer segreto"})
+    assert response.status_code == 200
+    assert "session_cache_events_total" in response.text
+
+
+async def test_missing_codecs_are_reported_at_startup(monkeypatch, caplog):
+    with caplog.at_level(logging.WARNING):
+        await server.check_codecs()
+    assert "Pacchetti non installati" not in caplog.text
+
+    monkeypatch.setattr(serialization, "ORJSON_AVAILABLE", False)
+    monkeypatch.setattr(compression, "BROTLI_AVAILABLE", False)
+    with caplog.at_level(logging.WARNING):
+        await server.check_codecs()
+    assert "orjson" in caplog.text and "brotli" in caplog.text
+
+    monkeypatch.setenv("REQUIRE_CODECS", "1")
+    with pytest.raises(RuntimeError, match="orjson"):
+        await server.check_codecs()
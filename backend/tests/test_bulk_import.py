@@ -0,0 +1,61 @@
+# Test Bulk Import
+# Limiti dell'importazione massiva: il corpo troppo grande è rifiutato
+# prima di essere letto o interpretato, il CSV non viene letto oltre il
+# numero massimo di righe.
+
+from datetime import date
+
+import pytest
+
+import bulk_import
+import server
+
+pytestmark = pytest.mark.anyio
+
+OGGI = date.today().isoformat()
+
+
+def csv_righe(n: int) -> str:
+    return "descrizione,importo,data\n" + "".join(f"r{i},{i + 1},{OGGI}\n" for i in range(n))
+
+
+def test_parse_rows_stops_at_max_rows():
+    assert len(bulk_import.parse_rows(csv_righe(3).encode(), "text/csv", max_rows=3)) == 3
+    with pytest.raises(bulk_import.TooManyRowsError):
+        bulk_import.parse_rows(csv_righe(4).encode(), "text/csv", max_rows=3)
+    with pytest.raises(bulk_import.TooManyRowsError):
+        bulk_import.parse_rows(b'[{}, {}, {}, {}]', "application/json", max_rows=3)
+    assert bulk_import.parse_rows(b"", "text/csv", max_rows=3) == []
+
+
+async def test_oversized_body_rejected_before_parsing(client, auth, monkeypatch):
+    monkeypatch.setattr(server, "BULK_IMPORT_MAX_BYTES", 100)
+
+    def parse_rows(*args, **kwargs):
+        raise AssertionError("il corpo non doveva essere interpretato")
+
+    monkeypatch.setattr(bulk_import, "parse_rows", parse_rows)
+
+    headers = {**auth, "content-type": "text/csv"}
+    response = await client.post("/api/entrate/bulk", headers=headers, content=csv_righe(20))
+    assert response.status_code == 413
+
+    # Senza Content-Length (upload chunked) il limite vale sui byte ricevuti
+    async def chunks():
+        for _ in range(20):
+            yield b"r,1,2026-10-17\n" * 2
+
+    response = await client.post("/api/entrate/bulk", headers=headers, content=chunks())
+    assert response.status_code == 413
+
+
+async def test_too_many_rows_is_413_and_writes_nothing(client, auth, monkeypatch):
+    monkeypatch.setattr(server, "BULK_IMPORT_MAX_ROWS", 5)
+    headers = {**auth, "content-type": "text/csv"}
+
+    response = await client.post("/api/entrate/bulk", headers=headers, content=csv_righe(6))
+    assert response.status_code == 413
+    assert (await client.get("/api/entrate", headers=auth)).json() == []
+
+    response = await client.post("/api/entrate/bulk", headers=headers, content=csv_righe(5))
+    assert response.json()["inseriti"] == 5
@@ -0,0 +1,102 @@
+# Test Dates
+# Backfill delle date salvate come stringa: a blocchi, senza ripassare sui
+# documenti già letti, lasciando intatti i valori non interpretabili.
+
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+import dates
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def db():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"dates_{uuid.uuid4().hex[:8]}")
+    yield backend.db
+    await backend.close()
+
+
+@pytest.fixture
+def pause(monkeypatch):
+    """Pause chieste dal backfill: una per blocco"""
+    chiamate = []
+
+    async def sleep(seconds):
+        chiamate.append(seconds)
+
+    monkeypatch.setattr(dates.asyncio, "sleep", sleep)
+    return chiamate
+
+
+def entrata(i: int, **campi) -> dict:
+    return {
+        "entrata_id": f"ent_{i:02d}", "user_id": "u1", "importo": 1.0,
+        "data": f"2026-10-{i % 28 + 1:02d}", "created_at": f"2026-10-{i % 28 + 1:02d}T08:30:00+00:00",
+        **campi
+    }
+
+
+async def test_backfill_converts_in_batches(db, pause):
+    await db.entrate.insert_many([entrata(i) for i in range(10)])
+
+    stats = await dates.backfill_collection(db, "entrate", batch_size=3, pause=0.5)
+    assert stats == {"convertiti": 10, "non_validi": 0}
+    # 10 documenti a blocchi di 3: 4 blocchi, una pausa dopo ciascuno
+    assert pause == [0.5] * 4
+
+    doc = await db.entrate.find_one({"entrata_id": "ent_03"})
+    assert doc["data"] == datetime(2026, 10, 4)
+    assert doc["created_at"] == datetime(2026, 10, 4, 8, 30)
+    assert await db.entrate.count_documents({"data": {"$type": "string"}}) == 0
+
+    # Secondo giro: niente da fare
+    assert await dates.backfill_collection(db, "entrate", batch_size=3) == {"convertiti": 0, "non_validi": 0}
+
+
+async def test_backfill_skips_invalid_and_converted_fields(db, pause):
+    gia_tipizzato = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    await db.entrate.insert_many([
+        entrata(0),
+        entrata(1, data="ieri"),
+        entrata(2, created_at=gia_tipizzato),
+        entrata(3, data=dates.data_to_mongo("2026-10-04"), created_at=gia_tipizzato),
+        entrata(4)
+    ])
+
+    # Blocchi da 1: il documento non valido non blocca l'avanzamento
+    stats = await dates.backfill_collection(db, "entrate", batch_size=1)
+    assert stats == {"convertiti": 3, "non_validi": 1}
+
+    invalido = await db.entrate.find_one({"entrata_id": "ent_01"})
+    assert invalido["data"] == "ieri"
+    assert isinstance(invalido["created_at"], str)
+    parziale = await db.entrate.find_one({"entrata_id": "ent_02"})
+    assert parziale["data"] == datetime(2026, 10, 3)
+    assert parziale["created_at"] == datetime(2026, 1, 1)
+
+
+async def test_backfill_dry_run_writes_nothing(db, pause):
+    await db.entrate.insert_many([entrata(i) for i in range(5)])
+    await db.users.insert_one({"user_id": "u1", "created_at": "2026-10-01T10:00:00+00:00"})
+
+    stats = await dates.backfill(db, batch_size=2, dry_run=True)
+    assert stats["entrate"] == {"convertiti": 5, "non_validi": 0}
+    assert stats["users"] == {"convertiti": 1, "non_validi": 0}
+    assert await db.entrate.count_documents({"data": {"$type": "string"}}) == 5
+
+    stats = await dates.backfill(db, batch_size=2)
+    assert stats["costi_variabili"] == {"convertiti": 0, "non_validi": 0}
+    assert await db.users.count_documents({"created_at": {"$type": "string"}}) == 0
+
+
+async def test_filters_match_both_forms_during_migration(db, pause):
+    await db.entrate.insert_many([entrata(i) for i in range(4)])
+    await dates.backfill_collection(db, "entrate", batch_size=2)
+    await db.entrate.insert_one(entrata(30))
+
+    trovate = await db.entrate.find({"data": dates.data_filter("2026-10-03")}).to_list(None)
+    assert sorted(d["entrata_id"] for d in trovate) == ["ent_02", "ent_30"]
@@ -0,0 +1,103 @@
+# Test DB Calls
+# Chiamate allo storage per richiesta sulle route più frequenti: un
+# Storage che conta le chiamate (entrambi i backend) e, su SQLite, le
+# istruzioni effettive registrate da metrics.observe_sqlite.
+
+from datetime import date
+
+import pytest
+
+import metrics
+import server
+from storage_sqlite import SqliteStorage
+
+pytestmark = pytest.mark.anyio
+
+OGGI = date.today().isoformat()
+
+
+class CountingStorage:
+    """Inoltra tutto allo storage reale registrando il nome di ogni metodo chiamato"""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+        return counted
+
+
+@pytest.fixture
+async def counted(client, auth, store, monkeypatch):
+    """Utente con qualche movimento e sessione già in cache; restituisce (storage contato, statement SQLite)"""
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "v", "importo": 10, "data": OGGI})
+    await client.post("/api/costi/variabili", headers=auth, json={"descrizione": "c", "importo": 4, "data": OGGI})
+    await client.post("/api/materiali", headers=auth, json={
+        "nome": "farina", "quantita_disponibile": 1, "unita_misura": "kg",
+        "consumo_medio_giornaliero": 2, "giorni_consegna": 3, "costo_unitario": 1
+    })
+    await client.get("/api/auth/me", headers=auth)
+
+    counting = CountingStorage(store)
+    monkeypatch.setattr(server, "store", counting)
+
+    sqlite_calls = []
+    observe_sqlite = metrics.observe_sqlite
+    monkeypatch.setattr(metrics, "observe_sqlite", lambda seconds, operazione: (
+        sqlite_calls.append(operazione), observe_sqlite(seconds, operazione)
+    ))
+    return counting, sqlite_calls
+
+
+async def _request(client, auth, counted, path, **kwargs):
+    counting, sqlite_calls = counted
+    counting.calls.clear()
+    sqlite_calls.clear()
+    response = await client.get(path, headers={**auth, **kwargs.pop("headers", {})}, **kwargs)
+    assert response.status_code in (200, 304), response.text
+    return response, list(counting.calls), len(sqlite_calls)
+
+
+@pytest.mark.parametrize("path, params, expected", [
+    ("/api/dashboard", {"data": OGGI}, ["get_versions", "get_dashboard"]),
+    ("/api/materiali", None, ["get_versions", "list_materiali"]),
+    ("/api/costi/fissi", None, ["get_versions", "list_costi_fissi"]),
+    ("/api/entrate", {"data": OGGI}, ["list_ledger"]),
+    ("/api/costi/variabili", {"data": OGGI}, ["list_ledger"]),
+])
+async def test_calls_per_request(client, auth, store, counted, path, params, expected):
+    response, calls, statements = await _request(client, auth, counted, path, params=params)
+    assert calls == expected
+    if isinstance(store, SqliteStorage):
+        # SQLite: una sola istruzione per chiamata allo storage
+        assert statements == len(expected)
+
+    if "etag" in response.headers:
+        # 304: solo i contatori di versione
+        _, calls, _ = await _request(
+            client, auth, counted, path, params=params, headers={"If-None-Match": response.headers["etag"]}
+        )
+        assert calls == ["get_versions"]
+
+
+async def test_insight_snapshot_reads_each_source_once(client, auth, store, counted):
+    counting, sqlite_calls = counted
+    user_id = (await client.get("/api/auth/me", headers=auth)).json()["user"]["user_id"]
+    counting.calls.clear()
+    sqlite_calls.clear()
+
+    snapshot = await server.load_day_snapshot(user_id, OGGI)
+
+    assert sorted(counting.calls) == sorted([
+        "get_profile", "get_dashboard_totals", "list_ledger", "list_ledger", "list_materiali"
+    ])
+    assert snapshot["totali"]["num_entrate"] == 1
+    if isinstance(store, SqliteStorage):
+        assert len(sqlite_calls) == 5
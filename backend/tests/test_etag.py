@@ -0,0 +1,97 @@
+# Test ETag
+# Risposte condizionali degli endpoint di lettura: 304 finché i dati non
+# cambiano, ETag nuovo dopo ogni scrittura, confronto debole con i body
+# compressi.
+
+from datetime import date
+
+import pytest
+
+import notifications
+
+pytestmark = pytest.mark.anyio
+
+OGGI = date.today().isoformat()
+
+
+async def test_dashboard_304_until_ledger_changes(client, auth):
+    response = await client.get("/api/dashboard", headers=auth, params={"data": OGGI})
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "private, no-cache"
+
+    response = await client.get("/api/dashboard", headers={**auth, "If-None-Match": etag}, params={"data": OGGI})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+    # Il giorno richiesto fa parte dell'ETag
+    response = await client.get("/api/dashboard", headers={**auth, "If-None-Match": etag}, params={"data": "2026-01-01"})
+    assert response.status_code == 200
+
+    await client.post("/api/entrate", headers=auth, json={"descrizione": "v", "importo": 10, "data": OGGI})
+    response = await client.get("/api/dashboard", headers={**auth, "If-None-Match": etag}, params={"data": OGGI})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert response.json()["entrate"] == 10
+
+
+async def test_if_none_match_lists_weak_and_wildcard(client, auth):
+    etag = (await client.get("/api/costi/fissi", headers=auth)).headers["etag"]
+
+    for if_none_match in (f"W/{etag}", f'"altro", {etag}', "*"):
+        response = await client.get("/api/costi/fissi", headers={**auth, "If-None-Match": if_none_match})
+        assert response.status_code == 304, if_none_match
+
+    response = await client.get("/api/costi/fissi", headers={**auth, "If-None-Match": '"altro"'})
+    assert response.status_code == 200
+
+
+async def test_compressed_body_gets_weak_etag(client, auth):
+    for i in range(20):
+        await client.post("/api/costi/fissi", headers=auth, json={"descrizione": f"affitto {i}", "importo_mensile": 100 + i})
+
+    response = await client.get("/api/costi/fissi", headers={**auth, "Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    etag = response.headers["etag"]
+    assert etag.startswith("W/")
+
+    response = await client.get("/api/costi/fissi", headers={**auth, "Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert response.status_code == 304
+
+
+async def test_etag_is_per_user_and_per_resource(client, auth, register):
+    etag = (await client.get("/api/materiali", headers=auth)).headers["etag"]
+    altro = await register(email="anna@example.it", name="Anna")
+
+    response = await client.get("/api/materiali", headers={**altro, "If-None-Match": etag})
+    assert response.status_code == 200
+
+    # Una scrittura sui costi fissi non invalida i materiali
+    await client.post("/api/costi/fissi", headers=auth, json={"descrizione": "affitto", "importo_mensile": 300})
+    response = await client.get("/api/materiali", headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 304
+
+    await client.post("/api/materiali", headers=auth, json={
+        "nome": "farina", "quantita_disponibile": 10, "unita_misura": "kg",
+        "consumo_medio_giornaliero": 2, "giorni_consegna": 3, "costo_unitario": 1.5
+    })
+    response = await client.get("/api/materiali", headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 200
+
+
+async def test_unread_count_etag_follows_counter(client, auth, store):
+    response = await client.get("/api/notifiche/unread-count", headers=auth)
+    etag = response.headers["etag"]
+    response = await client.get("/api/notifiche/unread-count", headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 304
+
+    user_id = (await client.get("/api/auth/me", headers=auth)).json()["user"]["user_id"]
+    pipeline = notifications.NotificationPipeline(store)
+    pipeline.add(user_id, "stato_rosso", None, "titolo", "messaggio")
+    await pipeline.flush()
+
+    response = await client.get("/api/notifiche/unread-count", headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json() == {"non_lette": 1}
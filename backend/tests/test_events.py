@@ -0,0 +1,69 @@
+# Test Events
+# wants() dei broker di events.py: con il backend mongo un processo sa
+# quali utenti hanno client connessi agli altri processi.
+
+import uuid
+
+import pytest
+from pymongo.errors import PyMongoError
+
+import events
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def db():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"events_{uuid.uuid4().hex[:8]}")
+    yield backend.db
+    await backend.close()
+
+
+def test_memory_broker_wants_only_subscribed_users():
+    broker = events.InMemoryBroker()
+    subscription = broker.subscribe("u1")
+    assert broker.wants("u1") and not broker.wants("u2")
+    subscription.close()
+    assert not broker.wants("u1")
+
+
+async def test_mongo_broker_sees_subscribers_of_other_processes(db):
+    # Due processi sullo stesso database; mongomock non ha change stream
+    server = events.MongoChangeStreamBroker(db, watch=False, presence_interval=60)
+    sweeper = events.MongoChangeStreamBroker(db, watch=False, presence_interval=60)
+    await server.start()
+    await sweeper.start()
+    assert not sweeper.wants("u1")
+
+    subscription = server.subscribe("u1")
+    assert server.wants("u1")
+    await server.refresh_presence()
+    await sweeper.refresh_presence()
+    assert sweeper.wants("u1")
+    assert not sweeper.wants("u2")
+
+    subscription.close()
+    await server.refresh_presence()
+    await sweeper.refresh_presence()
+    assert not sweeper.wants("u1")
+
+    server.subscribe("u3")
+    await server.refresh_presence()
+    await server.stop()
+    await sweeper.refresh_presence()
+    assert not sweeper.wants("u3")
+    await sweeper.stop()
+
+
+class _DatabaseDown:
+    class eventi_presenze:
+        @staticmethod
+        async def delete_many(*args, **kwargs):
+            raise PyMongoError("down")
+
+
+async def test_mongo_broker_fails_open_when_presence_is_unknown():
+    broker = events.MongoChangeStreamBroker(_DatabaseDown(), watch=False)
+    await broker.refresh_presence()
+    assert broker.wants("u1")
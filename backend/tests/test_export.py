@@ -0,0 +1,112 @@
+# Test Export
+# Export Parquet e Arrow dei movimenti di un utente: righe e tipi delle
+# colonne, export incrementale dal watermark, endpoint in streaming. Il
+# watermark resta indietro rispetto all'orologio, così una riga salvata in
+# ritardo rientra nell'export successivo.
+
+import io
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import export
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not export.PYARROW_AVAILABLE, reason="pyarrow non installato")
+]
+
+
+def entrata(entrata_id: str, created_at: datetime, user_id: str = "u1") -> dict:
+    return {
+        "entrata_id": entrata_id, "user_id": user_id, "descrizione": entrata_id, "importo": 10.0,
+        "data": created_at.date().isoformat(), "tipo": "vendita", "created_at": created_at.isoformat()
+    }
+
+
+def righe(path) -> list:
+    import pyarrow.parquet as pq
+    return pq.read_table(path).column("entrata_id").to_pylist()
+
+
+async def test_full_export_writes_typed_columns(store, tmp_path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    adesso = datetime.now(timezone.utc)
+    for i in range(3):
+        await store.insert_ledger("entrate", entrata(f"e{i}", adesso - timedelta(hours=3 - i)))
+    await store.insert_ledger("entrate", entrata("altro", adesso - timedelta(hours=1), user_id="u2"))
+
+    stato = await export.export_user(store, "u1", tmp_path)
+    assert stato["file"]["entrate"]["righe"] == 3
+    assert stato["file"]["materiali"]["righe"] == 0
+    assert (tmp_path / "watermark.json").exists()
+
+    tabella = pq.read_table(tmp_path / stato["file"]["entrate"]["file"])
+    assert tabella.column("entrata_id").to_pylist() == ["e0", "e1", "e2"]
+    assert tabella.schema.field("data").type == pa.date32()
+    assert tabella.schema.field("created_at").type == pa.timestamp("us", tz="UTC")
+    assert tabella.column("importo").to_pylist() == [10.0] * 3
+
+
+async def test_incremental_export_starts_after_watermark(store, tmp_path):
+    adesso = datetime.now(timezone.utc)
+    await store.insert_ledger("entrate", entrata("prima", adesso - timedelta(hours=2)))
+    dal = export.parse_watermark((adesso - timedelta(hours=1)).isoformat())
+    await store.insert_ledger("entrate", entrata("dopo", adesso - timedelta(minutes=30)))
+
+    stato = await export.export_user(store, "u1", tmp_path, dal=dal)
+    assert righe(tmp_path / stato["file"]["entrate"]["file"]) == ["dopo"]
+    assert stato["dal"] == dal
+
+
+def test_parse_watermark_normalizes_to_utc():
+    assert export.parse_watermark("2026-10-17T12:00:00+02:00") == "2026-10-17T10:00:00+00:00"
+    assert export.parse_watermark("2026-10-17T10:00:00") == "2026-10-17T10:00:00+00:00"
+    with pytest.raises(ValueError):
+        export.parse_watermark("ieri")
+
+
+async def test_export_endpoint_streams_arrow(client, auth, store):
+    import pyarrow as pa
+
+    user_id = (await client.get("/api/auth/me", headers=auth)).json()["user"]["user_id"]
+    await store.insert_ledger("entrate", entrata("e1", datetime.now(timezone.utc) - timedelta(hours=1), user_id))
+
+    response = await client.get("/api/export/entrate", headers=auth, params={"format": "arrow"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == export.FORMATI["arrow"]["media_type"]
+    assert response.headers["x-export-watermark"]
+    tabella = pa.ipc.open_stream(io.BytesIO(response.content)).read_all()
+    assert tabella.column("entrata_id").to_pylist() == ["e1"]
+    assert export.parse_watermark(response.headers["x-export-watermark"])
+
+    assert (await client.get("/api/export/utenti", headers=auth)).status_code == 404
+    assert (await client.get("/api/export/entrate", headers=auth, params={"format": "csv"})).status_code == 400
+    assert (await client.get("/api/export/entrate", headers=auth, params={"since": "ieri"})).status_code == 400
+
+
+def test_new_watermark_lags_the_clock():
+    prima = datetime.now(timezone.utc)
+    watermark = datetime.fromisoformat(export.new_watermark(lag=300))
+    assert prima - timedelta(seconds=301) < watermark <= prima - timedelta(seconds=299)
+    assert datetime.fromisoformat(export.new_watermark(lag=0)) >= prima
+
+
+async def test_late_committed_row_is_in_next_incremental_export(store, tmp_path, monkeypatch):
+    adesso = datetime.now(timezone.utc)
+    await store.insert_ledger("entrate", entrata("vecchia", adesso - timedelta(hours=1)))
+    await store.insert_ledger("entrate", entrata("recente", adesso - timedelta(seconds=10)))
+
+    primo = await export.export_user(store, "u1", tmp_path / "primo")
+    assert righe(tmp_path / "primo" / primo["file"]["entrate"]["file"]) == ["vecchia"]
+
+    # created_at assegnato prima dell'export, commit dopo
+    await store.insert_ledger("entrate", entrata("in_ritardo", adesso - timedelta(seconds=20)))
+
+    # Giro successivo, a finestra di ritardo trascorsa
+    nuovo_watermark = export.new_watermark
+    monkeypatch.setattr(export, "new_watermark", lambda: nuovo_watermark(lag=0))
+    secondo = await export.export_user(store, "u1", tmp_path / "secondo", dal=primo["watermark"])
+    assert sorted(righe(tmp_path / "secondo" / secondo["file"]["entrate"]["file"])) == ["in_ritardo", "recente"]
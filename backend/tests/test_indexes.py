@@ -0,0 +1,57 @@
+# Test Indexes
+# Riconciliazione degli indici MongoDB (indexes.py): all'avvio il drift è
+# solo segnalato, la ricreazione è esplicita e ripristina l'indice
+# precedente se fallisce.
+
+import uuid
+
+import pytest
+
+import indexes
+import storage
+
+pytestmark = pytest.mark.anyio
+
+SESSION_KEYS = [("session_token", 1)]
+
+
+@pytest.fixture
+async def db():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"indexes_{uuid.uuid4().hex[:8]}")
+    # Indice in drift: stessa chiave del piano, senza unique
+    await backend.db.user_sessions.create_index(SESSION_KEYS, name="session_token")
+    yield backend.db
+    await backend.close()
+
+
+def _session_index(info: dict) -> dict:
+    return next(index for index in info.values() if index["key"] == SESSION_KEYS)
+
+
+async def test_startup_only_reports_drift(db):
+    actions = await indexes.ensure_indexes(db)
+
+    assert any(a["action"] == "recreate" and a["collection"] == "user_sessions" for a in actions)
+    index = _session_index(await db.user_sessions.index_information())
+    assert not index.get("unique", False)
+    # Gli indici mancanti vengono comunque creati
+    assert "email_unique" in await db.users.index_information()
+
+
+async def test_recreate_applies_the_plan(db):
+    await indexes.ensure_indexes(db, recreate=True)
+
+    info = await db.user_sessions.index_information()
+    assert _session_index(info)["unique"] is True
+    assert "session_token_unique" in info
+
+
+async def test_failed_recreate_restores_previous_index(db):
+    # Duplicati: l'indice unique non si può costruire
+    await db.user_sessions.insert_many([{"session_token": "t"}, {"session_token": "t"}])
+
+    await indexes.ensure_indexes(db, recreate=True)
+
+    info = await db.user_sessions.index_information()
+    assert "session_token" in info
+    assert not info["session_token"].get("unique", False)
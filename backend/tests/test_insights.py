@@ -0,0 +1,130 @@
+# Test Insights
+# Generazione degli insight (insights.py) con FakeLlm: scadenza per
+# chiamata, budget complessivo e risultati parziali. Gli insight a regole
+# salvati scadono e la visita successiva riprova il modello.
+
+import time
+from datetime import date
+
+import pytest
+
+import insights
+import llm as llm_module
+import server
+from llm import FakeLlm
+
+pytestmark = pytest.mark.anyio
+
+DASHBOARD = {"utile": 120.0, "entrate": 300.0, "costi": 180.0, "stato": "positivo"}
+
+
+async def generate(llm, tier: str = "pro", **kwargs):
+    return await insights.generate(llm, "u1", tier, "2026-10-17", "Dati di oggi", DASHBOARD, **kwargs)
+
+
+def by_tipo(docs: list) -> dict:
+    return {doc["tipo"]: doc["contenuto"] for doc in docs}
+
+
+class FailingLlm(FakeLlm):
+    """Solleva un errore per le sessioni indicate"""
+
+    def __init__(self, fail_session_ids: tuple):
+        super().__init__()
+        self.fail_session_ids = fail_session_ids
+
+    async def complete(self, session_id: str, system_message: str, prompt: str) -> str:
+        if any(s in session_id for s in self.fail_session_ids):
+            self.calls += 1
+            raise RuntimeError("servizio non disponibile")
+        return await super().complete(session_id, system_message, prompt)
+
+
+async def test_all_prompts_answered():
+    llm = FakeLlm()
+    docs = await generate(llm)
+
+    assert [doc["tipo"] for doc in docs] == ["positivo", "rischio", "azione"]
+    assert all(doc["contenuto"].startswith("Insight di prova") for doc in docs)
+    assert llm.calls == 3
+
+    docs = await generate(FakeLlm(), tier="free")
+    assert [doc["tipo"] for doc in docs] == ["generale"]
+
+
+async def test_call_timeout_falls_back_for_that_prompt_only():
+    started = time.perf_counter()
+    docs = by_tipo(await generate(FakeLlm(hang_session_ids=("rischio",)), call_timeout=0.05, total_budget=5))
+
+    assert time.perf_counter() - started < 1
+    assert docs["rischio"] == insights.fallback_text("rischio", DASHBOARD)
+    assert docs["positivo"].startswith("Insight di prova")
+    assert docs["azione"].startswith("Insight di prova")
+
+
+async def test_total_budget_cuts_slow_calls():
+    started = time.perf_counter()
+    docs = by_tipo(await generate(FakeLlm(latency=5), call_timeout=10, total_budget=0.05))
+
+    assert time.perf_counter() - started < 1
+    assert docs == {tipo: insights.fallback_text(tipo, DASHBOARD) for tipo, _ in insights.PRO_PROMPTS}
+
+
+async def test_partial_results_within_budget():
+    docs = by_tipo(await generate(FakeLlm(hang_session_ids=("azione",)), call_timeout=10, total_budget=0.1))
+
+    assert docs["positivo"].startswith("Insight di prova")
+    assert docs["rischio"].startswith("Insight di prova")
+    assert docs["azione"] == insights.fallback_text("azione", DASHBOARD)
+
+
+async def test_failed_call_falls_back():
+    docs = by_tipo(await generate(FailingLlm(("positivo",)), materiali_critici=2))
+
+    assert docs["positivo"] == insights.fallback_text("positivo", DASHBOARD)
+    assert docs["rischio"].startswith("Insight di prova")
+
+
+async def test_fallback_docs_are_flagged_with_expiry():
+    docs = {doc["tipo"]: doc for doc in await generate(FailingLlm(("rischio",)), fallback_ttl=60)}
+
+    assert docs["rischio"]["fallback"] is True
+    assert docs["positivo"]["fallback"] is False
+    assert docs["positivo"]["expires_at"] is None
+    assert insights.expired_fallbacks(list(docs.values())) == []
+
+    # Solo i tipi chiesti
+    docs = await generate(FakeLlm(), tipi=["rischio"])
+    assert [doc["tipo"] for doc in docs] == ["rischio"]
+
+
+async def test_fallback_served_until_expiry_then_retried(client, auth, monkeypatch):
+    await client.post("/api/subscription/upgrade", headers=auth)
+    oggi = date.today().isoformat()
+
+    giu = FailingLlm(("rischio",))
+    monkeypatch.setattr(llm_module, "get_llm", lambda: giu)
+    monkeypatch.setattr(server, "INSIGHT_FALLBACK_TTL", 3600)
+    primi = {doc["tipo"]: doc for doc in (await client.get("/api/insights", headers=auth, params={"data": oggi})).json()}
+    assert primi["rischio"]["fallback"] is True
+    assert giu.calls == 3
+
+    # Entro la scadenza il testo a regole è servito senza chiamare il modello
+    response = await client.get("/api/insights", headers=auth, params={"data": oggi})
+    assert sorted(doc["insight_id"] for doc in response.json()) == sorted(doc["insight_id"] for doc in primi.values())
+    assert giu.calls == 3
+
+    # Scaduto: la visita successiva riprova solo il tipo mancato
+    monkeypatch.setattr(server, "INSIGHT_FALLBACK_TTL", 0)
+    altro_giorno = "2026-10-16"
+    await client.get("/api/insights", headers=auth, params={"data": altro_giorno})
+    su = FakeLlm()
+    monkeypatch.setattr(llm_module, "get_llm", lambda: su)
+    docs = {doc["tipo"]: doc for doc in (await client.get("/api/insights", headers=auth, params={"data": altro_giorno})).json()}
+    assert su.calls == 1
+    assert docs["rischio"]["fallback"] is False
+    assert docs["rischio"]["contenuto"].startswith("Insight di prova")
+    assert len(docs) == 3
+
+    response = await client.get("/api/insights", headers=auth, params={"data": altro_giorno})
+    assert su.calls == 1
@@ -0,0 +1,131 @@
+# Test Insights Batch
+# insights_batch.py: worker che sopravvivono agli errori dello storage e
+# utenti attivi da users.last_seen_at oltre la durata delle sessioni. Il
+# giorno di default è quello che la dashboard chiede.
+
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import insights_batch
+import llm
+import server
+from llm import FakeLlm
+from storage_sqlite import SqliteStorage
+
+pytestmark = pytest.mark.anyio
+
+ADESSO = datetime.now(timezone.utc)
+
+
+class FlakyStore:
+    """Storage minimo per run_batch: get_user o set_batch_progress falliscono per alcuni utenti"""
+
+    def __init__(self, user_ids, fail_get=(), fail_progress=()):
+        self.user_ids = user_ids
+        self.fail_get = fail_get
+        self.fail_progress = fail_progress
+        self.progress = {}
+
+    async def completed_batch_users(self, run_id):
+        return set()
+
+    async def iter_active_user_ids(self, since):
+        for user_id in self.user_ids:
+            yield user_id
+
+    async def get_user(self, user_id):
+        if user_id in self.fail_get:
+            raise ConnectionError("storage non raggiungibile")
+        return {"user_id": user_id}
+
+    async def set_batch_progress(self, run_id, user_id, stato):
+        if user_id in self.fail_progress:
+            raise ConnectionError("storage non raggiungibile")
+        self.progress[user_id] = stato
+
+
+async def test_storage_errors_are_counted_and_do_not_stop_workers():
+    user_ids = [f"u{i}" for i in range(10)]
+    store = FlakyStore(user_ids, fail_get={"u1", "u2"}, fail_progress={"u5"})
+    generated = []
+
+    async def generate_insights(user, data):
+        if user["user_id"] == "u7":
+            raise RuntimeError("LLM non disponibile")
+        generated.append(user["user_id"])
+
+    # Con un solo worker, un worker morto bloccherebbe queue.put
+    stats = await asyncio.wait_for(insights_batch.run_batch(
+        store, generate_insights, lambda doc: doc, "2026-10-16", concurrency=1, rate=0
+    ), timeout=5)
+
+    assert stats == {"completati": 6, "saltati": 0, "errori": 4}
+    assert store.progress["u7"] == "errore"
+    assert "u5" not in store.progress
+
+
+async def test_active_users_from_last_seen_beyond_session_ttl(store):
+    for user_id, last_seen in (("recente", ADESSO - timedelta(days=20)), ("vecchio", ADESSO - timedelta(days=40)),
+                               ("mai_visto", None)):
+        await store.insert_user({
+            "user_id": user_id, "email": f"{user_id}@example.it", "name": user_id,
+            "created_at": (ADESSO - timedelta(days=60)).isoformat()
+        })
+        if last_seen is not None:
+            await store.update_user(user_id, {"last_seen_at": last_seen})
+    # Utente senza last_seen_at ma con una sessione recente
+    await store.insert_session({
+        "user_id": "mai_visto", "session_token": "tok",
+        "expires_at": ADESSO + timedelta(days=7), "created_at": ADESSO - timedelta(days=1)
+    })
+
+    attivi = [user_id async for user_id in insights_batch.iter_active_user_ids(store, 30)]
+    assert attivi == ["mai_visto", "recente"]
+
+
+async def test_requests_record_last_seen(client, register, store):
+    headers = await register()
+    user_id = (await client.get("/api/auth/me", headers=headers)).json()["user"]["user_id"]
+
+    last_seen = (await store.get_user(user_id))["last_seen_at"]
+    assert last_seen is not None
+
+
+def test_sqlite_adds_last_seen_at_to_existing_files(tmp_path):
+    path = tmp_path / "vecchio.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, email TEXT NOT NULL UNIQUE, name TEXT, created_at TEXT)")
+    conn.close()
+
+    async def open_and_close():
+        store = SqliteStorage(str(path))
+        await store.ensure_schema()
+        await store.close()
+
+    asyncio.run(open_and_close())
+    conn = sqlite3.connect(path)
+    assert "last_seen_at" in {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_last_seen_at'").fetchone()
+    conn.close()
+
+
+async def test_default_day_is_the_one_the_dashboard_asks_for(client, auth, store, monkeypatch):
+    fake = FakeLlm()
+    monkeypatch.setattr(llm, "get_llm", lambda: fake)
+
+    stats = await insights_batch.run_batch(
+        store, server.generate_insights, server.user_from_doc, insights_batch.default_data(), rate=0
+    )
+    assert stats["completati"] == 1
+    chiamate = fake.calls
+    assert chiamate > 0
+
+    # Dashboard.js: new Date().toISOString().split('T')[0]
+    oggi = datetime.now(timezone.utc).date().isoformat()
+    response = await client.get("/api/insights", headers=auth, params={"data": oggi})
+    assert response.status_code == 200
+    assert response.json()
+    assert fake.calls == chiamate
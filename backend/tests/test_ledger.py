@@ -0,0 +1,101 @@
+# Test Ledger
+# Riepiloghi giornalieri di MongoDB (ledger.py): arrotondamento dei totali
+# e letture senza scritture per gli utenti mai ricostruiti, anche a gruppi.
+
+import uuid
+from datetime import date, datetime, timezone
+
+import pytest
+
+import dates
+import ledger
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def mongo():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"ledger_{uuid.uuid4().hex[:8]}")
+    yield backend
+    await backend.close()
+
+
+@pytest.fixture
+def db(mongo):
+    return mongo.db
+
+
+def test_build_dashboard_rounds_before_classifying():
+    # 0.1 + 0.2 - 0.3 lascia un residuo positivo di 5.5e-17
+    dashboard = ledger.build_dashboard("2026-10-17", 0.1 + 0.2, 0.3, 0)
+    assert dashboard["utile"] == 0
+    assert dashboard["stato"] == "attenzione"
+
+    dashboard = ledger.build_dashboard("2026-10-17", 100.004, 50.001, 0)
+    assert dashboard["entrate"] == 100.0
+    assert dashboard["utile"] == 50.0
+
+
+async def test_legacy_user_is_read_from_raw_documents_without_writes(db):
+    # Dati precedenti ai riepiloghi, con `data` in entrambe le forme del backfill
+    await db.entrate.insert_many([
+        {"entrata_id": "e1", "user_id": "u1", "importo": 100, "data": "2026-10-16"},
+        {"entrata_id": "e2", "user_id": "u1", "importo": 50, "data": dates.data_to_mongo("2026-10-16")},
+        {"entrata_id": "e3", "user_id": "u1", "importo": 30, "data": "2026-10-17"}
+    ])
+    await db.costi_variabili.insert_one({"costo_id": "c1", "user_id": "u1", "importo": 20, "data": "2026-10-16"})
+    await db.costi_fissi.insert_one({"costo_id": "f1", "user_id": "u1", "quota_giornaliera": 10})
+
+    dashboard = await ledger.get_dashboard(db, "u1", "2026-10-16")
+    assert (dashboard["entrate"], dashboard["costi_variabili"], dashboard["quota_fissi"]) == (150, 20, 10)
+
+    serie = await ledger.get_dashboard_range(db, "u1", date(2026, 10, 15), date(2026, 10, 17))
+    assert [punto["entrate"] for punto in serie] == [0, 150, 30]
+
+    assert await db.riepiloghi_giornalieri.count_documents({}) == 0
+
+
+async def test_rebuild_then_incremental_updates(db):
+    await db.entrate.insert_one({"entrata_id": "e1", "user_id": "u1", "importo": 100, "data": "2026-10-16"})
+    assert await ledger.rebuild_user(db, "u1") == 1
+
+    await ledger.record_entrata(db, "u1", "2026-10-16", 25)
+    dashboard = await ledger.get_dashboard(db, "u1", "2026-10-16")
+    assert dashboard["entrate"] == 125
+
+
+async def test_new_user_starts_with_rebuilt_marker(mongo, db):
+    await mongo.insert_user({"user_id": "u2", "email": "n@example.it", "created_at": datetime.now(timezone.utc).isoformat()})
+
+    fissi = await db.riepiloghi_giornalieri.find_one({"user_id": "u2", "data": ledger.RIEPILOGO_FISSI})
+    assert "ricostruito_il" in fissi
+    assert (await ledger.get_dashboard(db, "u2", "2026-10-17"))["utile"] == 0
+
+
+async def test_totals_many_mixes_rebuilt_and_legacy_users_without_per_user_queries(mongo, db, monkeypatch):
+    await mongo.insert_user({"user_id": "nuovo", "email": "n@example.it", "created_at": datetime.now(timezone.utc).isoformat()})
+    await ledger.record_entrata(db, "nuovo", "2026-10-16", 40)
+    await db.entrate.insert_many([
+        {"entrata_id": f"e{i}", "user_id": f"vecchio{i}", "importo": 100, "data": "2026-10-16"} for i in range(3)
+    ] + [{"entrata_id": "e9", "user_id": "vecchio0", "importo": 5, "data": dates.data_to_mongo("2026-10-16")}])
+    await db.costi_variabili.insert_one({"costo_id": "c1", "user_id": "vecchio1", "importo": 20, "data": "2026-10-16"})
+    await db.costi_fissi.insert_one({"costo_id": "f1", "user_id": "vecchio2", "quota_giornaliera": 10})
+
+    async def per_utente(*args):
+        raise AssertionError("lettura per utente")
+
+    monkeypatch.setattr(ledger, "get_dashboard_totals", per_utente)
+    monkeypatch.setattr(ledger, "_totali_grezzi", per_utente)
+
+    user_ids = ["nuovo", "vecchio0", "vecchio1", "vecchio2", "assente"]
+    totali = await mongo.get_dashboard_totals_many(user_ids, "2026-10-16")
+    assert {u: (t["totale_entrate"], t["totale_costi_variabili"], t["totale_quota_fissi"]) for u, t in totali.items()} == {
+        "nuovo": (40, 0, 0),
+        "vecchio0": (105, 0, 0),
+        "vecchio1": (100, 20, 0),
+        "vecchio2": (100, 0, 10),
+        "assente": (0, 0, 0)
+    }
+    assert (await mongo.get_dashboard_totals_many(["vecchio0"], "ieri"))["vecchio0"]["totale_entrate"] == 0
+    assert await db.riepiloghi_giornalieri.count_documents({"user_id": {"$ne": "nuovo"}}) == 0
@@ -0,0 +1,84 @@
+# Test Materiali
+# Decadimento della media dei consumi alla lettura (forecasting.py) ed
+# eliminazione di un materiale con il suo storico.
+
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+import forecasting
+import movimenti
+from storage_sqlite import SqliteStorage
+
+pytestmark = pytest.mark.anyio
+
+OGGI = date(2026, 10, 17)
+
+
+def materiale(fino_al: date, ewma: float = 4.0, var: float = 1.0) -> dict:
+    return {
+        "materiale_id": "mat_1", "quantita_disponibile": 10, "giorni_consegna": 3,
+        "consumo_medio_giornaliero": 4, "consumo_ewma": ewma, "consumo_ewma_var": var,
+        "consumo_ewma_fino_al": fino_al.isoformat()
+    }
+
+
+@pytest.mark.parametrize("giorni", [0, 1, 5, 30])
+def test_decay_matches_days_of_zero_consumption(giorni):
+    media, varianza = 4.0, 1.5
+    for _ in range(giorni):
+        media, varianza = movimenti.ewma_update(media, varianza, 0.0)
+
+    decayed = forecasting.decay(np.array([4.0]), np.array([1.5]), np.array([giorni]))
+    assert decayed[0][0] == pytest.approx(media)
+    assert decayed[1][0] == pytest.approx(varianza)
+
+
+def test_forecast_decays_stale_consumption():
+    aggiornato, fermo = forecasting.annotate_materiali(
+        [materiale(OGGI - timedelta(days=1)), materiale(OGGI - timedelta(days=60))], oggi=OGGI
+    )
+
+    # Aggiornato a ieri: nessun decadimento, 10 / 4 = 2.5 giorni
+    assert aggiornato["giorni_rimasti"] == 2.5
+    assert aggiornato["stato"] == "ordina_ora"
+    # Due mesi senza scarichi: il consumo stimato è quasi nullo
+    assert fermo["giorni_rimasti"] > 100
+    assert fermo["stato"] == "ok"
+
+
+def test_forecast_without_history_uses_static_consumption():
+    doc = {"quantita_disponibile": 10, "giorni_consegna": 3, "consumo_medio_giornaliero": 2}
+    assert forecasting.annotate_materiali([doc], oggi=OGGI)[0]["giorni_rimasti"] == 5
+
+
+async def _count(store, table: str, materiale_id: str) -> int:
+    if isinstance(store, SqliteStorage):
+        def _count_rows(conn):
+            return conn.execute(f"SELECT COUNT(*) FROM {table} WHERE materiale_id = ?", (materiale_id,)).fetchone()[0]
+        return await store._run(_count_rows)
+    return await store.db[table].count_documents({"materiale_id": materiale_id})
+
+
+async def test_delete_materiale_removes_movimenti_and_consumi(client, auth, store):
+    ids = []
+    for nome in ("farina", "zucchero"):
+        response = await client.post("/api/materiali", headers=auth, json={
+            "nome": nome, "quantita_disponibile": 10, "unita_misura": "kg",
+            "consumo_medio_giornaliero": 1, "giorni_consegna": 2, "costo_unitario": 1
+        })
+        ids.append(response.json()["materiale_id"])
+        await client.post(f"/api/materiali/{ids[-1]}/movimenti", headers=auth, json={"tipo": "scarico", "quantita": 3})
+
+    response = await client.delete(f"/api/materiali/{ids[0]}", headers=auth)
+    assert response.status_code == 200
+
+    assert await _count(store, "movimenti_materiali", ids[0]) == 0
+    assert await _count(store, "consumi_giornalieri", ids[0]) == 0
+    # L'altro materiale conserva il suo storico
+    assert await _count(store, "movimenti_materiali", ids[1]) == 1
+    assert await _count(store, "consumi_giornalieri", ids[1]) == 1
+
+    response = await client.delete(f"/api/materiali/{ids[0]}", headers=auth)
+    assert response.status_code == 404
@@ -0,0 +1,114 @@
+# Test Notification Sweeper
+# Suddivisione degli utenti tra i worker: ogni utente con le push attive
+# viene valutato da uno e un solo shard, filtrato nella query dello storage.
+
+import uuid
+
+import pytest
+
+import notification_sweeper
+import notifications
+import storage
+from notification_sweeper import run_sweep, shard_of
+
+pytestmark = pytest.mark.anyio
+
+OGGI = "2026-10-17"
+SHARDS = 3
+
+
+@pytest.fixture
+async def utenti(store):
+    user_ids = [f"user_{i:03d}" for i in range(30)]
+    for user_id in user_ids:
+        await store.insert_notification_preferences({
+            "user_id": user_id, "notifiche_push_enabled": True, "notifiche_magazzino": True,
+            "notifiche_stato": True, "notifiche_giornata_positiva": True
+        })
+    await store.insert_notification_preferences({"user_id": "spento", "notifiche_push_enabled": False})
+    return user_ids
+
+
+@pytest.fixture
+def valutati(monkeypatch):
+    """Utenti passati a sweep_chunk, gruppo per gruppo"""
+    chunks = []
+
+    async def sweep_chunk(store, prefs_chunk, oggi):
+        chunks.append([p["user_id"] for p in prefs_chunk])
+        return 0
+
+    monkeypatch.setattr(notification_sweeper, "sweep_chunk", sweep_chunk)
+    return chunks
+
+
+def test_shard_of_is_stable_and_in_range():
+    # crc32 e non hash(): lo stesso utente finisce nello stesso shard in ogni processo
+    assert [shard_of(user_id, 4) for user_id in ("user_001", "user_002")] == [0, 2]
+    assert all(0 <= shard_of(f"u{i}", 5) < 5 for i in range(100))
+    assert all(shard_of(f"u{i}", 1) == 0 for i in range(10))
+
+
+async def test_shards_partition_enabled_users(store, utenti, valutati):
+    per_shard = []
+    for shard in range(SHARDS):
+        valutati.clear()
+        stats = await run_sweep(store, oggi=OGGI, shard=shard, shards=SHARDS, chunk_size=4)
+        visti = [user_id for chunk in valutati for user_id in chunk]
+        assert stats["utenti"] == len(visti)
+        assert all(len(chunk) <= 4 for chunk in valutati)
+        assert all(shard_of(user_id, SHARDS) == shard for user_id in visti)
+        per_shard.append(set(visti))
+
+    assert sum(len(s) for s in per_shard) == len(utenti)
+    assert set().union(*per_shard) == set(utenti)
+    assert all(per_shard)
+
+
+async def test_single_shard_sees_everyone(store, utenti, valutati):
+    stats = await run_sweep(store, oggi=OGGI)
+    assert stats["utenti"] == len(utenti)
+    assert sorted(user_id for chunk in valutati for user_id in chunk) == utenti
+
+
+async def test_store_filters_the_shard_in_the_query(store, utenti):
+    per_shard = [
+        [prefs async for prefs in store.iter_push_enabled_preferences(shard, SHARDS)]
+        for shard in range(SHARDS)
+    ]
+    for shard, prefs in enumerate(per_shard):
+        assert prefs
+        assert all(shard_of(p["user_id"], SHARDS) == shard for p in prefs)
+        assert all("shard_hash" not in p for p in prefs)
+    assert sorted(p["user_id"] for prefs in per_shard for p in prefs) == utenti
+
+
+@pytest.fixture
+async def mongo():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"sweeper_{uuid.uuid4().hex[:8]}")
+    yield backend
+    await backend.close()
+
+
+async def test_mongo_preferences_without_shard_hash(mongo):
+    # Preferenze salvate prima di shard_hash
+    await mongo.db.notification_preferences.insert_many([
+        {"user_id": f"vecchio_{i}", "notifiche_push_enabled": True} for i in range(6)
+    ])
+    await mongo.update_notification_preferences("nuovo", {"notifiche_push_enabled": True})
+    assert (await mongo.db.notification_preferences.find_one({"user_id": "nuovo"}))["shard_hash"] == notifications.shard_hash("nuovo")
+    assert "shard_hash" not in await mongo.get_notification_preferences("nuovo")
+
+    async def visti():
+        return [
+            sorted([p["user_id"] async for p in mongo.iter_push_enabled_preferences(shard, 2)])
+            for shard in range(2)
+        ]
+
+    prima = await visti()
+    assert all(shard_of(user_id, 2) == shard for shard, ids in enumerate(prima) for user_id in ids)
+    assert sum(len(ids) for ids in prima) == 7
+
+    assert await notifications.assign_shard_hashes(mongo.db) == 6
+    assert await mongo.db.notification_preferences.count_documents({"shard_hash": {"$exists": False}}) == 0
+    assert await visti() == prima
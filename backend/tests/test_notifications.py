@@ -0,0 +1,150 @@
+# Test Notifiche
+# Deduplica della NotificationPipeline: nel batch e contro le notifiche
+# recenti già salvate. Contatore delle non lette su MongoDB.
+
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import notifications
+import storage
+from notifications import NotificationPipeline
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_duplicates_in_the_same_batch_are_merged(store):
+    pipeline = NotificationPipeline(store)
+    pipeline.add("u1", "magazzino", "mat_1", "primo", "m")
+    pipeline.add("u1", "magazzino", "mat_1", "secondo", "m")
+    pipeline.add("u1", "magazzino", "mat_2", "altro materiale", "m")
+    pipeline.add("u2", "magazzino", "mat_1", "altro utente", "m")
+    assert len(pipeline) == 3
+
+    salvate = await pipeline.flush()
+    assert len(salvate) == 3
+    # Vince la prima candidata
+    assert [n["titolo"] for n in salvate if n["user_id"] == "u1" and n["soggetto"] == "mat_1"] == ["primo"]
+    assert len(pipeline) == 0
+
+
+async def test_unread_recent_notification_blocks_duplicate(store):
+    pipeline = NotificationPipeline(store)
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    pipeline.add("u1", "stato_rosso", None, "t", "m")
+    await pipeline.flush()
+
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    pipeline.add("u1", "stato_rosso", None, "t", "m")
+    pipeline.add("u1", "stato_rosso", "2026-10-17", "t", "m")
+    salvate = await pipeline.flush()
+    assert [(n["tipo"], n["soggetto"]) for n in salvate] == [("stato_rosso", "2026-10-17")]
+    assert len(await store.list_notifiche("u1")) == 3
+
+
+async def test_read_notification_allows_repeat_unless_una_volta(store):
+    pipeline = NotificationPipeline(store)
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    pipeline.add("u1", "giornata_positiva", "2026-10-17", "t", "m", una_volta=True)
+    await pipeline.flush()
+    await store.mark_all_notifiche_lette("u1")
+
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    pipeline.add("u1", "giornata_positiva", "2026-10-17", "t", "m", una_volta=True)
+    salvate = await pipeline.flush()
+    assert [(n["tipo"], n["soggetto"]) for n in salvate] == [("magazzino", "mat_1")]
+
+
+async def test_notifications_older_than_window_do_not_block(store):
+    vecchia = (datetime.now(timezone.utc) - timedelta(hours=48)).isoformat()
+    await store.insert_notifiche([{
+        "notifica_id": "notif_vecchia", "user_id": "u1", "tipo": "magazzino", "soggetto": "mat_1",
+        "titolo": "t", "messaggio": "m", "letta": False, "created_at": vecchia
+    }])
+
+    pipeline = NotificationPipeline(store, dedup_hours=24)
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    assert len(await pipeline.flush()) == 1
+    pipeline.add("u1", "magazzino", "mat_1", "t", "m")
+    assert await pipeline.flush() == []
+
+
+@pytest.fixture
+async def mongo():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"notifiche_{uuid.uuid4().hex[:8]}")
+    yield backend
+    await backend.close()
+
+
+def notifica(notifica_id: str, user_id: str = "u1") -> dict:
+    return {
+        "notifica_id": notifica_id, "user_id": user_id, "tipo": "magazzino", "soggetto": notifica_id,
+        "titolo": "t", "messaggio": "m", "letta": False, "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def contatore(db, user_id: str = "u1"):
+    doc = await db.contatori_notifiche.find_one({"user_id": user_id})
+    return None if doc is None else doc["non_lette"]
+
+
+async def test_insert_creates_counter(mongo):
+    await mongo.insert_notifiche([notifica("n1"), notifica("n2"), notifica("n3", "u2")])
+    assert await contatore(mongo.db) == 2
+    assert await contatore(mongo.db, "u2") == 1
+
+    assert await mongo.mark_notifica_letta("u1", "n1") is True
+    assert await mongo.mark_notifica_letta("u1", "n1") is False
+    assert await mongo.get_unread_count("u1") == 1
+
+
+async def test_mark_all_decrements_by_marked_notifications(mongo):
+    await mongo.insert_notifiche([notifica("n1"), notifica("n2"), notifica("n3")])
+    assert await mongo.mark_notifica_letta("u1", "n1") is True
+
+    assert await mongo.mark_all_notifiche_lette("u1") == 2
+    assert await contatore(mongo.db) == 0
+    await mongo.insert_notifiche([notifica("n4")])
+    assert await mongo.get_unread_count("u1") == 1
+
+    # Contatore rimasto indietro: si ferma a zero
+    await mongo.db.contatori_notifiche.update_one({"user_id": "u1"}, {"$set": {"non_lette": 0}})
+    assert await mongo.mark_all_notifiche_lette("u1") == 1
+    assert await contatore(mongo.db) == 0
+
+
+async def test_insert_during_mark_all_stays_counted(mongo, monkeypatch):
+    await mongo.insert_notifiche([notifica("n1"), notifica("n2")])
+    decrement_unread = notifications.decrement_unread
+
+    async def insert_then_decrement(db, user_id, n=1):
+        # Notifica salvata tra update_many e l'aggiornamento del contatore
+        await mongo.insert_notifiche([notifica("n3")])
+        await decrement_unread(db, user_id, n)
+
+    monkeypatch.setattr(notifications, "decrement_unread", insert_then_decrement)
+    assert await mongo.mark_all_notifiche_lette("u1") == 2
+    assert await contatore(mongo.db) == 1
+    assert await mongo.get_unread_count("u1") == 1
+    assert [n["notifica_id"] for n in await mongo.list_notifiche("u1") if not n["letta"]] == ["n3"]
+
+
+async def test_decrement_never_goes_negative(mongo):
+    await mongo.insert_notifiche([notifica("n1")])
+    await mongo.db.contatori_notifiche.update_one({"user_id": "u1"}, {"$set": {"non_lette": 0}})
+    await notifications.decrement_unread(mongo.db, "u1")
+    assert await contatore(mongo.db) == 0
+
+
+async def test_legacy_notifications_read_only_count_and_rebuild(mongo):
+    # Notifiche salvate prima del contatore
+    await mongo.db.notifiche.insert_many([notifica("n1"), notifica("n2"), {**notifica("n3"), "letta": True}])
+
+    assert await mongo.get_unread_count("u1") == 2
+    assert await contatore(mongo.db) is None
+
+    await mongo.db.contatori_notifiche.insert_one({"user_id": "u9", "non_lette": 4})
+    assert await notifications.rebuild_unread_counters(mongo.db) == 2
+    assert await contatore(mongo.db) == 2
+    assert await contatore(mongo.db, "u9") == 0
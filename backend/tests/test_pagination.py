@@ -0,0 +1,75 @@
+# Test Pagination
+# Cursori di pagination.py: andata e ritorno con created_at stringa o
+# datetime, e pagine complete su una collection in pieno backfill.
+
+import base64
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import pagination
+import storage
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("created_at", [
+    "2026-10-17T08:30:00+00:00",
+    datetime(2026, 10, 17, 8, 30, tzinfo=timezone.utc),
+    datetime(2026, 10, 17, 8, 30, 0, 123000)
+])
+def test_cursor_round_trip(created_at):
+    cursor = pagination.encode_cursor(created_at, "ent_1")
+    assert pagination.decode_cursor(cursor) == (created_at, "ent_1")
+    assert type(pagination.decode_cursor(cursor)[0]) is type(created_at)
+
+
+@pytest.mark.parametrize("cursor", ["zzz", "", pagination.encode_cursor("x", "y")[:-4], "WyJhIiwgMV0="])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(cursor)
+
+
+def test_unknown_cursor_type_is_rejected():
+    raw = json.dumps(["2026-10-17", "ent_1", "int"]).encode("utf-8")
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(base64.urlsafe_b64encode(raw).decode("ascii"))
+
+
+async def test_pages_cover_mixed_created_at_once():
+    backend = storage.create_storage("mongo", mongo_url="mongodb://localhost:27017", db_name=f"pagination_{uuid.uuid4().hex[:8]}")
+    collection = backend.db.entrate
+    inizio = datetime(2026, 10, 1, tzinfo=timezone.utc)
+    docs = []
+    for i in range(13):
+        created_at = inizio + timedelta(minutes=i // 2)
+        # Metà dei documenti ancora con la stringa ISO di prima del backfill
+        docs.append({
+            "entrata_id": f"ent_{i:02d}",
+            "user_id": "u1",
+            "created_at": created_at.isoformat() if i % 2 else created_at
+        })
+    await collection.insert_many(docs)
+
+    visti, cursor = [], None
+    while True:
+        page, cursor = await pagination.fetch_page(collection, {"user_id": "u1"}, "entrata_id", 4, cursor)
+        visti += [doc["entrata_id"] for doc in page]
+        if cursor is None:
+            break
+        # Ogni cursore sopravvive al giro in querystring
+        assert pagination.decode_cursor(cursor)[1] == page[-1]["entrata_id"]
+
+    assert sorted(visti) == [doc["entrata_id"] for doc in docs]
+    assert len(visti) == len(set(visti))
+    # MongoDB ordina le stringhe prima delle date
+    stringhe = [doc["entrata_id"] for doc in docs if isinstance(doc["created_at"], str)]
+    assert visti[:len(stringhe)] == sorted(stringhe)
+
+    streamed = [doc["entrata_id"] async for doc in pagination.iter_documents(
+        collection, {"user_id": "u1"}, "entrata_id", pagination.encode_cursor(docs[1]["created_at"], "ent_01")
+    )]
+    assert "ent_01" not in streamed and len(streamed) == len(visti) - visti.index("ent_01") - 1
+    await backend.close()
@@ -0,0 +1,101 @@
+# Test Push Dispatcher
+# Nuovi tentativi con backoff per gli errori temporanei e rimozione dei
+# token non più registrati, con un sender finto al posto di FCM.
+
+import asyncio
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import notifications
+from notifications import PUSH_TEMPORANEO, PUSH_TOKEN_NON_VALIDO, PushDispatcher
+
+pytestmark = pytest.mark.anyio
+
+BACKOFF = 0.02
+
+
+class FlakySender:
+    """Errore temporaneo per le prime `fallimenti` chiamate, poi consegna"""
+
+    def __init__(self, fallimenti: int):
+        self.fallimenti = fallimenti
+        self.chiamate = []
+
+    def send_batch(self, messages):
+        self.chiamate.append(time.monotonic())
+        if len(self.chiamate) <= self.fallimenti:
+            return [PUSH_TEMPORANEO] * len(messages)
+        return [None] * len(messages)
+
+
+async def attendi(condizione, timeout: float = 2.0):
+    scadenza = time.monotonic() + timeout
+    while not condizione():
+        assert time.monotonic() < scadenza, "condizione non raggiunta"
+        await asyncio.sleep(0.005)
+
+
+@pytest.fixture
+def dispatcher(store, monkeypatch):
+    # Jitter fisso: i ritardi sono esattamente backoff_base * 2^(tentativo - 1)
+    monkeypatch.setattr(notifications.random, "uniform", lambda a, b: 1.0)
+    return PushDispatcher(store, workers=1, max_retries=3, backoff_base=BACKOFF)
+
+
+def messaggio(user_id: str = "u1", token: str = "tok_u1") -> dict:
+    return {"user_id": user_id, "token": token, "title": "Titolo", "body": "Testo"}
+
+
+async def test_temporary_errors_are_retried_with_backoff(dispatcher, monkeypatch):
+    sender = FlakySender(fallimenti=2)
+    monkeypatch.setattr(notifications, "_push_sender", sender)
+    dispatcher.start()
+    dispatcher.enqueue([messaggio()])
+    await attendi(lambda: dispatcher.stats["inviati"] == 1)
+    await dispatcher.stop()
+
+    assert len(sender.chiamate) == 3
+    assert dispatcher.stats["ritentati"] == 2
+    assert dispatcher.stats["falliti"] == 0
+    attese = [b - a for a, b in zip(sender.chiamate, sender.chiamate[1:])]
+    assert attese[0] >= BACKOFF
+    assert attese[1] >= 2 * BACKOFF
+
+
+async def test_gives_up_after_max_retries(dispatcher, monkeypatch):
+    sender = FlakySender(fallimenti=10)
+    monkeypatch.setattr(notifications, "_push_sender", sender)
+    dispatcher.start()
+    dispatcher.enqueue([messaggio()])
+    await attendi(lambda: dispatcher.stats["falliti"] == 1)
+    await dispatcher.stop()
+
+    assert len(sender.chiamate) == 1 + dispatcher.max_retries
+    assert dispatcher.stats["ritentati"] == dispatcher.max_retries
+    assert dispatcher.stats["inviati"] == 0
+
+
+async def test_unregistered_tokens_are_pruned(dispatcher, store, monkeypatch):
+    for user_id in ("u1", "u2", "u3"):
+        await store.insert_user({
+            "user_id": user_id, "email": f"{user_id}@example.it", "name": user_id,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        })
+        await store.update_user(user_id, {"fcm_token": f"tok_{user_id}"})
+    # u3 ha registrato un nuovo token dopo l'invio: quello vecchio non va più rimosso
+    await store.update_user("u3", {"fcm_token": "tok_u3_nuovo"})
+
+    sender = notifications.StubPushSender(
+        failing_tokens={"tok_u1": PUSH_TOKEN_NON_VALIDO, "tok_u3": PUSH_TOKEN_NON_VALIDO}
+    )
+    monkeypatch.setattr(notifications, "_push_sender", sender)
+    dispatcher.start()
+    dispatcher.enqueue([messaggio("u1", "tok_u1"), messaggio("u2", "tok_u2"), messaggio("u3", "tok_u3")])
+    await dispatcher.stop()
+
+    assert [m["token"] for m in sender.sent] == ["tok_u2"]
+    assert dispatcher.stats["token_rimossi"] == 1
+    assert dispatcher.stats["ritentati"] == 0
+    assert await store.get_fcm_tokens(["u1", "u2", "u3"]) == {"u2": "tok_u2", "u3": "tok_u3_nuovo"}